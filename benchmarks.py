@@ -0,0 +1,738 @@
+#! /usr/bin/env python
+
+"""
+Micro benchmarks for the lambda calculus core and the parser data structures.
+
+Usage:
+   python benchmarks.py [benchmark_name ...]
+
+With no argument, every benchmark is run.
+"""
+import sys
+import json
+import time
+import random
+import tracemalloc
+
+from functional_core import *
+from lambda_parser import FuncParser
+from wikidata_model import WikidataModelInterface,NamingContextWikidata,WikidataQuery
+from semparser import StackElement,SRAction,make_logical_parser
+from lexerpytrie_quan import Token
+from tests.terms import make_conjunction
+
+
+def make_beam_terms(parser,K=500,max_depth=4,seed=1):
+    """
+    Generates a beam worth of logical forms of the shape
+    (WHQ (JOIN wdt:P.. (AND wd:Q.. (JOIN wdt:P.. wd:Q..)))) as built by CCGParser.make_query
+    @param parser: a FuncParser with the combinators defined
+    @param K: number of logical forms
+    @return a list of lambda terms (non normalized)
+    """
+    names = parser.naming_context
+    rnd   = random.Random(seed)
+
+    def predicate(depth):
+        if depth == 0 or rnd.random() < 0.3:
+            return parser.parse_code('wd:Q%d'%(rnd.randint(1,10**6),))
+        combinator = rnd.choice(['JOIN','JOIN','AND','OR'])
+        if combinator == 'JOIN':
+            lhs = parser.parse_code('wdt:P%d'%(rnd.randint(1,3000),))
+        else:
+            lhs = predicate(depth-1)
+        return LambdaApplication(LambdaApplication(names[combinator].copy(),lhs),predicate(depth-1))
+
+    return [LambdaApplication(names['WHQ'].copy(),predicate(max_depth)) for _ in range(K)]
+
+
+def count_nodes(term):
+    """
+    Counts the nodes of a lambda term
+    """
+    N,stack = 0,[term]
+    while stack:
+        node = stack.pop()
+        N += 1
+        if isinstance(node,(LambdaAbstraction,ExistentialQuantifier)):
+            stack.append(node.body)
+        elif isinstance(node,LambdaApplication):
+            stack.extend((node.termA,node.termB))
+        elif isinstance(node,ConstantFunction):
+            stack.extend(node.args_values)
+    return N
+
+
+def bench_memory(K=500):
+    """
+    Reports the number of bytes allocated per lambda term node and per stack element
+    for a beam of K logical forms.
+    """
+    parser = make_logical_parser()
+    make_beam_terms(parser,K=2) #warm up caches
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    terms  = make_beam_terms(parser,K=K)
+    after  = tracemalloc.get_traced_memory()[0]
+    nodes  = sum(count_nodes(t) for t in terms)
+    print('raw terms        : %d nodes, %.1f bytes/node'%(nodes,(after-before)/nodes))
+
+    before = tracemalloc.get_traced_memory()[0]
+    values = [t.copy().value() for t in terms]
+    after  = tracemalloc.get_traced_memory()[0]
+    nodes  = sum(count_nodes(t) for t in values)
+    print('normalized terms : %d nodes, %.1f bytes/node'%(nodes,(after-before)/nodes))
+
+    before = tracemalloc.get_traced_memory()[0]
+    stack  = [StackElement('JOIN',idx,TYPE_REGISTRY.intern(('e','t'))) for idx in range(K*10)]
+    after  = tracemalloc.get_traced_memory()[0]
+    print('stack elements   : %d elements, %.1f bytes/element'%(len(stack),(after-before)/len(stack)))
+    tracemalloc.stop()
+
+
+def bench_traversal(sizes=(100,300,1000,5000)):
+    """
+    Times copy, typecheck, is_closed, substitute and value on large conjunctions
+    (as produced by coordination) under the default recursion limit.
+    """
+    parser = make_logical_parser()
+    print('recursion limit: %d'%(sys.getrecursionlimit(),))
+    for N in sizes:
+        term    = make_conjunction(parser,N)
+        apps    = make_conjunction(parser,N,normal_form=False)
+        timings = [ ]
+        try:
+            start = time.perf_counter()
+            cpy   = term.copy()
+            timings.append(('copy',time.perf_counter()-start,term))
+            start = time.perf_counter()
+            term.is_closed()
+            timings.append(('is_closed',time.perf_counter()-start,term))
+            start = time.perf_counter()
+            LambdaApplication(LambdaAbstraction('P',(TypeSystem.BOOLEAN,),LambdaVariable('P')),cpy).value()
+            timings.append(('substitute+value',time.perf_counter()-start,term))
+            start = time.perf_counter()
+            TypeSystem.typecheck(apps)
+            timings.append(('typecheck',time.perf_counter()-start,apps))
+        except RecursionError:
+            timings.append(('RecursionError',0,term))
+        print('N=%5d  %s'%(N,'  '.join(['%s %.2f us/node'%(name,1e6*t/count_nodes(T)) for name,t,T in timings])))
+
+
+def bench_closures(R=20000,seed=1):
+    """
+    Evaluates a numeric filter over R candidate bindings, either by rewriting
+    the term for each binding or by calling the compiled closure once per binding.
+    """
+    parser = FuncParser()
+    code   = '(lambda (x:num y:num) (and (< (* 2 x) (+ y 3)) (or (>= (- y x) 1) (not (== x y)))))'
+    term   = parser.parse_code(code)
+    rnd    = random.Random(seed)
+    bindings = [(float(rnd.randint(0,100)),float(rnd.randint(0,100))) for _ in range(R)]
+
+    start = time.perf_counter()
+    rewritten = [ ]
+    for x,y in bindings:
+        T = LambdaApplication(LambdaApplication(term.copy(),ConstantFunction.make_constant(x,TypeSystem.NUMERIC)),\
+                              ConstantFunction.make_constant(y,TypeSystem.NUMERIC))
+        rewritten.append(T.value().ret_value())
+    t_rewrite = time.perf_counter()-start
+
+    start = time.perf_counter()
+    fun   = compile_term(term)
+    t_compile = time.perf_counter()-start
+    start = time.perf_counter()
+    compiled = [fun(x,y) for x,y in bindings]
+    t_call = time.perf_counter()-start
+
+    assert rewritten == compiled
+    print('rewriting : %.2f us/binding'%(1e6*t_rewrite/R,))
+    print('compiled  : %.2f us/binding (compilation %.1f us)'%(1e6*t_call/R,1e6*t_compile))
+
+
+def make_chain(parser,D):
+    """
+    Builds the logical form (WHQ (JOIN wdt:P1 (AND wd:Q1 (JOIN wdt:P2 (AND wd:Q2 ... wd:QD))))) of depth 2D
+    as produced by the CCG parser for long relative clauses and coordinations.
+    @return a lambda term (non normalized)
+    """
+    names = parser.naming_context
+    pred  = parser.parse_code('wd:Q%d'%(D,))
+    for idx in range(D-1,0,-1):
+        pred = LambdaApplication(LambdaApplication(names['AND'].copy(),parser.parse_code('wd:Q%d'%(idx,))),pred)
+        pred = LambdaApplication(LambdaApplication(names['JOIN'].copy(),parser.parse_code('wdt:P%d'%(idx,))),pred)
+    return LambdaApplication(names['WHQ'].copy(),pred)
+
+
+def bench_sharing(depths=(2,8,32,128),K=500):
+    """
+    Compares the rewriting evaluator (copy + value) with the shared environment evaluator
+    on JOIN/AND chains: time and transient memory (peak minus memory retained by the results).
+    """
+    parser = make_logical_parser()
+    for D in depths:
+        terms = [make_beam_terms(parser,K=K)] if D == 2 else [[make_chain(parser,D)]]
+        terms = terms[0]
+        stats = [ ]
+        for name,evaluate in [('rewriting',lambda t:t.copy().value()),('shared',evaluate_term)]:
+            tracemalloc.start()
+            start  = time.perf_counter()
+            values = [evaluate(t) for t in terms]
+            end    = time.perf_counter()
+            retained,peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats.append((name,values,end-start,peak-retained))
+        assert all(equal_terms(A,B) for A,B in zip(stats[0][1],stats[1][1]))
+        label = 'beam K=%d'%(K,) if D == 2 else 'chain D=%d'%(D,)
+        print('%-12s %s'%(label,'  '.join(['%s %.1f ms, transient %.1f kB'%(name,1e3*t,peak/1024) for name,values,t,peak in stats])))
+
+
+def bench_types(R=20000,seed=1):
+    """
+    Times the type deductions performed by the parser actions when generating the
+    constraints of R configurations: tuple surgery versus registry lookups.
+    """
+    parser  = make_logical_parser()
+    names   = parser.naming_context
+    actions = [SRAction(SRAction.APPLY_LEFT),SRAction(SRAction.APPLY_RIGHT)]
+    actions+= [SRAction(act_type,macro,names[macro]) for act_type in [SRAction.APPLY_LEFT,SRAction.APPLY_RIGHT] for macro in ['JOIN','AND','OR']]
+    actions+= [SRAction(SRAction.COORD,macro,names[macro]) for macro in ['AND','OR']]
+    ttypes  = [('e','t'),('e','e','t'),('e',),('t',),(('e','t'),'t'),TypeSystem.FAILURE]
+    rnd     = random.Random(seed)
+    configs = [(rnd.choice(ttypes),rnd.choice(ttypes)) for _ in range(R)]
+
+    start = time.perf_counter()
+    tuple_results = [ ]
+    for lhs,rhs in configs:
+        for act in actions:
+            ctype = TYPE_REGISTRY.type_of(act.ctype)
+            if act.act_type == SRAction.APPLY_RIGHT:
+                lhs,rhs = rhs,lhs
+            ltype = TypeSystem.deduce_application_type(ctype,lhs) if act.act_combinator else lhs
+            tuple_results.append(TypeSystem.deduce_application_type(ltype,rhs))
+            if act.act_type == SRAction.APPLY_RIGHT:
+                lhs,rhs = rhs,lhs
+    t_tuples = time.perf_counter()-start
+
+    start = time.perf_counter()
+    id_configs  = [(TYPE_REGISTRY.intern(lhs),TYPE_REGISTRY.intern(rhs)) for lhs,rhs in configs]
+    id_results  = [act.logical_type(lhs,rhs) for lhs,rhs in id_configs for act in actions]
+    t_ids = time.perf_counter()-start
+
+    assert tuple_results == [TYPE_REGISTRY.type_of(type_id) for type_id in id_results]
+    N = len(id_results)
+    print('tuple types : %.2f us/deduction'%(1e6*t_tuples/N,))
+    print('type ids    : %.2f us/deduction (%d types interned)'%(1e6*t_ids/N,len(TYPE_REGISTRY.types)))
+
+    terms = make_beam_terms(parser,K=R//10)
+    start = time.perf_counter()
+    first = [TypeSystem.typecheck(t) for t in terms]
+    t_first = time.perf_counter()-start
+    start = time.perf_counter()
+    again = [TypeSystem.typecheck(t) for t in terms]
+    t_again = time.perf_counter()-start
+    assert first == again
+    print('typecheck   : %.2f us/term, again (cached) %.2f us/term'%(1e6*t_first/len(terms),1e6*t_again/len(terms)))
+
+    lexicon = dict([(macro,parser.parse_code(macro)) for macro in ['wd:Q%d'%(idx,) for idx in range(100)]])
+    lexicon['WHQ'] = names['WHQ']
+    macros  = [rnd.choice(list(lexicon)) for _ in range(R)]
+    start   = time.perf_counter()
+    type_cache = MacroTypeCache()
+    tokens  = [Token(macro,'NOTAG',macro,lexicon[macro],type_cache) for macro in macros]
+    t_tokens = time.perf_counter()-start
+    print('tokens      : %.2f us/token (%d macros typechecked)'%(1e6*t_tokens/R,len(type_cache.types)))
+
+
+def bench_startup(R=50):
+    """
+    Times the construction of parser instances (the LALR tables are built by the first one only).
+    """
+    names = NamingContext.make_std_builtins_context()
+    start = time.perf_counter()
+    FuncParser(names)
+    t_first = time.perf_counter()-start
+    start = time.perf_counter()
+    parsers = [FuncParser(names) for _ in range(R)]
+    t_next = time.perf_counter()-start
+    print('first parser : %.1f ms'%(1e3*t_first,))
+    print('next parsers : %.1f us/parser'%(1e6*t_next/R,))
+
+
+def bench_parsing(R=20000,seed=1):
+    """
+    Times the parsing of lexical entries as done by the lexers (wikidata IDs drawn from a small
+    vocabulary) and of repeated combinator expressions, with and without the parse cache.
+    """
+    rnd    = random.Random(seed)
+    ids    = ['wd:Q%d'%(rnd.randint(1,10**6),) if rnd.random() < 0.7 else 'wdt:P%d'%(rnd.randint(1,3000),) for _ in range(500)]
+    codes  = ['(lambda (P:e=>t) (@exists(x:e) (P x)))','(lambda (x:e) (and (%s x) (%s x)))'%(rnd.choice(ids),rnd.choice(ids))]
+    for name,stream in [('ids',[rnd.choice(ids) for _ in range(R)]),('expressions',[rnd.choice(codes) for _ in range(R)])]:
+        for cache_size in [0,10000]:
+            parser = make_logical_parser()
+            parser.cache_size = cache_size
+            start = time.perf_counter()
+            for code in stream:
+                parser.parse_code(code)
+            elapsed = time.perf_counter()-start
+            print('%-12s cache size %5d : %.2f us/parse'%(name,cache_size,1e6*elapsed/R))
+
+
+def bench_sparql(R=500):
+    """
+    Times ASK queries sent to a local stand-in endpoint: one new connection per query
+    (as SPARQLWrapper does) versus the pooled keep-alive client.
+    """
+    from sparql_client import SparqlClient
+    from tests.sparql_server import LocalSparqlServer
+    server = LocalSparqlServer(LocalSparqlServer.ask_answer(True))
+    query  = WikidataQuery.make_ask_query('wd:Q42 wdt:P31 wd:Q5 .')
+    start  = time.perf_counter()
+    for _ in range(R):
+        client = SparqlClient(server.endpoint)
+        assert client.query(query)['boolean']
+        client.close()
+    t_new  = time.perf_counter()-start
+    client = SparqlClient(server.endpoint)
+    start  = time.perf_counter()
+    for _ in range(R):
+        assert client.query(query)['boolean']
+    t_pool = time.perf_counter()-start
+    print('new connection per query : %.1f us/query'%(1e6*t_new/R,))
+    print('pooled connections       : %.1f us/query (%s)'%(1e6*t_pool/R,client))
+    client.close()
+    server.close()
+
+
+def select_answer(query_string):
+    """
+    Stand-in endpoint answer: every SELECT query has one solution, every ASK query is true
+    """
+    if 'SELECT' in query_string:
+        return {'head':{'vars':['x']},'results':{'bindings':[{'x':{'type':'uri','value':'http://www.wikidata.org/entity/Q42'}}]}}
+    return {'head':{},'boolean':True}
+
+
+def bench_beam_queries(K=32,delay=0.02):
+    """
+    Answers the queries of a beam of K logical forms against a stand-in endpoint answering in 'delay' seconds,
+    sequentially (one blocking round trip per query) or concurrently with the async API.
+    """
+    import asyncio
+    from tests.sparql_server import LocalSparqlServer
+    server = LocalSparqlServer(select_answer,delay=delay)
+    WikidataQuery.ENDPOINT   = server.endpoint
+    WikidataQuery.CACHE_SIZE = 0 #every query of both runs goes to the endpoint
+    parser  = make_logical_parser()
+    queries = [evaluate_term(term) for term in make_beam_terms(parser,K=K)]
+    start   = time.perf_counter()
+    sequential = [query.ret_value(ret_type='SELECT',debug=False) for query in queries]
+    t_seq   = time.perf_counter()-start
+
+    async def beam():
+        return await asyncio.gather(*[query.ret_value_async(ret_type='SELECT') for query in queries])
+    start   = time.perf_counter()
+    concurrent = asyncio.run(beam())
+    t_async = time.perf_counter()-start
+    assert sequential == concurrent
+    print('sequential : %.1f ms/beam'%(1e3*t_seq,))
+    print('concurrent : %.1f ms/beam (at most %d queries in flight)'%(1e3*t_async,WikidataQuery.MAX_CONCURRENCY))
+    server.close()
+
+
+def bench_degraded(R=200,seed=1):
+    """
+    Sends R queries to a stand-in endpoint failing (503) on a third of the requests, without and with retries,
+    then R queries to an endpoint slower than the query deadline, without and with the circuit breaker.
+    """
+    from sparql_client import SparqlClient,SparqlError
+    from tests.sparql_server import LocalSparqlServer
+    rnd = random.Random(seed)
+    def flaky(query_string):
+        if rnd.random() < 1/3:
+            raise SparqlError(503,'overloaded')
+        return {'head':{},'boolean':True}
+
+    def run(client):
+        ok,start = 0,time.perf_counter()
+        for idx in range(R):
+            try:
+                client.query('ASK { wd:Q%d ?p ?o }'%(idx,),timeout=0.05)
+                ok += 1
+            except SparqlError:
+                pass
+        return ok,time.perf_counter()-start
+
+    server = LocalSparqlServer(flaky)
+    for retries in [0,2]:
+        ok,elapsed = run(SparqlClient(server.endpoint,retries=retries,backoff=0.005,failure_threshold=R))
+        print('503 on 1/3 of the requests, %d retries : %d/%d answered in %.2f s'%(retries,ok,R,elapsed))
+    server.close()
+    server = LocalSparqlServer(LocalSparqlServer.ask_answer(True),delay=0.2)
+    for threshold in [R*10,5]:
+        ok,elapsed = run(SparqlClient(server.endpoint,retries=0,failure_threshold=threshold,reset_timeout=60))
+        print('endpoint too slow, breaker after %4d failures : %d/%d answered in %.2f s'%(threshold,ok,R,elapsed))
+    server.close()
+
+
+def bench_cache(R=300,K=50,seed=1):
+    """
+    Sends R queries drawn from K distinct ones (a third are hopeless: they time out, a third are empty)
+    to a stand-in endpoint, without and with the cache of query outcomes.
+    """
+    from sparql_client import SparqlClient,SparqlError,QueryCache
+    from tests.sparql_server import LocalSparqlServer
+    def answer(query_string):
+        idx = int(query_string.split('wd:Q')[1].split()[0])
+        if idx % 3 == 0:
+            time.sleep(0.1)
+        return {'head':{},'boolean':idx % 3 == 2}
+    rnd     = random.Random(seed)
+    queries = ['ASK { wd:Q%d ?p ?o }'%(rnd.randrange(K),) for _ in range(R)]
+    server  = LocalSparqlServer(answer)
+    for cache in [None,QueryCache(1000,negative_ttl=60,error_ttl=10)]:
+        client = SparqlClient(server.endpoint,retries=0,failure_threshold=R*10,cache=cache)
+        ok,start = 0,time.perf_counter()
+        for query in queries:
+            try:
+                ok += client.query(query,timeout=0.05)['boolean']
+            except SparqlError:
+                pass
+        print('%s : %d/%d true in %.2f s, %d sent'%('with cache   ' if cache else 'without cache',ok,R,time.perf_counter()-start,client.nqueries))
+    print(cache)
+    server.close()
+
+
+def bench_triple_store(N=200000,K=500,seed=1):
+    """
+    Builds a local triple store of N random claims and answers the queries of K logical forms with it.
+    """
+    import tempfile
+    from triple_store import TripleStore,TripleStoreModelInterface
+    rnd     = random.Random(seed)
+    triples = [('Q%d'%(rnd.randint(1,N//4),),'P%d'%(rnd.randint(1,30),),'Q%d'%(rnd.randint(1,N//4),)) for _ in range(N)]
+    with tempfile.TemporaryDirectory() as dirname:
+        start = time.perf_counter()
+        TripleStore.build(triples,dirname).close()
+        t_build = time.perf_counter()-start
+        start = time.perf_counter()
+        store = TripleStore(dirname)
+        t_open = time.perf_counter()-start
+        parser  = make_logical_parser(TripleStoreModelInterface(store))
+        queries = [evaluate_term(term) for term in make_beam_terms(parser,K=K,seed=seed)]
+        for query in queries: #restricts the IDs to the ones of the store
+            stack = [query]
+            while stack:
+                node = stack.pop()
+                if isinstance(node,ConstantFunction) and node.fun_name[:3] in ('wd:','wdt'):
+                    node.fun_name = 'wd:Q%d'%(rnd.randint(1,N//4),) if node.fun_name[:3] == 'wd:' else 'wdt:P%d'%(rnd.randint(1,30),)
+                stack.extend(node.args_values if isinstance(node,ConstantFunction) else [getattr(node,field) for field in ('body','func','arg') if hasattr(node,field)])
+        start   = time.perf_counter()
+        answers = [query.ret_value(ret_type='SELECT',debug=False) for query in queries]
+        t_query = time.perf_counter()-start
+        print('build : %.1f s for %d triples, open : %.1f ms'%(t_build,N,1e3*t_open))
+        print('query : %.2f ms/query (%d answers)'%(1e3*t_query/K,sum(len(answer) for answer in answers)))
+        store.close()
+
+
+def bench_planner(N=200000,K=500,seed=1):
+    """
+    Evaluates the group patterns of K logical forms left to right (no reordering by the engine) against
+    a local store with skewed property frequencies, in derivation order and in the order of the planner.
+    Reports the number of intermediate solutions built and the planning time.
+    """
+    import tempfile
+    from triple_store import TripleStore
+    from sparql_planner import QueryPlanner
+    from wikidata_model import SparqlNameGenerator
+    rnd     = random.Random(seed)
+    props   = ['P%d'%(min(int(rnd.paretovariate(0.7)),30),) for _ in range(N)]
+    triples = [('Q%d'%(rnd.randint(1,N//4),),prop,'Q%d'%(rnd.randint(1,N//(4*int(prop[1:]))+1),)) for prop in props]
+    with tempfile.TemporaryDirectory() as dirname:
+        store   = TripleStore.build(triples,dirname)
+        planner = QueryPlanner(QueryPlanner.stats_from_store(store))
+        parser  = make_logical_parser()
+        queries = [ ]
+        for term in make_beam_terms(parser,K=4*K,seed=seed):
+            query = evaluate_term(term)
+            stack = [query]
+            while stack: #restricts the IDs to the ones of the store
+                node = stack.pop()
+                if isinstance(node,ConstantFunction) and node.fun_name[:3] in ('wd:','wdt'):
+                    node.fun_name = 'wd:Q%d'%(rnd.randint(1,N//4),) if node.fun_name[:3] == 'wd:' else 'wdt:P%d'%(rnd.randint(1,30),)
+                stack.extend(node.args_values if isinstance(node,ConstantFunction) else [getattr(node,field) for field in ('body','func','arg') if hasattr(node,field)])
+            patterns = query.sparql_patterns([],SparqlNameGenerator()) if hasattr(query,'sparql_patterns') else []
+            if len(patterns) > 1 and all(QueryPlanner.parse_element(pattern)[0] != 'other' for pattern in patterns):
+                queries.append(patterns)
+        queries = queries[:K]
+
+        def run(patterns):
+            solutions,work = [{}],0
+            for element in map(QueryPlanner.parse_element,patterns):
+                if element[0] == 'bind':
+                    code = store.code(element[1])
+                    solutions = [dict(solution,**{element[2]:code}) for solution in solutions if solution.get(element[2],code) == code]
+                else:
+                    solutions = store.join_triple(element[1:],solutions)
+                work += len(solutions)
+            return work,len(solutions)
+
+        start = time.perf_counter()
+        plans = [planner.order(patterns) for patterns in queries]
+        t_plan = time.perf_counter()-start
+        for name,batch in [('derivation order',queries),('planned order   ',plans)]:
+            start = time.perf_counter()
+            results = [run(patterns) for patterns in batch]
+            print('%s : %8d intermediate solutions, %d answers, %.2f ms/query'%(name,sum(w for w,_ in results),sum(a for _,a in results),1e3*(time.perf_counter()-start)/len(batch)))
+        print('planning : %.1f us/query (%d queries)'%(1e6*t_plan/len(queries),len(queries)))
+        store.close()
+
+
+def make_derivations(ccg,parser,K,ids,seed=1):
+    """
+    Generates K derivations (with their tokens) of the skeletons who P Q, who P P Q and who P Q and P Q
+    @param ccg: a CCGParser
+    @param parser: a FuncParser with the combinators defined
+    @param ids: a function (rnd,macro) -> a wikidata ID (macro is either P or Q)
+    @return a list of couples (derivation,toklist)
+    """
+    from lexerpytrie_quan import Token
+    rnd     = random.Random(seed)
+    actions = dict([(action.stack_label,action) for action in ccg.actions_list])
+    wh_term = parser.parse_code('(lambda (P:e=>t) (@exists(x:e) (P x)))')
+    shapes  = [('WHQ P Q',['S','S','S','>[JOIN]','>']),
+               ('WHQ P P Q',['S','S','S','S','>[JOIN]','>[JOIN]','>']),
+               ('WHQ P Q AND P Q',['S','S','S','>[JOIN]','D','S','S','>[JOIN]','C[AND]','>'])]
+    samples = [ ]
+    for _ in range(K):
+        macros,labels = rnd.choice(shapes)
+        toklist = [ ]
+        for macro in macros.split():
+            if macro == 'WHQ':
+                toklist.append(Token('qui','NOTAG','WHQ',wh_term.copy()))
+            elif macro == 'AND':
+                toklist.append(Token('et','NOTAG','AND',None))
+            else:
+                ident = ids(rnd,macro)
+                toklist.append(Token(ident,'NOTAG',ident,parser.parse_code(('wd:' if macro == 'Q' else 'wdt:')+ident)))
+        samples.append(([(None,actions[label]) for label in labels]+[(None,None)],toklist))
+    return samples
+
+
+def bench_templates(K=2000,seed=1):
+    """
+    Generates the queries of K derivations of three skeletons (who P Q, who P P Q, who P Q and P Q) with random IDs,
+    by normalizing their logical forms or from the templates of their skeletons.
+    """
+    from semparser import CCGParser
+    parser  = make_logical_parser()
+    ccg     = CCGParser(None)
+    samples = make_derivations(ccg,parser,K,lambda rnd,macro: '%s%d'%(macro,rnd.randint(1,10**6)),seed)
+
+    start   = time.perf_counter()
+    full    = [ccg.make_query_term(derivation,toklist).sparql_query('SELECT') for derivation,toklist in samples]
+    t_full  = time.perf_counter()-start
+    start   = time.perf_counter()
+    fast    = [ccg.make_query_string(derivation,toklist)[0] for derivation,toklist in samples]
+    t_fast  = time.perf_counter()-start
+    assert full == fast
+    print('normalized logical forms : %.1f us/query'%(1e6*t_full/K,))
+    print('query templates          : %.1f us/query (%d templates)'%(1e6*t_fast/K,len(ccg.templates)))
+
+    #with statistics, the evaluation order depends on the IDs: each instance is planned with its own IDs
+    from sparql_planner import QueryPlanner
+    rnd       = random.Random(seed)
+    props     = set(tok.logical_macro for derivation,toklist in samples for tok in toklist if tok.logical_macro.startswith('P'))
+    entities  = set(tok.logical_macro for derivation,toklist in samples for tok in toklist if tok.logical_macro.startswith('Q'))
+    stats     = dict([(prop,(rnd.randint(1,10**6),rnd.randint(1,10**5),rnd.randint(1,10**5))) for prop in props])
+    planner   = WikidataQuery.PLANNER
+    WikidataQuery.PLANNER = QueryPlanner(stats,dict([(entity,rnd.random()) for entity in entities]))
+    ccg.templates.clear()
+    start   = time.perf_counter()
+    full    = [ccg.make_query_term(derivation,toklist).sparql_query('SELECT') for derivation,toklist in samples]
+    t_full  = time.perf_counter()-start
+    start   = time.perf_counter()
+    fast    = [ccg.make_query_string(derivation,toklist)[0] for derivation,toklist in samples]
+    t_fast  = time.perf_counter()-start
+    WikidataQuery.PLANNER = planner
+    assert full == fast
+    print('with statistics, normalized logical forms : %.1f us/query'%(1e6*t_full/K,))
+    print('with statistics, query templates          : %.1f us/query (%d templates, %d evaluation orders)'%(1e6*t_fast/K,len(ccg.templates),sum(len(template.plans) for template in ccg.templates.values() if template is not None)))
+
+
+def bench_streaming(R=200,N=1000):
+    """
+    Checks the answers of R SELECT queries with N solutions each against a reference set,
+    from the complete JSON results or from TSV results read as they arrive (stopping at the first
+    correct answer): the correct answer is the 10th solution, or is missing.
+    """
+    from semparser import CCGParser
+    from tests.sparql_server import LocalSparqlServer
+    result = {'head':{'vars':['x0']},'results':{'bindings':[{'x0':{'type':'uri','value':'http://www.wikidata.org/entity/Q%d'%(idx,)}} for idx in range(N)]}}
+    server = LocalSparqlServer(lambda query_string: result)
+    WikidataQuery.ENDPOINT   = server.endpoint
+    WikidataQuery.CACHE_SIZE = 0
+    for refset,case in [(set(['Q9']),'answer found '),(set(['Q-1']),'answer missing')]:
+        start = time.perf_counter()
+        full  = [CCGParser.is_correct(CCGParser.answer_entities(WikidataQuery.send_query('SELECT ?x0 WHERE { } #%d'%(idx,),'SELECT')),refset) for idx in range(R)]
+        t_full = time.perf_counter()-start
+        start = time.perf_counter()
+        lazy  = [ ]
+        for idx in range(R):
+            results = WikidataQuery.stream_query('SELECT ?x0 WHERE { } #%d'%(idx,))
+            lazy.append(CCGParser.is_correct(CCGParser.iter_entities(results),refset))
+            results.close()
+        t_lazy = time.perf_counter()-start
+        assert full == lazy
+        print('%s : json %.2f ms/query, streamed tsv %.2f ms/query'%(case,1e3*t_full/R,1e3*t_lazy/R))
+    print(WikidataQuery.client())
+    server.close()
+
+
+def bench_answer_checks(K=300,N=1000,seed=1):
+    """
+    Checks the answers of K derivations against reference answers in the three check modes of the CCG parser:
+    on a local triple store (the modes must agree) and on a stand-in endpoint answering N solutions per SELECT query.
+    """
+    import tempfile
+    from semparser import CCGParser
+    from tests.sparql_server import LocalSparqlServer
+    from triple_store import TripleStore,TripleStoreModelInterface
+    rnd     = random.Random(seed)
+    triples = [('Q%d'%(rnd.randint(1,2000),),'P%d'%(rnd.randint(1,5),),'Q%d'%(rnd.randint(1,2000),)) for _ in range(50000)]
+    ids     = lambda rnd,macro: '%s%d'%(macro,rnd.randint(1,5) if macro == 'P' else rnd.randint(1,2000))
+    ccg     = CCGParser(None)
+
+    def run(samples,refset):
+        results = { }
+        for mode in ['select','stream','ask']:
+            ccg.check_mode = mode
+            start  = time.perf_counter()
+            flags  = [ccg.check_derivations([(derivation,('t',))],toklist,refset,True)[0] for derivation,toklist in samples]
+            results[mode] = (flags,time.perf_counter()-start)
+        return results
+
+    with tempfile.TemporaryDirectory() as dirname:
+        store   = TripleStore.build(triples,dirname)
+        samples = make_derivations(ccg,make_logical_parser(TripleStoreModelInterface(store)),K,ids,seed)
+        ccg.templates.clear()
+        results = run(samples,set(['Q%d'%(idx,) for idx in range(1,2000,50)]))
+        assert results['select'][0] == results['stream'][0] == results['ask'][0]
+        print('local store : %d/%d correct, %s'%(sum(results['ask'][0]),K,', '.join(['%s %.2f ms'%(mode,1e3*t/K) for mode,(flags,t) in results.items()])))
+        store.close()
+
+    rows   = [{'x0':{'type':'uri','value':'http://www.wikidata.org/entity/Q%d'%(idx,)}} for idx in range(N)]
+    select = json.dumps({'head':{'vars':['x0']},'results':{'bindings':rows}})
+    sizes  = { }
+    def answer(query_string):
+        qtype = 'ASK' if 'ASK {' in query_string else 'SELECT'
+        sizes[qtype] = len(json.dumps({'head':{},'boolean':True})) if qtype == 'ASK' else len(select)
+        return {'head':{},'boolean':True} if qtype == 'ASK' else json.loads(select)
+    server = LocalSparqlServer(answer)
+    WikidataQuery.ENDPOINT   = server.endpoint
+    WikidataQuery.CACHE_SIZE = 0
+    ccg     = CCGParser(None)
+    samples = make_derivations(ccg,make_logical_parser(),K,lambda rnd,macro: '%s%d'%(macro,rnd.randint(1,10**6)),seed)
+    results = run(samples,set(['Q%d'%(N//2,)]))
+    print('endpoint    : %s (JSON answer %d bytes for SELECT, %d bytes for ASK)'%(', '.join(['%s %.2f ms'%(mode,1e3*t/K) for mode,(flags,t) in results.items()]),sizes['SELECT'],sizes['ASK']))
+    server.close()
+
+
+def bench_batching(P=8,Q=8,delay=0.02,seed=1):
+    """
+    Answers the queries of a beam of P*Q derivations (who P Q, for P properties and Q entities of the sentence)
+    with a stand-in endpoint evaluating the queries on a local store in 'delay' seconds per request,
+    one query per request or merged in batches (@see WikidataQuery.make_batch_query).
+    """
+    import tempfile
+    from semparser import CCGParser
+    from tests.sparql_server import LocalSparqlServer
+    from triple_store import TripleStore
+    from lexerpytrie_quan import Token
+    rnd     = random.Random(seed)
+    triples = [('Q%d'%(rnd.randint(1,2000),),'P%d'%(rnd.randint(1,P),),'Q%d'%(rnd.randint(1,2000),)) for _ in range(50000)]
+    parser  = make_logical_parser()
+    ccg     = CCGParser(None)
+    actions = dict([(action.stack_label,action) for action in ccg.actions_list])
+    toklist = [Token('qui','NOTAG','WHQ',parser.parse_code('(lambda (P:e=>t) (@exists(x:e) (P x)))'))]
+    toklist.extend(Token('P%d'%(idx,),'NOTAG','P%d'%(idx,),parser.parse_code('wdt:P%d'%(idx,))) for idx in range(1,P+1))
+    toklist.extend(Token('Q%d'%(idx,),'NOTAG','Q%d'%(idx,),parser.parse_code('wd:Q%d'%(idx,))) for idx in rnd.sample(range(1,2001),Q))
+    beam = [ ]
+    for i in range(P):
+        for j in range(Q):
+            labels = ['S']+['D']*i+['S']+['D']*(P-1-i)+['D']*j+['S']+['D']*(Q-1-j)+['>[JOIN]','>']
+            beam.append([(None,actions[label]) for label in labels]+[(None,None)])
+    with tempfile.TemporaryDirectory() as dirname:
+        store  = TripleStore.build(triples,dirname)
+        server = LocalSparqlServer(store.query,delay=delay)
+        WikidataQuery.ENDPOINT   = server.endpoint
+        WikidataQuery.CACHE_SIZE = 0
+        reference = None
+        for size in [1,8,32]:
+            WikidataQuery.BATCH_SIZE = size
+            nrequests = len(server.queries)
+            start     = time.perf_counter()
+            answers   = ccg.make_queries_concurrently(beam,toklist)
+            elapsed   = time.perf_counter()-start
+            reference = answers if reference is None else reference
+            assert answers == reference
+            print('batch size %2d : %3d requests, %.1f ms/beam (%d queries, %d answers)'%(size,len(server.queries)-nrequests,1e3*elapsed,len(beam),sum(len(answer) for answer in answers)))
+        WikidataQuery.BATCH_SIZE = 1
+        server.close()
+        store.close()
+
+
+def bench_superlatives(N=20000,C=5,R=20,seed=1):
+    """
+    Answers 'which is the highest X' for C classes X of N/C candidates each, on a local store served by a stand-in endpoint:
+    ranked by the endpoint (argmax @see WikiSuperlative) or by fetching the (candidate,value) pairs and ranking them in python.
+    """
+    import tempfile
+    from tests.sparql_server import LocalSparqlServer
+    from triple_store import TripleStore
+    rnd     = random.Random(seed)
+    triples = [ ]
+    for idx in range(N):
+        triples.append(('Q%d'%(idx+1000,),'P31','Q%d'%(1+idx%C,)))
+        triples.append(('Q%d'%(idx+1000,),'P2044',str(rnd.randint(0,10**6))))
+    with tempfile.TemporaryDirectory() as dirname:
+        store = TripleStore.build(triples,dirname)
+        sizes = [ ]
+        def answer(query_string):
+            result = store.query(query_string)
+            sizes.append(len(json.dumps(result)))
+            return result
+        server = LocalSparqlServer(answer)
+        WikidataQuery.ENDPOINT   = server.endpoint
+        WikidataQuery.CACHE_SIZE = 0
+        parser      = make_logical_parser()
+        restriction = '(lambda (y:e) (exists (z:e) (and (wdt:P31 y z) (wd:Q%d z))))'
+        ranked      = [parser.parse_code('(@exists (x:e) (argmax %s wdt:P2044 x))'%(restriction%(cls,),)).value() for cls in range(1,C+1)]
+        fetched     = [parser.parse_code('(@exists (x:e) (@exists (v:e) (and (%s x) (wdt:P2044 x v))))'%(restriction%(cls,),)).value() for cls in range(1,C+1)]
+        reference   = { } #class -> (value,candidate) of the highest candidate
+        for (subj,_,cls),(_,_,value) in zip(triples[0::2],triples[1::2]):
+            reference[cls] = max(reference.get(cls,(-1,None)),(int(value),subj))
+
+        def client_argmax(term):
+            pairs = [dict(assignment) for assignment in term.ret_value('SELECT',debug=False)]
+            return max(pairs,key=lambda pair:float(pair['x1']))['x0'] if pairs else None
+
+        for name,terms,evaluate in [('endpoint',ranked,lambda term:term.ret_value('SELECT',debug=False)[0][0][1]),('client',fetched,client_argmax)]:
+            del sizes[:]
+            start   = time.perf_counter()
+            answers = [[evaluate(term) for term in terms] for _ in range(R)][0]
+            elapsed = (time.perf_counter()-start)/(R*C)
+            correct = sum(1 for cls,answer in enumerate(answers) if answer == reference['Q%d'%(cls+1,)][1])
+            print('%-8s : %.1f ms/question, %7d bytes/answer, %d/%d correct'%(name,1e3*elapsed,sum(sizes)//len(sizes),correct,C))
+        server.close()
+        store.close()
+
+
+BENCHMARKS = {'memory':bench_memory,'traversal':bench_traversal,'closures':bench_closures,'sharing':bench_sharing,'types':bench_types,'startup':bench_startup,'parsing':bench_parsing,'sparql':bench_sparql,'beam_queries':bench_beam_queries,'triple_store':bench_triple_store,'degraded':bench_degraded,'cache':bench_cache,'planner':bench_planner,'templates':bench_templates,'streaming':bench_streaming,'answer_checks':bench_answer_checks,'batching':bench_batching,'superlatives':bench_superlatives}
+
+if __name__ == '__main__':
+
+    for name in (sys.argv[1:] if len(sys.argv) > 1 else BENCHMARKS):
+        print('== %s =='%(name,))
+        BENCHMARKS[name]()
@@ -1,6 +1,8 @@
 #! /usr/bin/python
 
-import copy
+import abc
+import operator
+from collections import OrderedDict
 
 class TypeSystem:
 
@@ -73,28 +75,9 @@ class TypeSystem:
     def typecheck(term):
         """
         Statically type checks a lambda term and returns its type
+        @see typecheck_term
         """
-        if isinstance(term,LambdaVariable):
-            return TypeSystem.add_brackets(term.ttype)
-        elif isinstance(term,ConstantFunction):
-            return TypeSystem.add_brackets(term.ttype)
-        elif isinstance(term,ExistentialQuantifier):
-            return TypeSystem.typecheck(term.body)
-        elif isinstance(term,LambdaAbstraction):
-            body_type     = TypeSystem.typecheck(term.body)
-            boundvar_type = term.boundvar_type
-            #print("abstract",boundvar_type,' abs ',body_type,'>>><<<',TypeSystem.concat_types(boundvar_type,body_type))
-            return TypeSystem.concat_types(boundvar_type,body_type)
-        elif isinstance(term,LambdaApplication):
-            func_type = TypeSystem.typecheck(term.termA)
-            arg_type  = TypeSystem.typecheck(term.termB)
-            ret_type = TypeSystem.deduce_application_type(func_type,arg_type)
-            return ret_type
-            if ret_type == TypeSystem.FAILURE:
-                raise TypeError(term.termA,term.termB,func_type,arg_type)
-        
-        print('oops (type checker broken)')
-        return TypeSystem.FAILURE
+        return typecheck_term(term)
     
     @staticmethod
     def requires_inference(ttype):
@@ -143,6 +126,97 @@ class TypeSystem:
         return tuple(ret_type)
 
         
+class TypeRegistry:
+    """
+    Interns types to small integer ids and caches the results of type deductions.
+    Types are looked up by value (nested tuples, or FAILURE) and the result of each
+    (functor type id, argument type id) application, including the cases requiring
+    type inference with ANY, is computed once by TypeSystem.deduce_application_type.
+    """
+    FAILURE_ID = 0
+
+    def __init__(self):
+        self.types       = [ ]   #id -> type
+        self.type_ids    = { }   #type -> id
+        self.apply_table = [ ]   #functor type id -> {argument type id -> result type id}
+        self.intern(TypeSystem.FAILURE)
+
+    def intern(self,ttype):
+        """
+        Returns the id of a type, allocating a new id if needed
+        @param ttype: a type (tuple) or FAILURE
+        @return an integer
+        """
+        type_id = self.type_ids.get(ttype)
+        if type_id is None:
+            type_id = len(self.types)
+            self.types.append(ttype)
+            self.type_ids[ttype] = type_id
+            self.apply_table.append({ })
+        return type_id
+
+    def type_of(self,type_id):
+        """
+        @param type_id: an integer
+        @return the type with this id
+        """
+        return self.types[type_id]
+
+    def apply(self,func_id,arg_id):
+        """
+        Performs a modus ponens inference for an application
+        @param func_id: the type id of a functor
+        @param arg_id: the type id of an argument
+        @return the id of the deduced type (FAILURE_ID in case of application failure)
+        @see TypeSystem.deduce_application_type
+        """
+        row    = self.apply_table[func_id]
+        ret_id = row.get(arg_id)
+        if ret_id is None:
+            ret_id = self.intern(TypeSystem.deduce_application_type(self.types[func_id],self.types[arg_id]))
+            row[arg_id] = ret_id
+        return ret_id
+
+#the registry shared by all the parsers
+TYPE_REGISTRY = TypeRegistry()
+
+
+class MacroTypeCache:
+    """
+    Caches the types of the logical forms of lexical macros (@see Token), the logical form of a macro is typechecked once.
+    There is one cache per LF dictionary or naming context, and it keeps at most max_size macros in LRU order.
+    When the cache is bound to a naming context, its entries are valid as long as the version of the context is unchanged,
+    otherwise an entry is valid as long as the macro is mapped to the same lambda term.
+    """
+    def __init__(self,naming_context=None,max_size=10000):
+        """
+        @param naming_context: the NamingContext the logical forms are built from, or None for an LF dictionary
+        @param max_size: max number of macros in the cache
+        """
+        self.naming_context = naming_context
+        self.max_size = max_size
+        self.types    = OrderedDict() #macro -> (version or lambda term,type), in LRU order
+
+    def typecheck(self,macro,logform):
+        """
+        Returns the type of the logical form of a macro, typechecking it only if the cache has no valid entry for it.
+        @param macro: a wikidata Qxxx or Pxxx identifier or a macro name
+        @param logform: the lambda term of the macro
+        @return a type
+        """
+        stamp = logform if self.naming_context is None else self.naming_context.version
+        entry = self.types.get(macro)
+        if entry is not None and (entry[0] is logform if self.naming_context is None else entry[0] == stamp):
+            self.types.move_to_end(macro)
+            return entry[1]
+        ttype = TypeSystem.typecheck(logform)
+        self.types[macro] = (stamp,ttype)
+        self.types.move_to_end(macro)
+        if len(self.types) > self.max_size:
+            self.types.popitem(last=False)
+        return ttype
+
+        
 class TypeError(Exception):
     
     def __init__(self,func_term,arg_term,func_type,arg_type):
@@ -160,6 +234,15 @@ class TypeInferenceError:
     def __str__(self):
         return msg + '(arg type = %s)'%(str(self.arg_type))
 
+class CompilationError(Exception):
+
+    def __init__(self,term,msg):
+        self.term = term
+        self.msg  = msg
+
+    def __str__(self):
+        return 'Compilation Error: %s'%(self.msg,)
+
 ##################################################################
 class NamingContext(object):
     """
@@ -171,6 +254,7 @@ class NamingContext(object):
 
         self.name_dic = {}
         self.debug = debug
+        self.version = 0 #incremented each time a name is (re)bound
         
     def get_names(self):
         """
@@ -192,6 +276,7 @@ class NamingContext(object):
         if self.debug:
             print('binding name %s'%(key))
         self.name_dic[key] = value
+        self.version += 1
 
     def __str__(self):
         return 'Bound names: %s'%(",".join(self.name_dic.keys()))
@@ -213,7 +298,11 @@ class NamingContext(object):
 
 class LambdaVariable:
 
+    __slots__ = ['varname','ttype','db_index']
+
     FREEVAR_IDX = 100000
+
+    has_lambda  = False #@see refresh_node
     
     def __init__(self,varname,ttype=TypeSystem.FAILURE,db_index=FREEVAR_IDX):
         """
@@ -224,6 +313,13 @@ class LambdaVariable:
         self.varname,self.ttype, self.db_index = varname,ttype,db_index
 
         
+    @property
+    def max_free_index(self):
+        """
+        @see refresh_node
+        """
+        return self.db_index
+
     def copy(self,db_update=0,depth=0):
         """
         Performs a deep copy of the term and returns it
@@ -231,11 +327,7 @@ class LambdaVariable:
         @param depth : the depth of the variable in this term
         @return a LambdaTerm
         """
-
-        if self.db_index-depth > 0 :#if var is free in this term
-            return LambdaVariable(self.varname,ttype=self.ttype, db_index=self.db_index+db_update)
-        #if var is bound in this term
-        return LambdaVariable(self.varname,ttype=self.ttype, db_index=self.db_index)
+        return copy_term(self,db_update,depth)
 
     
     def bind_var(self,varname,vartype,depth=0):
@@ -246,11 +338,7 @@ class LambdaVariable:
         @param vartype: the type of the variable to bind 
         @param depth below a quantifier, used for recursive calls
         """
-        if varname == self.varname and self.db_index == LambdaVariable.FREEVAR_IDX:
-            self.db_index = depth
-            if type(vartype) != tuple:
-                vartype = (vartype,)
-            self.ttype    = vartype
+        bind_var_term(self,varname,vartype,depth)
                                     
     def is_bound(self,varname,depth):
         """
@@ -269,7 +357,7 @@ class LambdaVariable:
         @param depth from the top quantifier
         @return true if this var is bound in the formula, false otherwise
         """
-        return self.db_index <= depth
+        return is_closed_term(self,depth)
                     
     def value(self):
         """
@@ -279,10 +367,12 @@ class LambdaVariable:
         return self
 
     def __str__(self):
-        return "%s-%d"%(self.varname,self.db_index)
+        return term_to_string(self)
 
 class LambdaAbstraction:
-    
+
+    __slots__ = ['boundvar_name','boundvar_type','body','max_free_index','has_lambda','cached_type']
+
     def __init__(self,boundvar_name,boundvar_type,body):
         """
         That creates the Lambda Abstraction term \boundvar_name:boundvar_type (func_body)
@@ -300,7 +390,7 @@ class LambdaAbstraction:
         @param db_update: a number with which to update db_indexes
         @return a LambdaTerm
         """
-        return LambdaAbstraction(self.boundvar_name,self.boundvar_type,self.body.copy(db_update,depth+1))
+        return copy_term(self,db_update,depth)
     
     def bind_var(self,varname,vartype,depth=0):
         """
@@ -310,7 +400,7 @@ class LambdaAbstraction:
         @param vartype: the type of the variable to bind 
         @param depth below a quantifier, used for recursive calls
         """
-        self.body.bind_var(varname,vartype,depth+1)
+        bind_var_term(self,varname,vartype,depth)
 
     def substitute(self,varname,replacement,depth=0):
         """
@@ -320,14 +410,7 @@ class LambdaAbstraction:
         @param replacement: the replacement term
         @param depth below a quantifier, used for recursive calls
         """
-        depth += 1
-        if isinstance(self.body,LambdaVariable):
-            if self.body.is_bound(varname,depth):
-                self.body = replacement.copy(db_update=depth-1)
-            elif self.body.db_index - depth > 0 : #if var is free...
-                self.body.db_index -= 1
-        else:
-            self.body.substitute(varname,replacement,depth)
+        substitute_term(self,varname,replacement,depth)
 
     def is_closed(self,depth):
         """
@@ -342,14 +425,15 @@ class LambdaAbstraction:
         This does in-place normalisation of the body of this abstraction.
         @return a lambda term
         """
-        self.body = self.body.value()
-        return self
+        return normalize_term(self)
 
     def __str__(self):
-        return '(lambda (%s:%s) %s)'%(self.boundvar_name,self.boundvar_type,str(self.body))
+        return term_to_string(self)
 
 class LambdaApplication:
-    
+
+    __slots__ = ['termA','termB','max_free_index','has_lambda','cached_type']
+
     def __init__(self,termA,termB):
         """
         That's the Lambda Application of the form (A B)
@@ -357,6 +441,7 @@ class LambdaApplication:
         @param termB: the right term
         """
         self.termA,self.termB = termA,termB
+        refresh_node(self)
                 
     def copy(self,db_update=0,depth=0):
         """
@@ -364,7 +449,7 @@ class LambdaApplication:
         @param db_update: a number with which to update db_indexes
         @return a LambdaTerm
         """
-        return LambdaApplication(self.termA.copy(db_update,depth),self.termB.copy(db_update,depth))
+        return copy_term(self,db_update,depth)
         
     def bind_var(self,varname,vartype,depth=0):
         """
@@ -374,8 +459,7 @@ class LambdaApplication:
         @param vartype: the type of the variable to bind 
         @param depth below a quantifier, used for recursive calls
         """
-        self.termA.bind_var(varname,vartype,depth)
-        self.termB.bind_var(varname,vartype,depth)
+        bind_var_term(self,varname,vartype,depth)
         
     def substitute(self,varname,replacement,depth=0):
         """
@@ -385,21 +469,7 @@ class LambdaApplication:
         @param replacement: the replacement term
         @param depth below a quantifier, used for recursive calls
         """
-        if isinstance(self.termA,LambdaVariable):
-            if self.termA.is_bound(varname,depth):
-                self.termA = replacement.copy(db_update=depth-1)
-            elif self.termA.db_index - depth > 0 : #var is free ?
-                self.termA.db_index -= 1
-        else:
-            self.termA.substitute(varname,replacement,depth)
-
-        if isinstance(self.termB,LambdaVariable):
-            if self.termB.is_bound(varname,depth):
-                self.termB = replacement.copy(db_update=depth-1)
-            elif self.termB.db_index - depth > 0 : #var is free ?:
-                self.termB.db_index -= 1
-        else:
-            self.termB.substitute(varname,replacement,depth)
+        substitute_term(self,varname,replacement,depth)
 
     def is_closed(self,depth):
         """
@@ -407,7 +477,7 @@ class LambdaApplication:
         @param depth from the top quantifier
         @return true if this var is bound in the formula, false otherwise
         """
-        return self.termA.is_closed(depth) and self.termB.is_closed(depth)
+        return is_closed_term(self,depth)
                 
     def value(self):
         """
@@ -415,34 +485,20 @@ class LambdaApplication:
         Inplace operation.
         @return a normalized lambda term (a value) if it exists
         """
-        self.termA = self.termA.value()
-        
-        #generic (normal) case
-        if isinstance(self.termA,LambdaAbstraction):
-            self.termB = self.termB.value()
-            self.termA.substitute(self.termA.boundvar_name,self.termB)
-            return self.termA.body.value()
-        
-        #external func case
-        elif isinstance(self.termA,ConstantFunction):
-            self.termB = self.termB.value()
-            self.termA.substitute(replacement=self.termB)
-            return self.termA.value()
-        
-        #otherwise (failed application)...
-        self.termB = self.termB.value()   
-        return self
+        return normalize_term(self)
     
     def sparql_value(self,answer_vars,varbindings):
         return self.termA.sparql_value(answer_vars,varbindings)
     
     def __str__(self):
-        return "(%s %s)"%(str(self.termA),str(self.termB))
+        return term_to_string(self)
 
 
 #EXTENSIONS
 class ExistentialQuantifier(object):
-    
+
+    __slots__ = ['boundvar_name','boundvar_type','body','max_free_index','has_lambda','cached_type']
+
     def __init__(self,boundvar_name,boundvar_type,body):
         """
         That creates an Existential quantifier term (exists (boundvar_name:boundvar_type) (func_body) )
@@ -459,9 +515,9 @@ class ExistentialQuantifier(object):
         """
         Performs a deep copy of the term and returns it
         @param db_update: a number with which to update db_indexes
-        @return a ExistentialQuantifier instance
+        @return an instance of the same class as this quantifier
         """
-        return ExistentialQuantifier(self.boundvar_name,self.boundvar_type,self.body.copy(db_update,depth+1))
+        return copy_term(self,db_update,depth)
 
     def bind_var(self,varname,vartype,depth=0):
         """
@@ -471,7 +527,7 @@ class ExistentialQuantifier(object):
         @param vartype: the type of the variable to bind 
         @param depth below a quantifier, used for recursive calls
         """
-        self.body.bind_var(varname,vartype,depth+1)
+        bind_var_term(self,varname,vartype,depth)
 
     def substitute(self,varname,replacement,depth=0):
         """
@@ -481,14 +537,7 @@ class ExistentialQuantifier(object):
         @param replacement: the replacement term
         @param depth below a quantifier, used for recursive calls
         """
-        depth += 1
-        if isinstance(self.body,LambdaVariable):
-            if self.body.is_bound(varname,depth):
-                self.body = replacement.copy(db_update=depth-1)
-            elif self.body.db_index - depth > 0 : #if var is free...
-                self.body.db_index -= 1
-        else:
-            self.body.substitute(varname,replacement,depth)
+        substitute_term(self,varname,replacement,depth)
 
     def ret_value(self):
         """
@@ -506,8 +555,7 @@ class ExistentialQuantifier(object):
         This does in-place normalisation of the body of this quantifier.
         @return a lambda term
         """
-        self.body = self.body.value()
-        return self
+        return normalize_term(self)
 
     def is_closed(self,depth=0):
         """
@@ -515,16 +563,16 @@ class ExistentialQuantifier(object):
         Returns True if the expression contains variables bound only by quantifiers (no free variables and no vars bound by lambda terms
         """
         #tests if all vars occurrences dbindexes in subformulas are smaller then their depth 
-        return self.body.is_closed(depth=depth+1)
+        return is_closed_term(self,depth)
+
+    def is_evaluable(self):
+        """
+        Returns true when this quantifier can return a proper truth value (@see ret_value)
+        """
+        return self.is_closed()
         
     def __str__(self):
-        
-        if self.is_closed():
-            print('quantifier closed')
-            return str(self.ret_value())
-        else:
-            print('quantifier not closed')
-            return '(exists (%s:%s) %s)'%(self.boundvar_name,self.boundvar_type,str(self.body))
+        return term_to_string(self)
 
 
 class ConstantFunction(object):
@@ -541,6 +589,9 @@ class ConstantFunction(object):
     To instanciate a constant, use the make_constant wrapper.
     To instanciate a function, use the make function wrapper.
     """
+
+    __slots__ = ['fun_name','ttype','val','nargs','args_values','max_free_index','has_lambda']
+
     def __init__(self,name=None,const_value=None,argtypes=[],ret_type=TypeSystem.FAILURE):
         """
         The constructor takes the signature of the function as parameters
@@ -555,6 +606,7 @@ class ConstantFunction(object):
 
         self.nargs = len(argtypes)
         self.args_values = [LambdaVariable("__x__",ttype=argtypes[idx],db_index=self.nargs-idx) for idx in range(self.nargs)]
+        refresh_node(self)
             
     @staticmethod
     def make_constant(const_value,const_type):
@@ -580,11 +632,21 @@ class ConstantFunction(object):
         """
         This copy method can be inherited by subclasses
         """
-        cpy = copy.deepcopy(self) #allows inheritance by subclasses ; shallow copy instead ?
-        for idx in range(len(cpy.args_values)):
-            term = cpy.args_values[idx]
-            cpy.args_values[idx] = term.copy(db_update,depth+self.nargs)
-        return cpy
+        return copy_term(self,db_update,depth)
+
+    def set_args(self,args):
+        """
+        Binds in place all the parameters of the function (a complete application without substitution)
+        and refreshes the cached free variable information (@see refresh_node).
+        Use this method rather than assigning args_values and nargs.
+        @param args: the list of the argument terms, under the same binders as the function
+        @return this function
+        """
+        assert(len(args) == len(self.args_values))
+        self.args_values = list(args)
+        self.nargs = 0
+        refresh_node(self)
+        return self
         
     def bind_var(self,varname,vartype,depth=0):
         """
@@ -604,7 +666,7 @@ class ConstantFunction(object):
         @param : a dict of bound varnames with their depth
         Returns True if the expression contains variables bound only by quantifiers (no free variables and no vars bound by lambda terms)
         """
-        return self.nargs == 0 and all([v.is_closed(depth) for v in self.args_values])
+        return is_closed_term(self,depth)
         
     def substitute(self,varname=None,replacement=None,depth=0):
         """
@@ -617,32 +679,7 @@ class ConstantFunction(object):
         #testA : (lambda (x:num y:num) (+ (+ x 3) (+ y 3)))
         #testB : (lambda (P:e=>t Q:e=>t) (exists (x:e) (and (P x) (Q x))))
         #testC : ((lambda (P:e=>t) (exists (x:e) (P x))) Q42)
-        
-        if depth < self.nargs:     # we are attempting a local substitution (we remove a local lambda binder)
-            if varname == None:                
-                varname = '__x__'
-            depth += self.nargs
-            for idx in range(len(self.args_values)):
-                term = self.args_values[idx]
-                if isinstance(term,LambdaVariable):
-                    if term.is_bound(varname,depth):
-                        self.args_values[idx] = replacement.copy(db_update=depth-1)
-                        self.nargs -= 1
-                    elif term.db_index - depth > 0:        #var is free
-                        term.db_index -= 1
-                else:
-                    term.substitute(varname,replacement,depth)  #todo : check this one                            
-        else:                          # we are performing a non-local substitution (we remove an outer lambda binder)
-            depth += self.nargs
-            for idx in range(len(self.args_values)):
-                term = self.args_values[idx]
-                if isinstance(term,LambdaVariable):
-                    if term.is_bound(varname,depth):
-                        self.args_values[idx] = replacement.copy(db_update=depth-1)
-                    elif term.db_index - depth > 0:   #var is free
-                        term.db_index -= 1
-                else:
-                    term.substitute(varname,replacement,depth)  #todo : check this one  
+        substitute_term(self,varname,replacement,depth)
 
                             
     def ret_value(self):
@@ -654,177 +691,146 @@ class ConstantFunction(object):
         """
         return self.val
 
+    def compile_closure(self,arg_closures):
+        """
+        Compiles this function into a python closure (@see compile_term).
+        Subclasses overloading ret_value should overload this method as well.
+        @param arg_closures: a list of closures computing the values of the arguments from an environment
+        @return a closure computing the value of this function from an environment
+        """
+        if arg_closures:
+            raise CompilationError(self,'function %s cannot be compiled'%(self.fun_name,))
+        val = self.ret_value()
+        return lambda env: val
+
     def value(self):
         """
         This does a call by value beta reduction.
         @return a ConstantFunction object
         """
-        for idx in range(len(self.args_values)):
-            self.args_values[idx] = self.args_values[idx].value()
-        return self
+        return normalize_term(self)
 
     def is_constant(self):
         """
         if true means that we can get the denotation (= call ret_value)
         """
         return all([isinstance(val,ConstantFunction) and val.is_constant() for val in self.args_values])
+
+    def is_evaluable(self):
+        """
+        Returns true when ret_value can be called on this function.
+        Subclasses whose denotation is computed differently should overload this method.
+        """
+        return self.is_constant()
      
     def __str__(self):
-        if self.is_constant():
-            return str(self.ret_value()) 
-        else:
-            def pprint_arg(term):
-                if isinstance(term,ConstantFunction) and term.is_constant():
-                    return str(term.ret_value())
-                elif isinstance(term,LambdaVariable):
-                    return str(term)
-                else:
-                    return str(term)#'?'
-                
-            return '%s(%s)'%(self.fun_name,','.join([pprint_arg(val) for val in self.args_values]))
+        return term_to_string(self)
 
 
-class SuperlativeCombinator(object):
+class SuperlativeCombinator(ConstantFunction,metaclass=abc.ABCMeta):
     """
-    This class codes an argmax/argmin style combinator that simulates
+    This abstract class codes an argmax/argmin combinator (argmax Q P x) that simulates
     the behaviour of a term of the form :
-    (lambda (Q:e=>t P:e=>num=>t)  (exists (x:e) (Q x) and exists (v:num v':num) (P x v) and  (forall (y:e) (P y v') -> (v > v')))
-    This roughly compares to the behaviour of the constant function except that it takes higher order arguments
-    Q is a unary predicate of type e=>t
-    P is binary predicate whose y value is numeric or a date
-    (num|date)
-    @TODO... 
+    (lambda (Q:e=>t P:e=>num=>t x:e) (Q x) and exists (v:num) (P x v) and (forall (y:e v':num) (Q y) and (P y v') -> (v >= v')))
+    Q is a unary predicate of type e=>t (the candidates)
+    P is a binary predicate whose second argument is the ranked value, of an ordered type (a number or a date)
+    The python evaluator cannot compute it (it quantifies over the whole model): it is never evaluable
+    and a model subclasses it to compile it to its database queries (@see sparql_value).
     """
-    def __init__(self):
-        self.ttype        = ((TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN),(TypeSystem.DB_ENTITY,TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN),TypeSystem.BOOLEAN)
-        self.nargs        = 2
-        # Q variable
-        self.entity_var   = LambdaVariable("__Q__",ttype=(TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN),db_index=2)
-        # P variable ANY TOO LAZY : accepts comparisons of strings too ! but works...
-        self.quantity_var = LambdaVariable("__P__",ttype=((TypeSystem.DB_ENTITY,TypeSystem.ANY),TypeSystem.BOOLEAN),db_index=1)
-        self.xarg_var     = LambdaVariable("__x__",ttype=(TypeSystem.DB_ENTITY),db_index=2)
-        self.varg_var     = LambdaVariable("__v__",ttype=(TypeSystem.ANY),db_index=2)
-        
-    def copy(self,db_update=0,depth=0):
-        """
-        This copy method can be inherited by subclasses
-        """
-        #TODO !
-        cpy = copy.deepcopy(self) #allows inheritance by subclasses ; shallow copy instead ?
-        for idx in range(len(cpy.args_values)):
-            term = cpy.args_values[idx]
-            cpy.args_values[idx] = term.copy(db_update,depth+self.nargs)
-        return cpy
+    __slots__ = ['descending','value_type']
 
-    
-    def bind_var(self,varname,vartype,depth=0):
-        """
-        This captures variables inside the body and indexes them with
-        DeBruijn indexes. Used only at init.
-        @param varname: the name of the variable to bind
-        @param vartype: the type of the variable to bind 
-        @param depth below a quantifier, used for recursive calls
-        """
-        pass
-        #This case never happens (here for interface)
+    QUANTITY_VAR = '__v__'
+    VALUE_TYPES  = (TypeSystem.NUMERIC,TypeSystem.DATE)
 
-    def ret_value(self):
+    def __init__(self,name='argmax',descending=True,value_type=TypeSystem.NUMERIC):
         """
-        This method computes a value (denotation) externally and returns it
-        This is the interface towards the outer world.
-        The only method that needs to be subclassed
-        @return a value with python type matching the ret_type of the function      
+        @param name: the name of the function (e.g. argmax, argmin)
+        @param descending: true for argmax (highest value first), false for argmin
+        @param value_type: the type of the ranked values (num or date)
         """
-        #valuation check : arg0 must be an externally bound variable and one must find a property constant in arg1
-        return self.val
+        assert(value_type in SuperlativeCombinator.VALUE_TYPES)
+        restriction_type = (TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN)
+        quantity_type    = (TypeSystem.DB_ENTITY,value_type,TypeSystem.BOOLEAN)
+        super().__init__(name=name,argtypes=(restriction_type,quantity_type,TypeSystem.DB_ENTITY),ret_type=TypeSystem.BOOLEAN)
+        self.descending = descending
+        self.value_type = value_type
 
-    def value(self):
+    def restriction(self):
         """
-        This does a call by value beta reduction.
-        @return a Superlative Function object
+        Builds the term testing the candidates, once all the args are bound
+        @return the normalized term (Q x)
         """
-        for idx in range(len(self.args_values)):
-            self.args_values[idx] = self.args_values[idx].value()
-        return self
+        Q,P,x = self.args_values
+        return normalize_term(LambdaApplication(Q.copy(),x.copy()))
 
-    def is_evaluable(self):
+    def quantity(self):
         """
-        Returns true when this quantifier can return a proper truth
-        value. Here we allow evaluation as soon as all the pseudo-binders are gone.
+        Builds the term binding the ranked value, once all the args are bound.
+        The value variable (named QUANTITY_VAR) is bound by an implicit binder above the term:
+        its De Bruijn index is 1 and the indexes of the other variables are shifted accordingly.
+        @return the normalized term (P x v)
         """
-        return self.nargs == 0
-    
+        Q,P,x = self.args_values
+        v = LambdaVariable(SuperlativeCombinator.QUANTITY_VAR,ttype=self.value_type,db_index=1)
+        return normalize_term(LambdaApplication(LambdaApplication(P.copy(1),x.copy(1)),v))
+
+    @abc.abstractmethod
     def sparql_value(self,answer_vars,var_bindings):
         """
-        This generates a SPARQL query for the predicate
+        Compiles the superlative to a part of a query, the ranking being done by the database
         @param answer_vars : variables whose bindings are answers to the question 
-        @param var_bindings: a dict sparql_varname: depth
+        @param var_bindings: the database variables bound by the enclosing quantifiers
         @return: a string part of the query
+        """
 
-        USE SPARQL subqueries
-        @see https://www.w3.org/TR/2013/REC-sparql11-query-20130321/#subqueries
-
-        Example ARGMAX for Mt Everest : 
-        (lambda (Q:e=>t P:e=>num=>t)  (exists (x:e) (Q x) and exists (v:num v':num) (P x v) and (forall (y:e) (P y v' ) -> (v > v') ))
-
-        The translation will not use p and q :
-        SELECT ?x WHERE{           # GENERIC QUERY
-          {                        # ARGMAX SUBQUERY
-             SELECT ?x WHERE {
-                ?x wdt:P31 wd:Q8502 .   # Restr    : Mountain(x)   #translation of arg (Q x) of the lambda term.
-                ?x wdt:P2660 ?v .       # Altitude : Altitude(x,v) #translation of arg (P x v) of the lambda term.
-          }ORDER BY DESC(?v)
-           LIMIT 1                      #Can generalize to K-Argmax and to offsets here.
-         } #END SUBQUERY
-          
-        }
-        Conclusion: the class emulates the process by:
-        introducing Q P lambda vars as args, an x var that gets bound by Q and P and a dummy ?y var that gets bound by P.
+    def is_evaluable(self):
         """
-        pass
-    
-        return """
-        OPTIONAL {
-             %s %s %s  #predicate stuff
-             FILTER ( < ) .
-        } .
-        FILTER ( ! %s ) .
-        """%(...)
-        
-    def __str__(self):
-        if self.is_evaluable():
-            return str(self.ret_value())
-        else:
-            return '%s(%s)'%('argmax',','.join([str(val) for val in self.args_values]))
+        The superlative is compiled to database queries, never evaluated by python
+        """
+        return False
+
 
-        
 #Arithmetic functions
 class ExtAddition(ConstantFunction):
     """
     Implements arithmetic addition
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="+",argtypes=(TypeSystem.NUMERIC,TypeSystem.NUMERIC),ret_type=TypeSystem.NUMERIC)
 
     def ret_value(self):
         res = float(self.args_values[0].ret_value()) + float(self.args_values[1].ret_value())
         return res
+
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: float(lhs(env)) + float(rhs(env))
         
 class ExtSubstraction(ConstantFunction):
     """
     Implements arithmetic substraction
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="-",argtypes=(TypeSystem.NUMERIC,TypeSystem.NUMERIC),ret_type=TypeSystem.NUMERIC)
         
     def ret_value(self):
         res = float(self.args_values[0].ret_value()) - float(self.args_values[1].ret_value()) 
         return res
+
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: float(lhs(env)) - float(rhs(env))
         
 class ExtMultiplication(ConstantFunction):
     """
     Implements arithmetic multiplication
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="*",argtypes=(TypeSystem.NUMERIC,TypeSystem.NUMERIC),ret_type=TypeSystem.NUMERIC)
 
@@ -832,10 +838,16 @@ class ExtMultiplication(ConstantFunction):
         res = float(self.args_values[0].ret_value()) * float(self.args_values[1].ret_value()) 
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: float(lhs(env)) * float(rhs(env))
+
 class ExtDivision(ConstantFunction):
     """
     Implements arithmetic division
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="/",argtypes=(TypeSystem.NUMERIC,TypeSystem.NUMERIC),ret_type=TypeSystem.NUMERIC)
         
@@ -843,11 +855,17 @@ class ExtDivision(ConstantFunction):
         res = float(self.args_values[0].ret_value()) / float(self.args_values[1].ret_value()) 
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: float(lhs(env)) / float(rhs(env))
+
 #Boolean functions
 class ExtAnd(ConstantFunction):
     """
     Implements logical and
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="and",argtypes=(TypeSystem.BOOLEAN,TypeSystem.BOOLEAN),ret_type=TypeSystem.BOOLEAN)
 
@@ -855,10 +873,16 @@ class ExtAnd(ConstantFunction):
         res = self.args_values[0].ret_value() and self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) and rhs(env)
+
 class ExtOr(ConstantFunction):
     """
     Implements logical or
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="or",argtypes=(TypeSystem.BOOLEAN,TypeSystem.BOOLEAN),ret_type=TypeSystem.BOOLEAN)
 
@@ -866,15 +890,25 @@ class ExtOr(ConstantFunction):
         res = self.args_values[0].ret_value() or self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) or rhs(env)
+
 class ExtNot(ConstantFunction):
     """
     Implements logical not
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="not",argtypes=(TypeSystem.BOOLEAN,),ret_type=TypeSystem.BOOLEAN)
 
     def ret_value(self):
         return not self.args_values[0].ret_value()
+
+    def compile_closure(self,arg_closures):
+        arg, = arg_closures
+        return lambda env: not arg(env)
     
 #comparisons
 #we use the ANY type. For most of the atomic types these comparisons make sense.
@@ -882,18 +916,25 @@ class ExtEqual(ConstantFunction):
     """
     Implements == 
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="==",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
     def ret_value(self):
-        print(type(self.args_values[0].ret_value()),type(self.args_values[1].ret_value()))
         res = self.args_values[0].ret_value() == self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) == rhs(env)
+
 class ExtNotEqual(ConstantFunction):
     """
     Implements != 
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="!=",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
@@ -901,10 +942,16 @@ class ExtNotEqual(ConstantFunction):
         res = self.args_values[0].ret_value() != self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) != rhs(env)
+
 class ExtLess(ConstantFunction):
     """
     Implements < 
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="<",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
@@ -912,10 +959,16 @@ class ExtLess(ConstantFunction):
         res = self.args_values[0].ret_value() < self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) < rhs(env)
+
 class ExtLessEq(ConstantFunction):
     """
     Implements <= 
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="<=",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
@@ -923,10 +976,16 @@ class ExtLessEq(ConstantFunction):
         res = self.args_values[0].ret_value() <= self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) <= rhs(env)
+
 class ExtGreater(ConstantFunction):
     """
     Implements > 
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name=">",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
@@ -934,27 +993,785 @@ class ExtGreater(ConstantFunction):
         res = self.args_values[0].ret_value() > self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) > rhs(env)
+
     
 class ExtGreaterEq(ConstantFunction):
     """
     Implements >=
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name=">=",argtypes=(TypeSystem.ANY,TypeSystem.ANY),ret_type=TypeSystem.BOOLEAN)
 
     def ret_value(self):
         res = self.args_values[0].ret_value() >= self.args_values[1].ret_value()
         return res
+
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) >= rhs(env)
     
 #String functions
 class ExtCarS(ConstantFunction):
-    pass
+    __slots__ = ()
 
 class ExtConsS(ConstantFunction):
-    pass
+    __slots__ = ()
 
 class ExtCdrS(ConstantFunction):
+    __slots__ = ()
+
+
+##################################################################
+#TRAVERSAL ENGINE
+#Explicit stack implementations of the operations on lambda terms.
+#The term methods (copy, bind_var, substitute, value, is_closed) and TypeSystem.typecheck
+#delegate to these functions: deep terms (e.g. long coordinations) do not hit the python
+#recursion limit and no python call is paid per visited node.
+#Every function modifying or building a term refreshes the cached free variable information
+#(max_free_index, has_lambda) of the nodes it touches, bottom up (@see refresh_node).
+
+_VAR,_ABS,_QUANT,_APP,_CONST,_OTHER = range(6)
+_NODE_KINDS = {}
+
+def _node_kind(node):
+    """
+    Returns the kind of a term node (dispatch is cached by class)
+    """
+    cls  = type(node)
+    kind = _NODE_KINDS.get(cls)
+    if kind is None:
+        if issubclass(cls,LambdaVariable):
+            kind = _VAR
+        elif issubclass(cls,LambdaAbstraction):
+            kind = _ABS
+        elif issubclass(cls,ExistentialQuantifier):
+            kind = _QUANT
+        elif issubclass(cls,LambdaApplication):
+            kind = _APP
+        elif issubclass(cls,ConstantFunction):
+            kind = _CONST
+        else:
+            kind = _OTHER
+        _NODE_KINDS[cls] = kind
+    return kind
+
+_CLASS_SLOTS = {}
+
+def _node_slots(cls):
+    """
+    Returns the list of all the slots of a term class (including inherited slots)
+    """
+    slots = _CLASS_SLOTS.get(cls)
+    if slots is None:
+        slots = []
+        for klass in cls.__mro__:
+            klass_slots = klass.__dict__.get('__slots__',())
+            slots.extend([klass_slots] if isinstance(klass_slots,str) else klass_slots)
+        _CLASS_SLOTS[cls] = slots
+    return slots
+
+def _shallow_copy(node):
+    """
+    Allocates a new node of the same class as node and sharing all its fields.
+    Subclasses fields (e.g. answer_marked) are preserved without calling the constructor.
+    """
+    cls = type(node)
+    cpy = cls.__new__(cls)
+    for field in _node_slots(cls):
+        setattr(cpy,field,getattr(node,field))
+    if hasattr(node,'__dict__'):
+        cpy.__dict__.update(node.__dict__)
+    return cpy
+
+
+def refresh_node(node):
+    """
+    Recomputes the cached free variable information of a node from the information of its children:
+      - max_free_index is the largest De Bruijn index of a variable free in the node, relative to the node (0 if there is none)
+      - has_lambda is true if the node contains a lambda abstraction or a partially applied function
+    and invalidates the type cached on the node (@see typecheck_term).
+    Must be called after modifying a node in place.
+    @param node: a lambda term
+    """
+    kind = _node_kind(node)
+    if kind == _APP:
+        termA,termB = node.termA,node.termB
+        node.max_free_index = max(termA.max_free_index,termB.max_free_index)
+        node.has_lambda     = termA.has_lambda or termB.has_lambda
+        node.cached_type    = None
+    elif kind == _CONST:
+        nargs      = node.nargs
+        max_free   = 0
+        has_lambda = nargs != 0
+        for arg in node.args_values:
+            if arg.max_free_index > max_free:
+                max_free = arg.max_free_index
+            has_lambda = has_lambda or arg.has_lambda
+        node.max_free_index = max_free - nargs if max_free > nargs else 0
+        node.has_lambda     = has_lambda
+    elif kind == _ABS or kind == _QUANT:
+        body = node.body
+        node.max_free_index = body.max_free_index - 1 if body.max_free_index > 1 else 0
+        node.has_lambda     = kind == _ABS or body.has_lambda
+        node.cached_type    = None
+
+
+def check_cached_info(term):
+    """
+    Tests that the cached free variable information of the nodes of a term is up to date,
+    a debugging helper for the code modifying terms in place (@see refresh_node).
+    @param term: a lambda term
+    @return True if the information cached on every node is the one computed from its children
+    """
+    stack = [ (term,copy_term(term)) ] #a copy recomputes the information of all its nodes
+    while stack:
+        node,fresh = stack.pop()
+        kind = _node_kind(node)
+        if kind == _VAR or kind == _OTHER:
+            continue
+        if node.max_free_index != fresh.max_free_index or node.has_lambda != fresh.has_lambda:
+            return False
+        if kind == _APP:
+            stack.extend([(node.termA,fresh.termA),(node.termB,fresh.termB)])
+        elif kind == _CONST:
+            stack.extend(zip(node.args_values,fresh.args_values))
+        else:
+            stack.append((node.body,fresh.body))
+    return True
+
+
+def copy_term(term,db_update=0,depth=0):
+    """
+    Performs a deep copy of a term and returns it
+    @param term: the term to copy
+    @param db_update: a number with which to update db_indexes of the variables free in this term
+    @param depth: the depth of the term
+    @return a lambda term
+    """
+    results = [ ]
+    stack   = [ (term,depth,False) ]
+    while stack:
+        node,depth,built = stack.pop()
+        kind = _node_kind(node)
+        if kind == _VAR:
+            db_index = node.db_index + db_update if node.db_index - depth > 0 else node.db_index
+            results.append(LambdaVariable(node.varname,ttype=node.ttype,db_index=db_index))
+        elif kind == _OTHER:
+            results.append(node.copy(db_update,depth))
+        elif not built:
+            stack.append((node,depth,True))
+            if kind == _APP:
+                stack.append((node.termB,depth,False))
+                stack.append((node.termA,depth,False))
+            elif kind == _CONST:
+                stack.extend([(arg,depth+node.nargs,False) for arg in reversed(node.args_values)])
+            else:
+                stack.append((node.body,depth+1,False))
+        else:
+            cpy = _shallow_copy(node)
+            if kind == _APP:
+                cpy.termB = results.pop()
+                cpy.termA = results.pop()
+            elif kind == _CONST:
+                nargs = len(node.args_values)
+                cpy.args_values = results[len(results)-nargs:]
+                del results[len(results)-nargs:]
+            else:
+                cpy.body = results.pop()
+            refresh_node(cpy)
+            if kind != _CONST: #a copy has the type of the original
+                cpy.cached_type = node.cached_type
+            results.append(cpy)
+    return results[0]
+
+
+def bind_var_term(term,varname,vartype,depth=0):
+    """
+    This captures the free occurrences of varname inside the term and indexes them with
+    DeBruijn indexes. Used only at init.
+    @param term: the term where to bind the variable
+    @param varname: the name of the variable to bind
+    @param vartype: the type of the variable to bind 
+    @param depth: depth of the term below the binder
+    """
+    if type(vartype) != tuple:
+        vartype = (vartype,)
+    stack = [ (term,depth) ]
+    while stack:
+        node,depth = stack.pop()
+        if depth is None: #the children of node are bound
+            refresh_node(node)
+            continue
+        kind = _node_kind(node)
+        if kind == _VAR:
+            if varname == node.varname and node.db_index == LambdaVariable.FREEVAR_IDX:
+                node.db_index = depth
+                node.ttype    = vartype
+        elif kind == _APP:
+            stack.append((node,None))
+            stack.append((node.termA,depth))
+            stack.append((node.termB,depth))
+        elif kind == _ABS or kind == _QUANT:
+            stack.append((node,None))
+            stack.append((node.body,depth+1))
+        elif kind == _OTHER:
+            node.bind_var(varname,vartype,depth)
+        #There is no way an external binder can bind a variable inside a constant function at init.
+
+
+def substitute_term(term,varname,replacement,depth=0):
+    """
+    This performs in place the substitution of a varname by a replacement term.
+    Uses DeBruijn indexing.
+    @param term: a lambda abstraction, a quantifier, an application or a constant function
+    @param varname: the variable name (None for the next argument of a constant function)
+    @param replacement: the replacement term
+    @param depth: depth of the term below the binder
+    """
+    stack = [ (term,varname,depth) ]
+    while stack:
+        node,varname,depth = stack.pop()
+        if depth is None: #the children of node are substituted
+            refresh_node(node)
+            continue
+        kind = _node_kind(node)
+        if kind != _OTHER:
+            stack.append((node,None,None))
+        if kind == _ABS or kind == _QUANT:
+            depth += 1
+            child = node.body
+            if isinstance(child,LambdaVariable):
+                if child.is_bound(varname,depth):
+                    node.body = copy_term(replacement,db_update=depth-1)
+                elif child.db_index - depth > 0 : #if var is free...
+                    child.db_index -= 1
+            else:
+                stack.append((child,varname,depth))
+        elif kind == _APP:
+            child = node.termA
+            if isinstance(child,LambdaVariable):
+                if child.is_bound(varname,depth):
+                    node.termA = copy_term(replacement,db_update=depth-1)
+                elif child.db_index - depth > 0 : #var is free ?
+                    child.db_index -= 1
+            else:
+                stack.append((child,varname,depth))
+            child = node.termB
+            if isinstance(child,LambdaVariable):
+                if child.is_bound(varname,depth):
+                    node.termB = copy_term(replacement,db_update=depth-1)
+                elif child.db_index - depth > 0 : #var is free ?
+                    child.db_index -= 1
+            else:
+                stack.append((child,varname,depth))
+        elif kind == _CONST:
+            #local substitution removes a local lambda binder, non local substitution removes an outer lambda binder
+            local = depth < node.nargs
+            if local and varname == None:
+                varname = '__x__'
+            depth += node.nargs
+            args   = node.args_values
+            for idx in range(len(args)):
+                child = args[idx]
+                if isinstance(child,LambdaVariable):
+                    if child.is_bound(varname,depth):
+                        args[idx] = copy_term(replacement,db_update=depth-1)
+                        if local:
+                            node.nargs -= 1
+                    elif child.db_index - depth > 0:  #var is free
+                        child.db_index -= 1
+                else:
+                    stack.append((child,varname,depth))
+        else:
+            node.substitute(varname,replacement,depth)
+
+
+def is_closed_term(term,depth=0):
+    """
+    Tests if a formula is closed by existential quantifiers only.
+    Constant time: uses the cached free variable information of the term.
+    @param term: a lambda term
+    @param depth from the top quantifier
+    @return True if the expression contains variables bound only by quantifiers (no free variables and no vars bound by lambda terms)
+    """
+    kind = _node_kind(term)
+    if kind == _VAR:
+        return term.db_index <= depth
+    elif kind == _OTHER:
+        return term.is_closed(depth)
+    return not term.has_lambda and term.max_free_index <= depth
+
+
+_CHILD_FIELDS = set(['body','termA','termB','args_values'])
+
+def equal_terms(termA,termB):
+    """
+    Tests if two terms are structurally equal (same classes, names, types, values and De Bruijn indexes)
+    @param termA: a lambda term
+    @param termB: a lambda term
+    @return a boolean
+    """
+    stack = [ (termA,termB) ]
+    while stack:
+        nodeA,nodeB = stack.pop()
+        cls = type(nodeA)
+        if cls != type(nodeB):
+            return False
+        if _node_kind(nodeA) == _OTHER:
+            if nodeA is not nodeB:
+                return False
+            continue
+        for field in _node_slots(cls):
+            valA,valB = getattr(nodeA,field),getattr(nodeB,field)
+            if field not in _CHILD_FIELDS:
+                if valA != valB:
+                    return False
+            elif field == 'args_values':
+                if len(valA) != len(valB):
+                    return False
+                stack.extend(zip(valA,valB))
+            else:
+                stack.append((valA,valB))
+    return True
+
+
+#continuation tags used by the evaluator
+_BODY,_ARG,_FUNCTOR,_OPERAND = range(4)
+
+def normalize_term(term):
+    """
+    This does a call by value beta reduction of the term.
+    Inplace operation.
+    @param term: a lambda term
+    @return a normalized lambda term (a value) if it exists
+    """
+    frames = [ ]
+    node   = term
+    while True:
+        #evaluates node
+        kind = _node_kind(node)
+        if kind == _ABS or kind == _QUANT:
+            frames.append((_BODY,node))
+            node = node.body
+            continue
+        elif kind == _APP:
+            frames.append((_FUNCTOR,node))
+            node = node.termA
+            continue
+        elif kind == _CONST and node.args_values:
+            frames.append((_ARG,node,0))
+            node = node.args_values[0]
+            continue
+        elif kind == _OTHER:
+            result = node.value()
+        else:
+            result = node
+        #returns result to the pending continuations
+        while frames:
+            frame = frames.pop()
+            tag,parent = frame[0],frame[1]
+            if tag == _BODY:
+                parent.body = result
+                refresh_node(parent)
+                result      = parent
+            elif tag == _ARG:
+                idx = frame[2]
+                parent.args_values[idx] = result
+                idx += 1
+                if idx < len(parent.args_values):
+                    frames.append((_ARG,parent,idx))
+                    node = parent.args_values[idx]
+                    break
+                refresh_node(parent)
+                result = parent
+            elif tag == _FUNCTOR:
+                parent.termA = result
+                frames.append((_OPERAND,parent))
+                node = parent.termB
+                break
+            else:
+                parent.termB = result
+                functor = parent.termA
+                #generic (normal) case
+                if isinstance(functor,LambdaAbstraction):
+                    functor.substitute(functor.boundvar_name,result)
+                    node = functor.body
+                    break
+                #external func case
+                elif isinstance(functor,ConstantFunction):
+                    functor.substitute(replacement=result)
+                    node = functor
+                    break
+                #otherwise (failed application)...
+                refresh_node(parent)
+                result = parent
+        else:
+            return result
+
+
+def typecheck_term(term):
+    """
+    Statically type checks a lambda term and returns its type.
+    The types of the abstractions, quantifiers and applications are cached on the nodes
+    (until the node is modified, @see refresh_node): typing again a term or one of its subterms is immediate.
+    @param term: a lambda term
+    @return a type
+    """
+    results = [ ]
+    stack   = [ term ]
+    while stack:
+        node = stack.pop()
+        if type(node) == tuple: #the children types of node are computed
+            node = node[0]
+            kind = _node_kind(node)
+            if kind == _ABS:
+                ttype = TypeSystem.concat_types(node.boundvar_type,results.pop())
+            elif kind == _QUANT:
+                ttype = results.pop()
+            else:
+                arg_type = results.pop()
+                ttype    = TypeSystem.deduce_application_type(results.pop(),arg_type)
+            node.cached_type = ttype
+            results.append(ttype)
+            continue
+        kind = _node_kind(node)
+        if kind == _VAR or kind == _CONST:
+            results.append(TypeSystem.add_brackets(node.ttype))
+        elif kind == _OTHER:
+            print('oops (type checker broken)')
+            results.append(TypeSystem.FAILURE)
+        elif node.cached_type is not None:
+            results.append(node.cached_type)
+        elif kind == _APP:
+            stack.append((node,))
+            stack.append(node.termB)
+            stack.append(node.termA)
+        else:
+            stack.append((node,))
+            stack.append(node.body)
+    return results[0]
+
+
+##################################################################
+#PRINTING
+#Printing a term never evaluates it (no query is sent to a database).
+#Use evaluate_to_string to print the values of the evaluable subterms instead.
+
+def term_to_string(term):
+    """
+    Returns the string representation of a term without evaluating any of its subterms.
+    @param term: a lambda term
+    @return a string
+    """
+    return _render_term(term,False)
+
+def evaluate_to_string(term):
+    """
+    Returns the string representation of a term where each evaluable subterm
+    (@see is_evaluable) is replaced by its value. This may query a database.
+    @param term: a lambda term
+    @return a string
+    """
+    return _render_term(term,True)
+
+def evaluate_to_value(term):
+    """
+    Returns the value of a term whose root is evaluable (@see is_evaluable). This may query a database.
+    @param term: a normalized lambda term
+    @return the python value computed by ret_value or None if the root of the term is not evaluable
+    """
+    kind = _node_kind(term)
+    if (kind == _CONST or kind == _QUANT) and term.is_evaluable():
+        return term.ret_value()
+    return None
+
+def _render_term(term,evaluate):
+
+    out   = [ ]
+    stack = [ term ]
+    while stack:
+        node = stack.pop()
+        if type(node) == str:
+            out.append(node)
+            continue
+        kind = _node_kind(node)
+        if evaluate and (kind == _CONST or kind == _QUANT) and node.is_evaluable():
+            out.append(str(node.ret_value()))
+        elif kind == _VAR:
+            out.append('%s-%d'%(node.varname,node.db_index))
+        elif kind == _APP:
+            out.append('(')
+            stack.extend((')',node.termB,' ',node.termA))
+        elif kind == _ABS:
+            out.append('(lambda (%s:%s) '%(node.boundvar_name,node.boundvar_type))
+            stack.extend((')',node.body))
+        elif kind == _QUANT:
+            out.append('(exists (%s:%s) '%(node.boundvar_name,node.boundvar_type))
+            stack.extend((')',node.body))
+        elif kind == _CONST:
+            args = node.args_values
+            if node.fun_name is None and not args: #constant
+                out.append(str(node.val))
+                continue
+            out.append('%s('%(node.fun_name,))
+            stack.append(')')
+            for idx in range(len(args)-1,0,-1):
+                stack.append(args[idx])
+                stack.append(',')
+            if args:
+                stack.append(args[0])
+        else:
+            out.append(str(node))
+    return ''.join(out)
+
+
+##################################################################
+#SHARED ENVIRONMENT EVALUATION
+#An alternative (non destructive) evaluator where beta reduction extends an environment
+#instead of copying the argument at every bound occurrence of the variable.
+#Arguments are evaluated once and shared by all their occurrences; the normal form is
+#built only once at the end (read back), when values are turned back into lambda terms.
+
+class _Closure(object):
+    """
+    Value of a lambda abstraction or of a quantifier: a binder with the environment of its body
+    """
+    __slots__ = ['node','env']
+
+    def __init__(self,node,env):
+        self.node,self.env = node,env
+
+class _Level(object):
+    """
+    Value of a variable that is not substituted (bound by a binder kept in the normal form or free).
+    The level counts binders from the top of the normal form, the De Bruijn index is recovered at read back.
+    """
+    __slots__ = ['level','varname','ttype']
+
+    def __init__(self,level,varname,ttype):
+        self.level,self.varname,self.ttype = level,varname,ttype
+
+class _Partial(object):
+    """
+    Value of a constant function with its argument values and the number of its remaining (unfilled) args
+    """
+    __slots__ = ['node','args','nargs']
+
+    def __init__(self,node,args,nargs):
+        self.node,self.args,self.nargs = node,args,nargs
+
+class _Stuck(object):
+    """
+    Value of an application that cannot be reduced (the functor is neither an abstraction nor a function)
+    """
+    __slots__ = ['node','functor','operand']
+
+    def __init__(self,node,functor,operand):
+        self.node,self.functor,self.operand = node,functor,operand
+
+class _Unsupported(Exception):
     pass
 
+#continuation tags used by the shared evaluator
+_READBACK,_READ_BODY,_READ_FUNCTOR,_READ_OPERAND,_READ_ARG = range(4,9)
 
-    
+def evaluate_term(term):
+    """
+    Call by value normalization of a term with shared substitutions.
+    This computes the same normal form as term.copy().value() but leaves the term untouched
+    and never copies an argument before it is read back in the normal form.
+    Terms with nodes unknown to the engine are evaluated by term.copy().value()
+    @param term: a lambda term
+    @return a normalized lambda term (a new term)
+    """
+    try:
+        return _evaluate_shared(term)
+    except _Unsupported:
+        return normalize_term(copy_term(term))
+
+def _evaluate_shared(term):
+
+    frames = [ (_READBACK,0) ]
+    node   = term
+    env    = [ ]
+    eval_mode = True
+    while True:
+        if eval_mode:
+            #evaluates node in env
+            kind = _node_kind(node)
+            if kind == _VAR:
+                N = len(env)
+                if node.db_index <= N:
+                    result = env[N-node.db_index]
+                else:
+                    result = _Level(N-node.db_index,node.varname,node.ttype)
+            elif kind == _ABS or kind == _QUANT:
+                result = _Closure(node,env)
+            elif kind == _APP:
+                frames.append((_FUNCTOR,node,env))
+                node = node.termA
+                continue
+            elif kind == _CONST:
+                nfilled = len(node.args_values) - node.nargs
+                if nfilled == 0:
+                    result = _Partial(node,[ ],node.nargs)
+                else:
+                    if node.nargs:
+                        env = env + [None] * node.nargs #the filled args live under the unfilled ones
+                    frames.append((_ARG,node,env,[ ]))
+                    node = node.args_values[0]
+                    continue
+            else:
+                raise _Unsupported()
+        else:
+            #reads back the value node at depth
+            cls = type(node)
+            if cls == _Level:
+                result = LambdaVariable(node.varname,ttype=node.ttype,db_index=depth-node.level)
+            elif cls == _Closure:
+                cpy = _shallow_copy(node.node)
+                vartype = cpy.boundvar_type if type(cpy.boundvar_type) == tuple else (cpy.boundvar_type,)
+                frames.append((_READ_BODY,cpy))
+                frames.append((_READBACK,depth+1))
+                env  = node.env + [_Level(depth,cpy.boundvar_name,vartype)]
+                node = cpy.body
+                eval_mode = True
+                continue
+            elif cls == _Stuck:
+                cpy = _shallow_copy(node.node)
+                frames.append((_READ_FUNCTOR,cpy,node.operand,depth))
+                node = node.functor
+                continue
+            else:
+                cpy = _shallow_copy(node.node)
+                holes = cpy.args_values[len(cpy.args_values)-node.nargs:]
+                cpy.args_values = [LambdaVariable(hole.varname,ttype=hole.ttype,db_index=hole.db_index) for hole in holes]
+                cpy.nargs = node.nargs
+                if not node.args:
+                    refresh_node(cpy)
+                    result = cpy
+                else:
+                    depth = depth+node.nargs
+                    frames.append((_READ_ARG,cpy,node.args,[ ],depth))
+                    node  = node.args[0]
+                    continue
+        #returns result to the pending continuations
+        while frames:
+            frame = frames.pop()
+            tag = frame[0]
+            if tag == _FUNCTOR:
+                frames.append((_OPERAND,frame[1],result))
+                node,env = frame[1].termB,frame[2]
+                eval_mode = True
+                break
+            elif tag == _OPERAND:
+                functor = frame[2]
+                if type(functor) == _Closure and _node_kind(functor.node) == _ABS:
+                    node,env = functor.node.body,functor.env + [result]
+                    eval_mode = True
+                    break
+                elif type(functor) == _Partial:
+                    if functor.nargs == 0:
+                        raise _Unsupported() #the rewriting engine drops the extra argument
+                    result = _Partial(functor.node,functor.args+[result],functor.nargs-1)
+                else:
+                    result = _Stuck(frame[1],functor,result)
+            elif tag == _ARG:
+                parent,values = frame[1],frame[3]
+                values.append(result)
+                if len(values) < len(parent.args_values) - parent.nargs:
+                    frames.append(frame)
+                    node,env = parent.args_values[len(values)],frame[2]
+                    eval_mode = True
+                    break
+                result = _Partial(parent,values,parent.nargs)
+            elif tag == _READBACK:
+                node,depth = result,frame[1]
+                eval_mode = False
+                break
+            elif tag == _READ_BODY:
+                frame[1].body = result
+                refresh_node(frame[1])
+                result = frame[1]
+            elif tag == _READ_FUNCTOR:
+                cpy = frame[1]
+                cpy.termA = result
+                frames.append((_READ_OPERAND,cpy))
+                node,depth = frame[2],frame[3]
+                eval_mode = False
+                break
+            elif tag == _READ_OPERAND:
+                frame[1].termB = result
+                refresh_node(frame[1])
+                result = frame[1]
+            else:
+                cpy,values,terms,depth = frame[1:]
+                terms.append(result)
+                if len(terms) < len(values):
+                    frames.append(frame)
+                    node = values[len(terms)]
+                    eval_mode = False
+                    break
+                cpy.args_values = terms + cpy.args_values
+                refresh_node(cpy)
+                result = cpy
+        else:
+            return result
+
+
+##################################################################
+#CLOSURE COMPILATION
+#A closed and well typed term over builtins is compiled once into nested python closures.
+#Evaluating the compiled function on new arguments does no tree rewriting.
+
+def compile_term(term):
+    """
+    Compiles a closed, well typed lambda term over builtin functions into a python function.
+    The leading lambda binders of the normalized term become the parameters of the function.
+    Example:
+        f = compile_term(parser.parse_code('(lambda (x:num y:num) (and (< x 3) (> (+ x y) 10)))'))
+        f(2,9) #==> True
+    @param term: a lambda term (left untouched)
+    @return a python function taking one python value per leading lambda binder
+    """
+    if typecheck_term(term) == TypeSystem.FAILURE:
+        raise CompilationError(term,'the term is not well typed')
+    body    = normalize_term(copy_term(term))
+    nparams = 0
+    while _node_kind(body) == _ABS:
+        body     = body.body
+        nparams += 1
+
+    closures = [ ]
+    stack    = [ (body,False) ]
+    while stack:
+        node,built = stack.pop()
+        kind = _node_kind(node)
+        if kind == _VAR:
+            if node.db_index < 1 or node.db_index > nparams:
+                raise CompilationError(node,'variable %s is not bound by a leading lambda'%(node.varname,))
+            closures.append(operator.itemgetter(nparams-node.db_index))
+        elif kind != _CONST:
+            raise CompilationError(node,'only builtin functions applied to constants and variables can be compiled')
+        elif node.nargs != 0:
+            raise CompilationError(node,'function %s is partially applied'%(node.fun_name,))
+        elif built:
+            nargs = len(node.args_values)
+            arg_closures = closures[len(closures)-nargs:]
+            del closures[len(closures)-nargs:]
+            closures.append(node.compile_closure(arg_closures))
+        else:
+            stack.append((node,True))
+            stack.extend([(arg,False) for arg in reversed(node.args_values)])
+    closure = closures[0]
+
+    def compiled_term(*args):
+        if len(args) != nparams:
+            raise CompilationError(term,'%d arguments expected, %d given'%(nparams,len(args)))
+        return closure(args)
+    return compiled_term
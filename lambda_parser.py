@@ -4,9 +4,17 @@ from functional_core import *
 
 import ply.lex as lex
 import ply.yacc as yacc
+import re
 import cmd
+import os
 import sys
+import copy
+import time
+import json
+import pickle
 import datetime
+from collections import OrderedDict,deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 class ModelInterface(object):
@@ -54,8 +62,15 @@ class Lexer(object):
     t_ARROW   = r'=>'
     t_DOTS    = r':'
 
+    #master lexer per Lexer class, built once per process and cloned by the instances
+    master_lexers = {}
+
     def __init__(self):
-        self.lexer = lex.lex(module=self)
+        master = Lexer.master_lexers.get(type(self))
+        if master is None:
+            master = lex.lex(module=self)
+            Lexer.master_lexers[type(self)] = master
+        self.lexer = master.clone(self)
     
     def t_STRING(self,t):
         r'"[^"]*"'
@@ -104,15 +119,50 @@ class Lexer(object):
 
             
 class FuncParser(object):
+
+    #LR parser per FuncParser class, its tables are built once per process and shared by the instances
+    master_parsers = {}
+
+    #bare wikidata entity or property ID (parsed without the grammar)
+    db_id_pattern = re.compile(r'\s*((wd:Q|wdt:P)[0-9]+)\s*')
    
-    def __init__(self,naming_context=None, model_interface=None,**kwargs):
+    def __init__(self,naming_context=None, model_interface=None,cache_size=10000,**kwargs):
+        """
+        @param naming_context: a NamingContext
+        @param model_interface: a ModelInterface
+        @param cache_size: max number of parsed terms kept in the parse cache (0 disables the cache)
+        """
         self.lexer = Lexer()
         self.tokens = Lexer.tokens
         self.naming_context = NamingContext.make_std_builtins_context(debug=True) if naming_context == None else naming_context
         self.model_interface = ModelInterface() if model_interface == None else model_interface
-        self.parser = yacc.yacc(module=self)
+        self.parser = self.make_parser()
         self.last_defined_macro = None
         self.last_defined_term  = None
+        self.cache_size  = cache_size
+        self.parse_cache = OrderedDict() #(code,naming context version) -> term, in LRU order
+        self.syntax_errors = 0           #number of syntax errors met so far
+        self.last_error    = None        #offending token of the last syntax error (None at end of input)
+        self.report_errors = True        #prints syntax errors
+
+    def make_parser(self):
+        """
+        Returns a LR parser whose grammar actions are the methods of this instance.
+        The LALR tables are generated only for the first instance (no table or debug file is written)
+        and the parsers of the next instances share them.
+        @return a ply LRParser
+        """
+        master = FuncParser.master_parsers.get(type(self))
+        if master is None:
+            master = yacc.yacc(module=self,write_tables=False,debug=False)
+            FuncParser.master_parsers[type(self)] = master
+        parser = copy.copy(master)
+        parser.productions = [yacc.MiniProduction(prod.str,prod.name,prod.len,prod.func,prod.file,prod.line) for prod in master.productions]
+        for prod in parser.productions:
+            if prod.func:
+                prod.callable = getattr(self,prod.func)
+        parser.errorfunc = self.p_error
+        return parser
         
     def p_parse_program(self,p):
         """
@@ -153,10 +203,17 @@ class FuncParser(object):
 
     def p_parse_db_id(self,p):#TODO : merge with general identifiers ? (more general)
         """ term : DB_IDENTIFIER """
-        predname = p[1]
+        p[0] = self.make_db_identifier(p[1])
+
+    def make_db_identifier(self,predname):
+        """
+        @param predname: a wikidata entity or property ID (wd:Qxxx or wdt:Pxxx)
+        @return a copy of the term bound to this ID or None if it is not bound
+        """
         if self.naming_context.is_bound_name(predname):
-            p[0] = self.naming_context[predname]
+            return self.naming_context[predname].copy()
         #TODO (in principle not an issue)
+        return None
 
                         
     def p_parse_termlist(self,p):
@@ -244,28 +301,151 @@ class FuncParser(object):
             p[0] = TypeSystem.concat_types(p[1],p[3]) 
 
     def p_error(self,p):
-        print("Syntax error in input!")
+        self.syntax_errors += 1
+        self.last_error     = p
+        if self.report_errors:
+            print("Syntax error in input!")
 
     def parse_code(self,codestring):
         """
         This does the job and returns the parsed code as a lambda term
-        or a list of \lambda terms.
+        or a list of lambda terms.
+        Parsed terms are memoized: parsing again the same code (with the same
+        name bindings) returns a fresh copy of the cached term.
+        Bare wikidata IDs are not parsed with the grammar nor cached, they also return a fresh copy.
+        The terms of a code with syntax errors are not cached.
         """
-        return self.parser.parse(codestring,lexer=self.lexer.lexer)
+        match = FuncParser.db_id_pattern.fullmatch(codestring)
+        if match:
+            return self.make_db_identifier(match.group(1))
+
+        version = self.naming_context.version
+        key     = (codestring,version)
+        term    = self.parse_cache.get(key)
+        if term is not None:
+            self.parse_cache.move_to_end(key)
+            return term.copy()
+
+        errors = self.syntax_errors
+        term   = self.parser.parse(codestring,lexer=self.lexer.lexer)
+        if term is None or self.cache_size <= 0 or self.syntax_errors > errors or self.naming_context.version != version: #failures and defines are not cached
+            return term
+        self.parse_cache[key] = term
+        if len(self.parse_cache) > self.cache_size:
+            self.parse_cache.popitem(last=False)
+        return term.copy()
+
+def load_defines(filename,parser,progress=10000,snapshot=None):
+    """
+    Streams a definition file (one define per line, '#' starts a comment) through a single parser.
+    Failures are reported with their line number and do not stop the loading.
+    The binding messages of the naming context are turned off while loading.
+    @param filename: the definition file
+    @param parser: the FuncParser used for the whole file, its naming context receives the defines
+    @param progress: prints a progress line every 'progress' lines (None or 0 for no progress line)
+    @param snapshot: if not None, path where the resulting naming context is saved (@see load_naming_context)
+    @return a dict : name -> lambda term, with the names defined in the file
+    """
+    naming_context = parser.naming_context
+    debug,report   = naming_context.debug,parser.report_errors
+    naming_context.debug,parser.report_errors = False,False
+
+    defines,failures = {},0
+    start   = time.perf_counter()
+    istream = open(filename)
+    for lineno,line in enumerate(istream,1):
+        line = line.split("#")[0]
+        if line and not line.isspace():
+            errors  = parser.syntax_errors
+            version = naming_context.version
+            try:
+                parser.parser.parse(line,lexer=parser.lexer.lexer)
+                if parser.syntax_errors > errors:
+                    token = parser.last_error
+                    print('%s:%d: syntax error near %s'%(filename,lineno,"'%s'"%(token.value,) if token else 'end of line'))
+                    failures += 1
+                elif naming_context.version != version:
+                    defines[parser.last_defined_macro] = parser.last_defined_term
+            except Exception as e:
+                print('%s:%d: %s'%(filename,lineno,e))
+                failures += 1
+        if progress and lineno % progress == 0:
+            print('%s: %d lines, %d defines, %d failures (%.1fs)'%(filename,lineno,len(defines),failures,time.perf_counter()-start))
+    istream.close()
+    naming_context.debug,parser.report_errors = debug,report
+    if progress:
+        print('%s: loaded %d defines, %d failures (%.1fs)'%(filename,len(defines),failures,time.perf_counter()-start))
+    if snapshot:
+        save_naming_context(naming_context,snapshot,source=filename)
+    return defines
+
+class SnapshotError(Exception):
+    """
+    Raised when a naming context snapshot cannot be reloaded: it was written with another format version
+    or its definition file changed since it was written.
+    """
+    def __init__(self,filename,msg):
+        self.filename = filename
+        self.msg      = msg
+
+    def __str__(self):
+        return 'snapshot %s: %s'%(self.filename,self.msg)
+
+SNAPSHOT_VERSION = 1 #bump when the pickled terms change layout
+
+def source_signature(source):
+    """
+    @param source: a definition file or None
+    @return the (mtime,size) of the file or None
+    """
+    if source is None:
+        return None
+    stat = os.stat(source)
+    return (stat.st_mtime_ns,stat.st_size)
 
-def source_defines(filename,naming_context,model_interface):
+def save_naming_context(naming_context,filename,source=None):
+    """
+    Saves a naming context (with its bound terms) as a binary snapshot.
+    The snapshot starts with a header: the format version and the signature of the definition file.
+    @param naming_context: a naming context
+    @param filename: the snapshot file
+    @param source: the definition file the naming context was loaded from or None
+    """
+    ostream = open(filename,'wb')
+    pickle.dump((SNAPSHOT_VERSION,source_signature(source)),ostream,protocol=pickle.HIGHEST_PROTOCOL)
+    pickle.dump(naming_context,ostream,protocol=pickle.HIGHEST_PROTOCOL)
+    ostream.close()
+
+def load_naming_context(filename,source=None):
+    """
+    Reloads a naming context saved by save_naming_context
+    @param filename: the snapshot file
+    @param source: the definition file the snapshot must have been made from or None to skip the check
+    @return a naming context
+    @raise SnapshotError if the snapshot has another format version or the definition file changed
+    """
+    istream = open(filename,'rb')
+    try:
+        header  = pickle.load(istream)
+        version = header[0] if isinstance(header,tuple) and len(header) == 2 else None #older snapshots have no header
+        if version != SNAPSHOT_VERSION:
+            raise SnapshotError(filename,'format version %s, expected %d'%(version,SNAPSHOT_VERSION))
+        if source is not None and header[1] != source_signature(source):
+            raise SnapshotError(filename,'%s changed since the snapshot was made'%(source,))
+        naming_context = pickle.load(istream)
+    finally:
+        istream.close()
+    return naming_context
+
+def source_defines(filename,naming_context,model_interface,snapshot=None):
     """
     This sources a definition file and returns a Naming Context
     @param naming_context : a naming context
+    @param snapshot: if not None, path where the resulting naming context is saved
     @return a naming context augmented with the defines in the file.
     """
     parser = FuncParser(naming_context,model_interface)
-    istream = open(filename)
-    for line in istream:
-        line = line.split("#")[0]
-        if not line.isspace():
-            parser.parse_code(line)
-    istream.close()
+    load_defines(filename,parser,snapshot=snapshot)
     return naming_context
 
 class InteractiveShell(cmd.Cmd):
@@ -291,12 +471,164 @@ to your .inputrc file.
                 #print(T)
                 ttype = TypeSystem.typecheck(T)
                 tval  = T.value()
-                print(tval,':',ttype)
+                print(evaluate_to_string(tval),':',ttype)
         except Exception as e:
             print(e)
+
+
+class BatchEvaluator(object):
+    """
+    Non interactive evaluation of newline delimited terms and defines ('#' starts a comment).
+    The lines are parsed in order by a single parser and the terms are evaluated by a pool of
+    worker threads (evaluation mostly waits for the database).
+    One JSON object is written per line, in input order:
+       {"line": 3, "term": "...", "type": [...], "value": ..., "text": "...", "parse_ms": 0.1, "eval_ms": 12.0}
+       {"line": 4, "define": "NAME", "parse_ms": 0.2}
+       {"line": 5, "term": "...", "error": "...", "parse_ms": 0.1}
+    The value is a JSON value of the type of the term (@see json_value), null when the normal form
+    of the term has no value, and the text is the normal form with its evaluable subterms evaluated.
+    """
+    NOT_EVALUATED = object() #stands for the evaluation of the records without term (@see run)
+
+    def __init__(self,model_interface=None,naming_context=None,workers=4):
+        """
+        @param model_interface: a ModelInterface
+        @param naming_context: a NamingContext
+        @param workers: number of evaluation threads
+        """
+        self.parser  = FuncParser(naming_context,model_interface)
+        self.parser.report_errors = False
+        self.workers = workers
+
+    def parse_line(self,lineno,line):
+        """
+        Parses a line (in input order)
+        @return a couple (record,term) where term is None if there is nothing to evaluate
+        """
+        parser  = self.parser
+        errors  = parser.syntax_errors
+        version = parser.naming_context.version
+        record  = {'line':lineno,'term':line}
+        start   = time.perf_counter()
+        term    = None
+        try:
+            term = parser.parse_code(line)
+            if parser.syntax_errors > errors:
+                token = parser.last_error
+                record['error'] = 'syntax error near %s'%("'%s'"%(token.value,) if token else 'end of line',)
+                term = None
+            elif parser.naming_context.version != version:
+                record = {'line':lineno,'define':parser.last_defined_macro}
+        except Exception as e:
+            record['error'] = str(e)
+            term = None
+        record['parse_ms'] = round(1000*(time.perf_counter()-start),3)
+        return record,term
+
+    @staticmethod
+    def evaluate(record,term):
+        """
+        Typechecks and evaluates a term (in a worker thread) and fills its record
+        @return the record
+        """
+        start = time.perf_counter()
+        try:
+            record['type'] = typecheck_term(term)
+            normal_form    = evaluate_term(term)
+            value          = evaluate_to_value(normal_form)
+            if value is None:
+                record['value'],record['text'] = None,evaluate_to_string(normal_form)
+            else:
+                record['value'],record['text'] = BatchEvaluator.json_value(value,record['type']),str(value)
+        except Exception as e:
+            record['error'] = str(e)
+        record['eval_ms'] = round(1000*(time.perf_counter()-start),3)
+        return record
+
+    @staticmethod
+    def json_value(value,ttype):
+        """
+        Converts the value of a term to a JSON value of its type
+        @param value: a value returned by ret_value
+        @param ttype: the type of the term
+        @return a boolean, a number, a list (the entity IDs assigned by a SELECT query, or a dict
+        var -> ID per assignment when there are several answer variables) or a string
+        """
+        if ttype == (TypeSystem.BOOLEAN,):
+            return bool(value)
+        if ttype == (TypeSystem.NUMERIC,):
+            number = float(value)
+            return int(number) if number.is_integer() else number
+        if isinstance(value,list):
+            return [assignment[0][1] if len(assignment) == 1 else dict(assignment) for assignment in value]
+        return str(value)
+
+    def run(self,istream,ostream):
+        """
+        Evaluates the lines of istream and writes the results on ostream.
+        @param istream: a text stream
+        @param ostream: a text stream
+        @return a couple (number of records,number of errors)
+        """
+        records,errors = 0,0
+        pending = deque()
+        def flush(max_pending):
+            nonlocal records,errors
+            while len(pending) > max_pending:
+                future,record = pending.popleft()
+                if future is not BatchEvaluator.NOT_EVALUATED:
+                    record = future.result()
+                records += 1
+                errors  += 'error' in record
+                ostream.write(json.dumps(record,default=str)+'\n')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for lineno,line in enumerate(istream,1):
+                line = line.split("#")[0].strip()
+                if not line:
+                    continue
+                record,term = self.parse_line(lineno,line)
+                pending.append((pool.submit(BatchEvaluator.evaluate,record,term) if term is not None else BatchEvaluator.NOT_EVALUATED,record))
+                flush(4*self.workers)
+            flush(0)
+        ostream.flush()
+        return records,errors
+
+
+def batch_main(model_interface=None,naming_context=None,description='Evaluates lambda terms'):
+    """
+    Command line entry point: evaluates terms read from a file or stdin as JSON lines
+    (run with --help for the options) or starts the interactive shell when --batch is not given.
+    """
+    import argparse
+    cmdline = argparse.ArgumentParser(description=description)
+    cmdline.add_argument('defines',nargs='?',help='definition file sourced before evaluation')
+    cmdline.add_argument('--batch',metavar='FILE',help="evaluates the terms of FILE ('-' for stdin) instead of starting the shell")
+    cmdline.add_argument('--output',metavar='FILE',help='JSON lines output file (default: stdout)')
+    cmdline.add_argument('--workers',type=int,default=4,help='number of evaluation threads (default: 4)')
+    args = cmdline.parse_args()
+
+    naming_context = NamingContext.make_std_builtins_context() if naming_context == None else naming_context
+    model_interface = ModelInterface() if model_interface == None else model_interface
+    if args.defines:
+        source_defines(args.defines,naming_context,model_interface)
+    if args.batch is None:
+        shell = InteractiveShell(model_interface=model_interface,naming_context=naming_context)
+        shell.cmdloop()
+        return
+    evaluator = BatchEvaluator(model_interface,naming_context,workers=args.workers)
+    istream = sys.stdin if args.batch == '-' else open(args.batch)
+    ostream = sys.stdout if args.output is None else open(args.output,'w')
+    start = time.perf_counter()
+    records,errors = evaluator.run(istream,ostream)
+    print('%d lines evaluated, %d errors (%.1fs)'%(records,errors,time.perf_counter()-start),file=sys.stderr)
+    if istream is not sys.stdin:
+        istream.close()
+    if ostream is not sys.stdout:
+        ostream.close()
+
         
 if __name__ == '__main__' :
-    
-    shell = InteractiveShell()
-    shell.cmdloop()
+
+    batch_main()
 
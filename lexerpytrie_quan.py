@@ -7,7 +7,7 @@ import re
 import json
 
 from lambda_parser import FuncParser
-from functional_core import TypeSystem
+from functional_core import TypeSystem,MacroTypeCache
 from wikidata_model import WikidataModelInterface,NamingContextWikidata
 import pytrie
 from pytrie import SortedStringTrie as Trie
@@ -15,19 +15,26 @@ from pytrie import SortedStringTrie as Trie
 
 class Token:
 	
-	def __init__(self,wform,ptag,logmacro,logform):
+	def __init__(self,wform,ptag,logmacro,logform,type_cache=None):
 		"""
 		Args:
 			wform              (string) : the raw string
 			ptag               (string) : the pos tag of the token
 			logmacro           (string) : a wikidata Qxxx or Pxxx identifier
 			logical_macro (LambdaTerm) : a lambda term for the macro
+		KwArgs:
+			type_cache (MacroTypeCache) : the type cache of the LF dictionary of the macro (None typechecks the logical form)
 		"""
 		self.form          = wform
 		self.postag        = ptag
 		self.logical_macro = logmacro
 		self.logical_form  = logform
-		self.logical_type  = TypeSystem.typecheck(logform)  if logform else None
+		if logform is None:
+			self.logical_type = None
+		elif type_cache is None:
+			self.logical_type = TypeSystem.typecheck(logform)
+		else:
+			self.logical_type = type_cache.typecheck(logmacro,logform)
 
 	def is_predicate(self):
 		return not self.logical_macro is None and self.logical_macro[0] == 'P'
@@ -52,6 +59,7 @@ class Tokenizer:
 		"""
 		self.istream = open(filename)
 		self.LFdict = LFdictionary
+		self.type_cache = MacroTypeCache()
 			
 	def read_conllu_input(self,ref_answer=False):
 		"""
@@ -74,11 +82,11 @@ class Tokenizer:
 					startidx,endidx = idxrange.split('-')
 					startidx,endidx = int(startidx),int(endidx)
 					skip_idxes.update(list(range(startidx,endidx+1)))
-					toklist.append(Token(surf_string,postag,logical_macro,self.LFdict.get(logical_macro,None)) ) 
+					toklist.append(Token(surf_string,postag,logical_macro,self.LFdict.get(logical_macro,None),self.type_cache) ) 
 				else:
 					idx = int(idxrange)
 					if idx not in skip_idxes:
-						toklist.append( Token(surf_string,postag,logical_macro,self.LFdict.get(logical_macro,None)) )
+						toklist.append( Token(surf_string,postag,logical_macro,self.LFdict.get(logical_macro,None),self.type_cache) )
 			line = self.istream.readline()
 		if not toklist:
 			self.istream.close()
@@ -98,6 +106,7 @@ class DefaultLexer:
 		wikidata_model     = WikidataModelInterface()
 		wikidata_names     = NamingContextWikidata.make_wikidata_builtins_context(debug=True)
 		self.lambda_parser = FuncParser(wikidata_names,wikidata_model)
+		self.type_cache    = MacroTypeCache(wikidata_names)
 
 		#should externalize this
 		self.wh_words = set(['Qui','Que','Quel','Quelle','Quels','Quelles','Où','qui','quel','quelle','quels','quelles','où'])
@@ -158,7 +167,7 @@ class DefaultLexer:
 			elif tokform in self.wh_words:
 				 qmacro   = 'WHQ'
 				 qlogform = self.wh_term.copy()  
-			tokens.append( Token(tokform,"NOTAG",qmacro,qlogform)) 
+			tokens.append( Token(tokform,"NOTAG",qmacro,qlogform,self.type_cache)) 
   
 		#Reference answers
 		if ref_answer:
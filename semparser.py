@@ -1,8 +1,11 @@
 import sys
+import asyncio
+from collections import OrderedDict
 from math import exp,log
 from functional_core import *
-from lambda_parser import FuncParser
-from wikidata_model import WikidataModelInterface, NamingContextWikidata,Assignation
+from lambda_parser import FuncParser,load_defines
+from wikidata_model import WikidataModelInterface, NamingContextWikidata,Assignation,WikidataPredicate,SparqlTemplate,WikidataQuery
+from sparql_client import SparqlError
 #from lexer import DefaultLexer
 from lexerpytrie_quan import DefaultLexer
 from SparseWeightVector import SparseWeightVector
@@ -15,16 +18,25 @@ def read_LF_dictionary(filename):
     @return a dict :  name -> lambda term
     """ 
     wikidata_model = WikidataModelInterface()
-    wikidata_names = NamingContextWikidata.make_wikidata_builtins_context(debug=True)
+    wikidata_names = NamingContextWikidata.make_wikidata_builtins_context()
     parser = FuncParser(wikidata_names,wikidata_model)
+    return load_defines(filename,parser)
 
-    lfdic = {}
-    istream = open(filename)
-    for line in istream:
-        parser.parse_code(line)
-        lfdic[parser.last_defined_macro] =  parser.last_defined_term 
-    istream.close()
-    return lfdic
+def make_logical_parser(wikidata_model=None):
+    """
+    Builds a wikidata lambda parser with the combinators used by the CCG parser.
+    @param wikidata_model: the model interface (defaults to the wikidata endpoint)
+    @return a FuncParser
+    """
+    wikidata_model = WikidataModelInterface() if wikidata_model is None else wikidata_model
+    wikidata_names = NamingContextWikidata.make_wikidata_builtins_context()
+    parser = FuncParser(wikidata_names,wikidata_model)
+    parser.parse_code("(define SWAP (lambda (P:e=>e=>t x:e y:e)  (P y x)))")
+    parser.parse_code("(define JOIN (lambda (P:e=>e=>t Q:e=>t x:e) (exists (y:e) (and (P x y) (Q y)))))")
+    parser.parse_code("(define AND (lambda (P:e=>t Q:e=>t x:e) (and (P x) (Q x))))")
+    parser.parse_code("(define OR (lambda (P:e=>t Q:e=>t x:e) (or (P x) (Q x))))")
+    parser.parse_code("(define WHQ (lambda (P:e=>t) (@exists(x:e) (P x))))")
+    return parser
 
 class ParseFailureError(Exception) :
 
@@ -56,8 +68,8 @@ class SRAction:
         self.act_macro      = act_macro
         self.act_combinator = act_combinator
 
-        #combinator type
-        self.ctype = TypeSystem.typecheck(self.act_combinator) if self.act_combinator else None
+        #combinator type (id in the type registry)
+        self.ctype = TYPE_REGISTRY.intern(TypeSystem.typecheck(self.act_combinator) if self.act_combinator else None)
         
         #label pushed on the stack and used as feature input by the CRF.
         self.stack_label = "%s[%s]"%(act_type,act_macro) if act_macro else act_type
@@ -84,22 +96,23 @@ class SRAction:
         
         print('apply oops',self.stack_label)
   
-    def logical_type( self,lhs_type,rhs_type=TypeSystem.FAILURE ):
+    def logical_type( self,lhs_type,rhs_type=TypeRegistry.FAILURE_ID ):
         """
-        @param lhs_type: type of the left operand
-        @param rhs_type: type of the right operand
-        @return the type of the return value
+        Types are ids in the type registry (@see TypeRegistry)
+        @param lhs_type: type id of the left operand
+        @param rhs_type: type id of the right operand
+        @return the type id of the return value
         """
         if self.act_type in [ SRAction.APPLY_LEFT, SRAction.COORD ]:
             if self.act_combinator:
-                lhs_type = TypeSystem.deduce_application_type(self.ctype,lhs_type)
-            return TypeSystem.deduce_application_type(lhs_type,rhs_type)
+                lhs_type = TYPE_REGISTRY.apply(self.ctype,lhs_type)
+            return TYPE_REGISTRY.apply(lhs_type,rhs_type)
         elif self.act_type ==  SRAction.APPLY_RIGHT:
             if self.act_combinator:
-                rhs_type = TypeSystem.deduce_application_type(self.ctype,rhs_type)
-            return TypeSystem.deduce_application_type(rhs_type,lhs_type)
+                rhs_type = TYPE_REGISTRY.apply(self.ctype,rhs_type)
+            return TYPE_REGISTRY.apply(rhs_type,lhs_type)
         elif self.act_type == SRAction.SHIFT_UNARY:
-            return TypeSystem.deduce_application_type(self.ctype,lhs_type)    
+            return TYPE_REGISTRY.apply(self.ctype,lhs_type)    
         print('type oops',self.stack_label)
        
     def head(self,lhs,rhs=None,coord=None):
@@ -131,8 +144,11 @@ class SRAction:
 
 class StackElement:
     """
-    Type of elements pushed on the stack
+    Type of elements pushed on the stack.
+    The logical type is an id in the type registry (@see TypeRegistry)
     """
+    __slots__ = ['label','head_idx','logical_type']
+
     def __init__(self,label,head_idx,logical_type):
         self.label        = label
         self.head_idx     = head_idx
@@ -178,11 +194,16 @@ class CCGParser :
     That's a CCG style robust shift reduce parser (arc standard style)
     with CRF style statistical inference. 
     """
+    TEMPLATE_CACHE_SIZE = 10000 #max number of query templates kept (@see query_template)
+
     def __init__(self,lexer):
         
         self.actions_list = self.make_actions()  #records an ordering of parsing actions           
         self.weights      = SparseWeightVector() 
         self.lexer        = lexer
+        self.query_counts = (0,0)                #(queries asked,queries sent) for the last sentence
+        self.templates    = OrderedDict()        #derivation skeleton -> SparqlTemplate (None if the skeleton yields no query)
+        self.check_mode   = 'select'             #how the training checks the answers: 'select', 'stream' or 'ask' (@see check_derivations)
         
     def make_actions(self):
         """
@@ -228,7 +249,7 @@ class CCGParser :
         """
         S,B,_ = configuration
         token = toklist[B[0]]
-        stack_elt = StackElement(token.postag,B[0],token.logical_type)
+        stack_elt = StackElement(token.postag,B[0],TYPE_REGISTRY.intern(token.logical_type))
         return (S + [stack_elt],B[1:],prefix_score)
 
     def drop(self,configuration,toklist,prefix_score):
@@ -250,7 +271,7 @@ class CCGParser :
         """
         S,B,_ = configuration
         token = toklist[B[0]]
-        stack_elt = StackElement(token.postag,B[0],action.logical_type(token.logical_type,None))
+        stack_elt = StackElement(token.postag,B[0],action.logical_type(TYPE_REGISTRY.intern(token.logical_type)))
         return (S + [stack_elt],B[1:],prefix_score)
 
     def reduce_binary(self,configuration,toklist,action,prefix_score):
@@ -310,6 +331,7 @@ class CCGParser :
         S,B,score = configuration
         
         flags = [True] * len(self.actions_list)
+        next_type = TYPE_REGISTRY.intern(toklist[B[0]].logical_type) if B else TypeRegistry.FAILURE_ID
   
         for idx,act in enumerate(self.actions_list):
             #Structural constraints 
@@ -324,13 +346,13 @@ class CCGParser :
                     flags[idx] = False
             elif len(S) < 2 and act.act_type in [ SRAction.APPLY_LEFT,SRAction.APPLY_RIGHT ]:
                 flags[idx] = False
-            elif act.act_type in [ SRAction.APPLY_LEFT, SRAction.APPLY_RIGHT ] and act.logical_type(S[-2].logical_type,S[-1].logical_type) == TypeSystem.FAILURE:
+            elif act.act_type in [ SRAction.APPLY_LEFT, SRAction.APPLY_RIGHT ] and act.logical_type(S[-2].logical_type,S[-1].logical_type) == TypeRegistry.FAILURE_ID:
                 #type constraints (binary case)
                 flags[idx] = False
-            elif act.act_type == SRAction.SHIFT_UNARY and act.logical_type(toklist[B[0]].logical_type) == TypeSystem.FAILURE:
+            elif act.act_type == SRAction.SHIFT_UNARY and act.logical_type(next_type) == TypeRegistry.FAILURE_ID:
                 #type constraints (unary case)
                 flags[idx] = False
-            elif act.act_type == SRAction.COORD and (len(S) < 3 or S[-2].label not in ['OR','AND'] or act.logical_type(S[-3].logical_type,S[-1].logical_type) == TypeSystem.FAILURE):
+            elif act.act_type == SRAction.COORD and (len(S) < 3 or S[-2].label not in ['OR','AND'] or act.logical_type(S[-3].logical_type,S[-1].logical_type) == TypeRegistry.FAILURE_ID):
                 flags[idx] = False
             
         return flags    
@@ -467,7 +489,7 @@ class CCGParser :
         prev_cell,act,config = beam_cell.prev,beam_cell.action,beam_cell.config
         S,B,score = config
         
-        dtype = S[-1].logical_type         #gets logical type 
+        dtype = TYPE_REGISTRY.type_of(S[-1].logical_type)         #gets logical type 
         deriv      = [ (config,None)]      #might include a terminate action later on (more elegant)
 
         while act != None:
@@ -506,25 +528,262 @@ class CCGParser :
 
     def make_query(self,derivation,toklist):
         """
-        This builds a logical form (lambda term) from a derivation and returns the answer (if any)
+        This builds the query of a derivation (from the template of its skeleton @see query_template) and returns the answer (if any)
         @param derivation : a parse derivation 
         @param toklist: a list of tokens
         @return a list of wikidata entities
         @TODO manage boolean (ASK) questions 
         """
+        query_string,sender = self.make_query_string(derivation,toklist)
+        if query_string is None: #not a query: no answer
+            return [ ]
+        return CCGParser.answer_entities(sender.send_query(query_string))
+
+    async def make_query_async(self,derivation,toklist):
+        """
+        Coroutine version of make_query (@see make_queries_concurrently)
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @return a list of wikidata entities
+        """
+        query_string,sender = self.make_query_string(derivation,toklist)
+        if query_string is None: #not a query: no answer
+            return [ ]
+        return CCGParser.answer_entities(await sender.send_query_async(query_string))
+
+    async def make_queries_async(self,derivations,toklist):
+        """
+        Sends the queries of all the derivations at once and gathers their answers.
+        Derivations with the same logical form yield the same (canonical) query, which is sent once.
+        The number of queries in flight is capped by WikidataQuery.MAX_CONCURRENCY and when
+        WikidataQuery.BATCH_SIZE > 1, the queries are merged in requests of BATCH_SIZE queries.
+        @param derivations : a list of parse derivations
+        @param toklist: a list of tokens
+        @return a list with, for each derivation, its list of wikidata entities or the SparqlError
+        raised if its query failed (the endpoint is unreachable, overloaded or too slow).
+        The derivations whose logical form is not a query have no answer.
+        """
+        queries,unique = [ ],{ } #unique: query -> (template,ids)
+        for derivation in derivations:
+            instance = self.query_instance(derivation,toklist)
+            if instance is None:
+                queries.append(None)
+                continue
+            template,ids = instance
+            query_string = template.instantiate(ids)
+            queries.append(query_string)
+            unique.setdefault(query_string,(template,ids))
+        items = list(unique.values())
+        size  = WikidataQuery.BATCH_SIZE
+        if size > 1:
+            batches = [items[idx:idx+size] for idx in range(0,len(items),size)]
+            results = await asyncio.gather(*[batch[0][0].send_batch_async([template.instance_pattern(ids) for template,ids in batch]) for batch in batches])
+            results = [result for batch_results in results for result in batch_results]
+        else:
+            results = await asyncio.gather(*[template.send_query_async(query) for query,(template,ids) in unique.items()],return_exceptions=True)
+        answers = {None:[ ]}
+        for query,result in zip(unique,results):
+            if isinstance(result,SparqlError):
+                answers[query] = result
+            elif isinstance(result,BaseException):
+                raise result
+            else:
+                answers[query] = CCGParser.answer_entities(result)
+        self.query_counts = (sum(1 for query in queries if query is not None),len(unique))
+        return [answers[query] if isinstance(answers[query],SparqlError) else list(answers[query]) for query in queries]
+
+    def make_queries_concurrently(self,derivations,toklist):
+        """
+        Returns the answers of all the derivations, the queries are sent concurrently:
+        the latency is roughly the one of the slowest query instead of the sum of the latencies.
+        @param derivations : a list of parse derivations
+        @param toklist: a list of tokens
+        @return a list with, for each derivation, its list of wikidata entities or a SparqlError
+        """
+        if not derivations:
+            self.query_counts = (0,0)
+            return [ ]
+        return asyncio.run(self.make_queries_async(derivations,toklist))
+
+    def make_check_query(self,derivation,toklist,refset):
+        """
+        Generates the query checking the answers of a derivation: in 'ask' mode, an ASK query
+        whose answer tells if a reference answer is an answer of the derivation (@see SparqlTemplate.check_query),
+        otherwise (or if the references are not all entities) its SELECT query.
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @param refset : the set of correct answers to the question
+        @return a triple (query_string,sender,qtype) where qtype is either ASK or SELECT
+        (or None if the logical form of the derivation is not a query)
+        """
+        if self.check_mode == 'ask':
+            template,ids = self.query_template(derivation,toklist)
+            query_string = template.check_query(ids,refset) if template is not None else None
+            if query_string is not None:
+                return query_string,template,'ASK'
+        query_string,sender = self.make_query_string(derivation,toklist)
+        return query_string,sender,'SELECT' if query_string is not None else None
+
+    async def check_queries_async(self,derivations,toklist,refset):
+        """
+        Checks the answers of the queries of all the derivations at once, either with ASK queries ('ask' mode)
+        or by reading the answers of the SELECT queries as they arrive, up to the first reference answer.
+        @param derivations : a list of parse derivations
+        @param toklist: a list of tokens
+        @param refset : the set of correct answers to the question
+        @return a list with, for each derivation, a boolean (correct or not) or the SparqlError raised by its query
+        (the derivations whose logical form is not a query are not correct)
+        """
+        queries,unique = [ ],{ } #unique: query -> (sender,qtype)
+        for derivation in derivations:
+            query_string,sender,qtype = self.make_check_query(derivation,toklist,refset)
+            queries.append(query_string)
+            if query_string is not None:
+                unique.setdefault(query_string,(sender,qtype))
+        def check(query,sender):
+            results = sender.stream_query(query)
+            try:
+                return CCGParser.is_correct(CCGParser.iter_entities(results),refset)
+            finally:
+                results.close() #puts back the connection in the pool right away
+        loop    = asyncio.get_running_loop()
+        tasks   = [sender.send_query_async(query,'ASK') if qtype == 'ASK' else loop.run_in_executor(None,check,query,sender) for query,(sender,qtype) in unique.items()]
+        results = await asyncio.gather(*tasks,return_exceptions=True)
+        flags   = {None:False}
+        for query,result in zip(unique,results):
+            if isinstance(result,BaseException) and not isinstance(result,SparqlError):
+                raise result
+            if isinstance(result,SparqlError) and not result.is_transient(): #rejected (incoherent) query: no answer
+                result = False
+            flags[query] = result
+        self.query_counts = (sum(1 for query in queries if query is not None),len(unique))
+        return [flags[query] for query in queries]
+
+    @staticmethod
+    def answer_entities(results):
+        """
+        @param results: the assignments returned by a SELECT query
+        @return the list of entities assigned to the answer variable
+        """
+        return list(CCGParser.iter_entities(results))
+
+    @staticmethod
+    def iter_entities(results):
+        """
+        @param results: an iterable of assignments returned by a SELECT query (@see WikidataQuery.stream_query)
+        @return a generator of the entities assigned to the answer variable
+        """
+        for assignment in results:
+            if len(assignment) == 1: #factoid question, in principle we cannot have more than 1 var binding
+                var,binding = assignment[0]
+                yield binding
+
+    def derivation_skeleton(self,derivation,toklist):
+        """
+        The skeleton of a derivation is its sequence of actions with the macro of each token shifted,
+        the wikidata IDs of the tokens being parameters: derivations with the same skeleton have
+        the same logical form up to the IDs.
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @return a couple (skeleton,params): a tuple and the list of the (token index,arity) of the parameters
+        """
+        idx      = 0
+        skeleton = [ ]
+        params   = [ ]
+        for config,action in derivation:
+            if action == None:
+                break
+            skeleton.append(action.stack_label)
+            if action.act_type in (SRAction.SHIFT,SRAction.SHIFT_UNARY):
+                lf = toklist[idx].logical_form
+                if isinstance(lf,WikidataPredicate) and all(isinstance(arg,LambdaVariable) for arg in lf.args_values): #a bare ID
+                    params.append((idx,lf.arity))
+                    skeleton.append('$%d'%(lf.arity,))
+                else:
+                    skeleton.append(toklist[idx].logical_macro)
+                idx += 1
+            elif action.act_type == SRAction.DROP:
+                idx += 1
+        return tuple(skeleton),params
+
+    def query_template(self,derivation,toklist):
+        """
+        Returns the query template of the skeleton of a derivation,
+        compiled (built and normalized once with parameters for the IDs) the first time the skeleton is seen.
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @return a couple (template,ids) where template is a SparqlTemplate or None if the skeleton yields no query
+        and ids are the IDs of the derivation to substitute in the template.
+        """
+        skeleton,params = self.derivation_skeleton(derivation,toklist)
+        ids = [toklist[idx].logical_form.fun_name for idx,arity in params]
+        if skeleton in self.templates:
+            self.templates.move_to_end(skeleton)
+            return self.templates[skeleton],ids
+
+        logical_forms = [tok.logical_form for tok in toklist]
+        for pidx,(idx,arity) in enumerate(params):
+            logical_forms[idx] = SparqlTemplate.parameter(pidx,arity)
+        query_term = self.make_query_term(derivation,toklist,logical_forms)
+        template   = None
+        if hasattr(query_term,'sparql_query'):
+            try:
+                template = SparqlTemplate(query_term,'SELECT')
+            except CompilationError: #no query can be generated (e.g. a superlative whose candidates are not quantified)
+                template = None
+        self.templates[skeleton] = template
+        if len(self.templates) > CCGParser.TEMPLATE_CACHE_SIZE:
+            self.templates.popitem(last=False)
+        return template,ids
+
+    def make_query_string(self,derivation,toklist):
+        """
+        Generates the SELECT query of a derivation from the template of its skeleton
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @return a couple (query_string,sender) where sender sends the query (@see SparqlTemplate.send_query),
+        (None,None) if the logical form of the derivation is not a query
+        """
+        instance = self.query_instance(derivation,toklist)
+        if instance is None:
+            return None,None
+        template,ids = instance
+        return template.instantiate(ids),template
+
+    def query_instance(self,derivation,toklist):
+        """
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @return a couple (template,ids) (@see query_template) or None if the logical form of the derivation is not a query
+        """
+        template,ids = self.query_template(derivation,toklist)
+        if template is None:
+            return None
+        return template,ids
+
+    def make_query_term(self,derivation,toklist,logical_forms=None):
+        """
+        This builds the logical form (lambda term) of a derivation
+        @param derivation : a parse derivation 
+        @param toklist: a list of tokens
+        @param logical_forms: the logical forms of the tokens (defaults to the ones of toklist)
+        @return a normalized lambda term
+        """
+        if logical_forms is None:
+            logical_forms = [tok.logical_form for tok in toklist]
         idx   = 0  
         stack = [ ]  
         for config,action in derivation:
             if action == None: 
                 break  #deriv is terminated
             elif action.act_type == SRAction.SHIFT:
-                lf = toklist[idx].logical_form.copy()
+                lf = logical_forms[idx]
                 stack.append( lf )
                 idx += 1
             elif action.act_type == SRAction.DROP:
                 idx += 1
             elif action.act_type == SRAction.SHIFT_UNARY:
-                lf = toklist[idx].logical_form.copy()
+                lf = logical_forms[idx]
                 newtop = action.logical_apply(lf,None)
                 stack.append(newtop)
                 idx += 1
@@ -535,17 +794,7 @@ class CCGParser :
                 stack.append(newtop)
                 
         #TODO:that's hacked, find a more elegant solution (combined with ASK) later on
-        query_term = stack[-1].value( ) 
-        
-        #print('query body',query_term.body) 
-        results = query_term.ret_value(ret_type='SELECT',debug=False)
-        #print('**',results,type(results),'**')
-        entitylist = [ ]
-        for assignment in results:
-            if len(assignment) == 1: #factoid question, in principle we cannot have more than 1 var binding
-                var,binding = assignment[0]
-                entitylist.append(binding)
-        return entitylist
+        return evaluate_term(stack[-1]) #the token logical forms are shared, not modified
 
     
     def best_answer(self,K,toklist):
@@ -564,32 +813,70 @@ class CCGParser :
                 return self.make_query(deriv,toklist)
         return [ ]
 
+    def answer_derivations(self,derivations_list,toklist,success):
+        """
+        Computes the answers of the well typed derivations of a beam, their queries are sent concurrently.
+        @param derivations_list : a list of couples (derivation,type)
+        @param toklist : a list of tokens
+        @param success :  a boolean indicating if the parse completed normally or got trapped early
+        @return a list with the answers of each derivation (None for the derivations that are not well typed,
+        a SparqlError for the ones whose query failed)
+        """
+        if not success:
+            self.query_counts = (0,0)
+            return [None] * len(derivations_list)
+        well_typed = [ bool(deriv) and bool(dtype) and len(dtype) == 1 and dtype[0] == 't' for deriv,dtype in derivations_list ]
+        sys.stdout.write('.' * sum(well_typed))
+        sys.stdout.flush()
+        answers = iter(self.make_queries_concurrently([deriv for (deriv,dtype),flag in zip(derivations_list,well_typed) if flag],toklist))
+        return [ next(answers) if flag else None for flag in well_typed ]
+
+    def check_derivations(self,derivations_list,toklist,refset,success):
+        """
+        Tells whether the answers of the derivations of a beam include a correct answer.
+        In 'select' mode the complete answers are fetched (@see answer_derivations), in 'stream' mode
+        the answers are read as they arrive, up to the first correct one, and in 'ask' mode the endpoint
+        answers whether a reference answer is an answer (@see check_queries_async).
+        @param derivations_list : a list of couples (derivation,type)
+        @param toklist : a list of tokens
+        @param refset : the set of correct answers to the question
+        @param success :  a boolean indicating if the parse completed normally or got trapped early
+        @return a list with a boolean for each derivation (False for the ones not well typed)
+        or the SparqlError raised by its query
+        """
+        if self.check_mode == 'select':
+            answers = self.answer_derivations(derivations_list,toklist,success)
+            return [answer if isinstance(answer,SparqlError) else CCGParser.is_correct(answer,refset) for answer in answers]
+        if not success:
+            self.query_counts = (0,0)
+            return [False] * len(derivations_list)
+        well_typed = [ bool(deriv) and bool(dtype) and len(dtype) == 1 and dtype[0] == 't' for deriv,dtype in derivations_list ]
+        sys.stdout.write('.' * sum(well_typed))
+        sys.stdout.flush()
+        derivations = [deriv for (deriv,dtype),flag in zip(derivations_list,well_typed) if flag]
+        if not derivations:
+            self.query_counts = (0,0)
+            return [False] * len(derivations_list)
+        flags = iter(asyncio.run(self.check_queries_async(derivations,toklist,refset)))
+        return [ next(flags) if flag else False for flag in well_typed ]
+
+    @staticmethod
+    def is_correct(answer,refset):
+        """
+        Assess the correctness of a question/answer couple.
+        @param answer : the answer of a derivation, an iterable of entities read up to the first correct one
+        (None if the derivation is not well typed)
+        @param refset : the set of correct answers to the question
+        """
+        if answer is None or isinstance(answer,SparqlError):
+            return False
+        for elt in answer:
+            if elt in refset:
+                return True
+        return False
+
     def eval_one(self,K,toklist,ref_values): 
         #like sgd train except it does eval.
-        def is_correct(toklist,derivation,dtype,refset,success):
-            """
-            Assess the correctness of a question/answer couple.
-            @param toklist : a list of tokens
-            @param derivation : a derivation
-            @param dtype   : the type of the derivation
-            @param refset  : the set of correct answers to the question
-            @param success :  a boolean indicating if the parse completed normally or got trapped early
-            """ 
-            if not derivation or not dtype or not success:
-                return False
-            #checks for type
-            if not (len(dtype) == 1 and dtype[0] == 't'):
-                return False
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            answer = self.make_query(derivation,toklist)
-            print('Ref',refset)
-            print("Answ",answer)
-            for elt in answer:
-                if elt in refset:
-                    return True
-            return False
-        
         final_beam          = self.predict_beam(K,toklist)
         derivations_list    = [self.make_derivation(beam_cell) for beam_cell in final_beam]
         derivations_scores  = [d[-1][0][2] for d,dtype in derivations_list]
@@ -601,7 +888,15 @@ class CCGParser :
                 
         #assess correct / incorrect results
         refset   = set(ref_values)
-        cflags   = [is_correct(toklist,deriv,dtype,refset,len(final_beam) > 0) for deriv,dtype in derivations_list]
+        answers  = self.answer_derivations(derivations_list,toklist,len(final_beam) > 0)
+        for answer in answers:
+            if isinstance(answer,SparqlError):
+                print('Query failed',answer)
+            elif answer is not None:
+                print('Ref',refset)
+                print("Answ",answer)
+        print('%d queries, %d sent (%d saved)'%(self.query_counts[0],self.query_counts[1],self.query_counts[0]-self.query_counts[1]))
+        cflags   = [CCGParser.is_correct(answer,refset) for answer in answers]
 
         for (deriv,dtype),flag,prob in sorted(zip(derivations_list,cflags,derivations_probs),key = lambda x: x[2] , reverse=True):
             return flag
@@ -617,28 +912,6 @@ class CCGParser :
         @param lr : learning rate
         @return the loglikelihood of this example
         """
-        def is_correct(toklist,derivation,dtype,refset,success):
-            """
-            Assess the correctness of a question/answer couple.
-            @param toklist : a list of tokens
-            @param derivation : a derivation
-            @param dtype : the type of the derivation
-            @param refset : the set of correct answers to the question
-            @param success :  a boolean indicating if the parse completed normally or got trapped early
-            """ 
-            if not derivation or not dtype or not success:
-                return False
-            #checks for type
-            if not (len(dtype) == 1 and dtype[0] == 't'):
-                return False
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            answer = self.make_query(derivation,toklist)
-            for elt in answer:
-                if elt in refset:
-                    return True
-            return False
-        
         final_beam          = self.predict_beam(K,toklist)
         derivations_list    = [self.make_derivation(beam_cell) for beam_cell in final_beam]
         derivations_scores  = [d[-1][0][2] for d,dtype in derivations_list]
@@ -650,8 +923,12 @@ class CCGParser :
                 
         #assess correct / incorrect results
         refset   = set([str(val) for val in ref_values])
-        cflags   = [is_correct(toklist,deriv,dtype,refset,len(final_beam) > 0) for deriv,dtype in derivations_list]
-        print('\n')
+        cflags   = self.check_derivations(derivations_list,toklist,refset,len(final_beam) > 0)
+        failures = [flag for flag in cflags if isinstance(flag,SparqlError)]
+        if failures: #the correct derivations are unknown: no update rather than a wrong one
+            print('\nexample skipped, %d queries failed (%s)'%(len(failures),failures[0]))
+            return 0
+        print('\n%d queries, %d sent (%d saved)'%(self.query_counts[0],self.query_counts[1],self.query_counts[0]-self.query_counts[1]))
         #debug
         for (deriv,dtype),flag,prob in sorted(zip(derivations_list,cflags,derivations_probs),key = lambda x: x[2] , reverse=True):
             #print(','.join([str(action) for c,action in deriv]))
@@ -0,0 +1,693 @@
+#!/usr/bin/python
+
+"""
+Module for sending queries to a SPARQL endpoint over persistent HTTP connections.
+"""
+import re
+import json
+import time
+import queue
+import random
+import socket
+import hashlib
+import asyncio
+import threading
+import http.client
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor,Future
+
+
+#string literals are left untouched by normalize_query
+_BLANKS_PATTERN  = re.compile(r'\s+')
+_LITERAL_PATTERN = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')')
+#escape sequences of the TSV results format
+_TSV_ESCAPE_PATTERN = re.compile(r'\\(.)')
+_TSV_ESCAPES        = {'t':'\t','n':'\n','r':'\r'}
+
+def normalize_query(query_string):
+    """
+    Whitespace normalization of a query: runs of blanks outside string literals become a single space.
+    Two queries generated from the same logical form have the same normalized text.
+    @param query_string: a SPARQL query
+    @return a string
+    """
+    pieces = _LITERAL_PATTERN.split(query_string)
+    for idx in range(0,len(pieces),2):  #even pieces are outside literals
+        pieces[idx] = _BLANKS_PATTERN.sub(' ',pieces[idx])
+    return ''.join(pieces).strip()
+
+def parse_tsv_value(cell):
+    """
+    Reads a cell of a SPARQL TSV result
+    @param cell: an RDF term in TSV syntax (<iri>, "literal"@lang, "literal"^^<type>, a number...)
+    @return the value of the term, as in the JSON results format (None for an unbound cell)
+    """
+    if not cell:
+        return None
+    if cell[0] == '<' and cell[-1] == '>':
+        return cell[1:-1]
+    if cell[0] == '"':
+        end = cell.rfind('"')
+        return _TSV_ESCAPE_PATTERN.sub(lambda match:_TSV_ESCAPES.get(match.group(1),match.group(1)),cell[1:end])
+    return cell
+
+def query_fingerprint(query_string):
+    """
+    @param query_string: a SPARQL query
+    @return a stable hexadecimal digest of the normalized query (a compact cache key)
+    """
+    return hashlib.sha1(normalize_query(query_string).encode('utf-8')).hexdigest()
+
+
+class SparqlError(Exception):
+    """
+    Raised when a query fails: the endpoint answers with an error status or an unreadable result
+    (status is the HTTP status) or cannot be reached in time (status is None).
+    """
+    def __init__(self,status,msg,retry_after=None):
+        self.status = status
+        self.msg    = msg
+        self.retry_after = retry_after #delay (in seconds) requested by the endpoint before retrying
+
+    def __str__(self):
+        return 'SPARQL error %s: %s'%(self.status,self.msg)
+
+    @staticmethod
+    def network_error(error,timeout):
+        """
+        @param error: the exception raised while talking to the endpoint
+        @param timeout: the timeout of the query
+        @return the SparqlError reporting it (with status None)
+        """
+        if isinstance(error,socket.timeout):
+            return SparqlError(None,'timeout after %s s'%(timeout,))
+        return SparqlError(None,'%s: %s'%(type(error).__name__,error))
+
+    def is_transient(self):
+        """
+        @return True if the failure is due to the endpoint (unreachable, overloaded, timeout),
+        False if the query itself is rejected: sending it again cannot succeed.
+        """
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class CircuitOpenError(SparqlError):
+    """
+    Raised instead of sending a query while the circuit breaker is open
+    """
+    def __init__(self,msg):
+        super().__init__(None,msg)
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending queries to a failing endpoint.
+    After failure_threshold consecutive transient failures the circuit opens: queries fail
+    immediately during reset_timeout seconds, then a single trial query is let through
+    (half open) whose success closes the circuit and whose failure opens it again.
+    A trial without outcome for reset_timeout seconds (or abandoned) lets another trial through.
+    """
+    CLOSED,OPEN,HALF_OPEN = 'closed','open','half open'
+
+    def __init__(self,failure_threshold=5,reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout     = reset_timeout
+        self.state     = CircuitBreaker.CLOSED
+        self.failures  = 0
+        self.opened_at = 0.0
+        self.lock      = threading.Lock()
+
+    def before_query(self):
+        """
+        @raise SparqlError if the circuit is open
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            now = time.monotonic()
+            if now-self.opened_at >= self.reset_timeout: #open long enough, or the pending trial is stale
+                self.state,self.opened_at = CircuitBreaker.HALF_OPEN,now
+                return
+            raise CircuitOpenError('circuit open: the endpoint failed %d times in a row'%(self.failures,))
+
+    def success(self):
+        with self.lock:
+            self.state,self.failures = CircuitBreaker.CLOSED,0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state,self.opened_at = CircuitBreaker.OPEN,time.monotonic()
+
+    def abandon(self):
+        """
+        A query ended without telling whether the endpoint works (it raised something else than a SparqlError):
+        if it was the trial, another trial is let through
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state,self.opened_at = CircuitBreaker.OPEN,time.monotonic()-self.reset_timeout
+
+
+class TokenBucket(object):
+    """
+    Rate limiter: at most rate queries per second on average, with bursts of at most burst queries.
+    """
+    def __init__(self,rate,burst=1):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = float(burst)
+        self.last   = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until a query can be sent
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,self.tokens+(now-self.last)*self.rate)
+                self.last   = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1-self.tokens)/self.rate
+            time.sleep(wait)
+
+
+class TTLCache(object):
+    """
+    Bounded LRU mapping whose entries expire ttl seconds after they are stored (not thread safe)
+    """
+    def __init__(self,maxsize,ttl):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.entries = OrderedDict() #key -> (expiry date,value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self,key):
+        """
+        @return the value stored for key or None if there is none or if it expired
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self,key,value):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic()+self.ttl,value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class QueryCache(object):
+    """
+    Thread safe cache of query outcomes with three separate stores:
+       positive : results with at least an answer (true, a solution, a non zero count)
+       negative : empty results (false, no solution, zero count) and queries rejected by the endpoint
+       error    : transient failures (timeouts, overloaded endpoint)
+    Each store has its own size and time to live: the negative and error outcomes are kept
+    for a shorter time, so that a hopeless query is not sent (and waited for) again and again.
+    """
+    def __init__(self,maxsize=100000,positive_ttl=86400.0,negative_ttl=3600.0,error_ttl=300.0,negative_size=None,error_size=None):
+        """
+        @param maxsize: max number of positive results
+        @param positive_ttl,negative_ttl,error_ttl: times to live in seconds
+        @param negative_size,error_size: max number of negative outcomes and errors (default: maxsize)
+        """
+        self.positive = TTLCache(maxsize,positive_ttl)
+        self.negative = TTLCache(maxsize if negative_size is None else negative_size,negative_ttl)
+        self.errors   = TTLCache(maxsize if error_size is None else error_size,error_ttl)
+        self.lock     = threading.Lock()
+        self.hits     = {'positive':0,'negative':0,'error':0}
+        self.misses   = 0
+
+    def __str__(self):
+        return 'QueryCache: %d positive, %d negative, %d errors stored; hits %s, %d misses'%(len(self.positive),len(self.negative),len(self.errors),self.hits,self.misses)
+
+    @staticmethod
+    def is_empty(result):
+        """
+        @param result: a dict (SPARQL JSON results format)
+        @return True if the result holds no answer
+        """
+        if 'boolean' in result:
+            return not result['boolean']
+        bindings = result.get('results',{}).get('bindings',[])
+        if len(bindings) == 1 and list(bindings[0]) == ['count']:
+            return bindings[0]['count'].get('value') in ('0',0)
+        return not bindings
+
+    def get(self,query_string):
+        """
+        @return None if the outcome of the query is not known, the result (a dict) otherwise
+        @raise the SparqlError of the query if it failed
+        """
+        with self.lock:
+            for kind,store in (('positive',self.positive),('negative',self.negative),('error',self.errors)):
+                outcome = store.get(query_string)
+                if outcome is not None:
+                    self.hits[kind] += 1
+                    break
+            else:
+                self.misses += 1
+                return None
+        if isinstance(outcome,SparqlError):
+            raise outcome
+        return outcome
+
+    def add_result(self,query_string,result):
+        with self.lock:
+            (self.negative if QueryCache.is_empty(result) else self.positive).put(query_string,result)
+
+    def add_error(self,query_string,error):
+        """
+        Stores a failure: rejected queries are negative outcomes, endpoint failures are errors.
+        The circuit breaker errors are not stored (they are not related to the query).
+        """
+        if isinstance(error,CircuitOpenError):
+            return
+        with self.lock:
+            (self.errors if error.is_transient() else self.negative).put(query_string,error)
+
+
+class SparqlClient(object):
+    """
+    Thread safe client for a SPARQL endpoint (SPARQL 1.1 protocol, JSON results).
+    Idle connections are kept alive in a pool and reused by the next queries,
+    at most max_concurrency queries are sent at the same time.
+    A query asked while the same query (same text) is in flight is not sent again:
+    it waits for the pending one and gets the same result (single flight).
+
+    Transient failures (@see SparqlError.is_transient) are retried after a jittered exponential
+    backoff, each retry doubling the timeout (up to max_timeout). A circuit breaker stops querying
+    an endpoint that keeps failing and an optional token bucket limits the query rate.
+    An optional QueryCache stores the outcomes of the queries.
+    """
+    USER_AGENT = 'semparsing/1.0 (python http.client)'
+    DRAIN_SIZE = 1 << 20 #max number of bytes read from the rest of a closed stream to reuse its connection
+
+    def __init__(self,endpoint,max_connections=8,max_concurrency=8,timeout=None,\
+                 retries=2,backoff=0.5,max_backoff=8.0,max_timeout=60.0,\
+                 failure_threshold=5,reset_timeout=30.0,rate=None,burst=1,cache=None):
+        """
+        @param endpoint: the URL of the endpoint (http or https)
+        @param max_connections: max number of idle connections kept open
+        @param max_concurrency: max number of queries in flight
+        @param timeout: default timeout of the queries in seconds (None for no timeout)
+        @param retries: max number of retries of a query after a transient failure
+        @param backoff: base delay (in seconds) before a retry, doubled at each retry
+        @param max_backoff: max delay before a retry
+        @param max_timeout: max timeout of a retried query
+        @param failure_threshold: number of consecutive failures opening the circuit breaker
+        @param reset_timeout: time (in seconds) the circuit stays open
+        @param rate: max number of queries per second (None for no limit)
+        @param burst: max number of queries sent at once when the rate is limited
+        @param cache: a QueryCache or None
+        """
+        url = urllib.parse.urlsplit(endpoint)
+        self.endpoint = endpoint
+        self.host     = url.netloc
+        self.path     = url.path if url.path else '/'
+        self.conn_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.timeout  = timeout
+        self.idle     = queue.LifoQueue(maxsize=max_connections)
+        self.slots    = threading.BoundedSemaphore(max_concurrency)
+        self.stats_lock = threading.Lock()
+        self.executor   = ThreadPoolExecutor(max_workers=max_concurrency,thread_name_prefix='sparql') #runs query_async
+        self.in_flight  = {}  #query string -> Future of the query being sent
+        self.retries,self.backoff,self.max_backoff,self.max_timeout = retries,backoff,max_backoff,max_timeout
+        self.breaker    = CircuitBreaker(failure_threshold,reset_timeout)
+        self.bucket     = TokenBucket(rate,burst) if rate else None
+        self.cache      = cache
+        self.nretries     = 0 #number of retries
+        self.nfailures    = 0 #number of queries failed (after the retries)
+        self.nqueries     = 0 #number of queries sent
+        self.nshared      = 0 #number of queries answered by a query in flight
+        self.nconnections = 0 #number of connections opened so far
+
+    def __str__(self):
+        stats = 'SparqlClient(%s): %d queries sent, %d shared, %d retries, %d failures, %d connections opened'%(self.endpoint,self.nqueries,self.nshared,self.nretries,self.nfailures,self.nconnections)
+        return stats if self.cache is None else stats + '\n' + str(self.cache)
+
+    def get_connection(self):
+        """
+        @return an idle connection or a new one if the pool is empty
+        """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            with self.stats_lock:
+                self.nconnections += 1
+            return self.conn_class(self.host)
+
+    def release_connection(self,conn):
+        """
+        Puts back a connection in the pool (or closes it if the pool is full)
+        """
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """
+        Closes the idle connections and stops the worker threads of query_async once their queries are done
+        """
+        self.executor.shutdown(wait=False)
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def query(self,query_string,timeout=None):
+        """
+        Sends a query and returns its decoded JSON result, unless its outcome is cached or the
+        same query is already in flight: then this waits for it and returns the same result
+        object (not to be modified).
+        @param query_string: a SPARQL query
+        @param timeout: timeout in seconds (defaults to the client timeout)
+        @return a dict (SPARQL JSON results format)
+        @raise SparqlError if the query fails (after the retries for transient failures)
+        """
+        result,flight,leader = self.lookup(query_string)
+        if result is not None:
+            return result
+        if not leader:
+            return flight.result()
+        return self.lead(query_string,flight,timeout)
+
+    def lookup(self,query_string):
+        """
+        Looks up the outcome of a query in the cache, then among the queries in flight.
+        When the query is neither cached nor in flight, the caller becomes the leader of its flight:
+        it must send the query with lead, or end the flight with complete.
+        @param query_string: a SPARQL query
+        @return a triple (result,flight,leader): the cached result (or None), the Future of the
+        query in flight (or None) and True if the caller leads the flight
+        @raise the cached SparqlError of the query if it failed
+        """
+        if self.cache is not None:
+            result = self.cache.get(query_string)
+            if result is not None:
+                return result,None,False
+        with self.stats_lock:
+            flight = self.in_flight.get(query_string)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[query_string] = Future()
+            else:
+                self.nshared += 1
+        return None,flight,leader
+
+    def lead(self,query_string,flight,timeout=None):
+        """
+        Sends a query whose flight the caller leads (@see lookup) and ends the flight
+        @param flight: the Future of the query
+        @param timeout: timeout in seconds (defaults to the client timeout)
+        @return a dict (SPARQL JSON results format)
+        @raise SparqlError if the query fails (after the retries for transient failures)
+        """
+        try:
+            result = self.send_with_retries(query_string,timeout)
+        except BaseException as e:
+            self.complete(query_string,flight,error=e)
+            raise
+        self.complete(query_string,flight,result)
+        return result
+
+    def complete(self,query_string,flight,result=None,error=None,cache=True):
+        """
+        Ends the flight of a query: stores its outcome in the cache and passes it to the queries waiting for it
+        @param flight: the Future of the query (@see lookup)
+        @param result: a dict (SPARQL JSON results format) if the query succeeded
+        @param error: the exception raised by the query otherwise
+        @param cache: False not to cache the outcome
+        """
+        if cache and self.cache is not None:
+            if error is None:
+                self.cache.add_result(query_string,result)
+            elif isinstance(error,SparqlError):
+                self.cache.add_error(query_string,error)
+        if error is None:
+            flight.set_result(result)
+        else:
+            flight.set_exception(error)
+        with self.stats_lock:
+            del self.in_flight[query_string]
+
+    def stream(self,query_string,timeout=None):
+        """
+        Sends a SELECT query asking for TSV results and yields its solutions as they are read
+        from the connection. A consumer stopping early must close the generator (close() or contextlib.closing):
+        the rest of the body (up to DRAIN_SIZE bytes) is then drained and the connection put back in the pool.
+        A slot is held while a request is sent and its response header read, not during the retry delays
+        nor while the solutions are read.
+        The streamed queries are not shared and only their failures are cached (the cached results
+        are read though), they are retried after transient failures as long as no solution has been read.
+        @param query_string: a SPARQL query
+        @param timeout: timeout in seconds (defaults to the client timeout)
+        @return a generator of dicts var -> value (the unbound variables are missing)
+        @raise SparqlError if the query fails
+        """
+        if self.cache is not None:
+            result = self.cache.get(query_string)
+            if result is not None:
+                for row in result['results']['bindings']:
+                    yield dict([(var,binding['value']) for var,binding in row.items()])
+                return
+        try:
+            conn,response = self.send_with_retries(query_string,timeout,self.open_stream)
+        except SparqlError as e:
+            if self.cache is not None:
+                self.cache.add_error(query_string,e)
+            raise
+        complete = False
+        try:
+            variables = None
+            for line in SparqlClient.read_lines(response):
+                cells = line.split('\t')
+                if variables is None:
+                    variables = [var.lstrip('?$') for var in cells]
+                    continue
+                yield dict([(var,parse_tsv_value(cell)) for var,cell in zip(variables,cells) if cell])
+            response.read() #marks the response as complete
+            complete = True
+        except GeneratorExit:
+            complete = SparqlClient.drain(response,self.DRAIN_SIZE)
+            raise
+        except (OSError,http.client.HTTPException) as e:
+            raise SparqlError.network_error(e,timeout)
+        finally:
+            if complete and not response.will_close:
+                self.release_connection(conn)
+            else:
+                conn.close()
+
+    @staticmethod
+    def drain(response,max_size,chunk_size=65536):
+        """
+        Reads and discards the rest of the body of a response, so that its connection can be reused
+        @param max_size: max number of bytes read (the connection of a longer body is not worth reusing)
+        @return True if the body has been read completely
+        """
+        size = 0
+        try:
+            while size <= max_size:
+                chunk = response.read1(chunk_size)
+                if not chunk:
+                    response.read() #marks the response as complete
+                    return True
+                size += len(chunk)
+        except (OSError,http.client.HTTPException):
+            pass
+        return False
+
+    @staticmethod
+    def read_lines(response,chunk_size=65536):
+        """
+        Reads the body of a response by chunks (faster than line by line)
+        @return a generator of the lines of the body, decoded and without end of line
+        """
+        pending = b''
+        while True:
+            chunk = response.read1(chunk_size)
+            if not chunk:
+                break
+            lines   = (pending+chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8').rstrip('\r')
+        if pending:
+            yield pending.decode('utf-8').rstrip('\r')
+
+    def open_stream(self,query_string,timeout=None):
+        """
+        Sends a query asking for TSV results, holding a slot until the response header is read (@see stream)
+        @return a couple (connection,response) whose body is still to be read
+        @raise SparqlError
+        """
+        with self.slots:
+            with self.stats_lock:
+                self.nqueries += 1
+            conn,response = self.send_request(query_string,timeout,'text/tab-separated-values')
+            if response.status != 200:
+                try:
+                    data = response.read()
+                except (OSError,http.client.HTTPException) as e:
+                    conn.close()
+                    raise SparqlError.network_error(e,timeout)
+                self.finish_response(conn,response)
+        if response.status != 200:
+            SparqlClient.check_status(response,data)
+        return conn,response
+
+    def send_with_retries(self,query_string,timeout=None,send=None):
+        """
+        Sends a query, retrying it after transient failures
+        @param query_string: a SPARQL query
+        @param timeout: timeout of the first attempt in seconds (defaults to the client timeout)
+        @param send: the function sending the query once (defaults to send_query)
+        @return a dict (SPARQL JSON results format) or what send returns
+        @raise SparqlError
+        """
+        send    = self.send_query if send is None else send
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.retries+1):
+            try:
+                self.breaker.before_query()
+                if self.bucket:
+                    self.bucket.acquire()
+                deadline = None if timeout is None else min(timeout * 2**attempt,self.max_timeout)
+                result   = send(query_string,deadline)
+                self.breaker.success()
+                return result
+            except CircuitOpenError as e:
+                error = e
+                break
+            except SparqlError as e:
+                error = e
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            if not error.is_transient():
+                self.breaker.success() #the endpoint answered
+                break
+            self.breaker.failure()
+            if attempt == self.retries:
+                break
+            with self.stats_lock:
+                self.nretries += 1
+            delay = random.uniform(0,min(self.max_backoff,self.backoff * 2**attempt)) #full jitter
+            time.sleep(max(delay,error.retry_after or 0))
+        with self.stats_lock:
+            self.nfailures += 1
+        raise error
+
+    def send_query(self,query_string,timeout=None):
+        """
+        Sends a query once and returns its decoded JSON result.
+        A query failing on a connection reused from the pool (closed by the server meanwhile)
+        is sent again once on a new connection.
+        @param query_string: a SPARQL query
+        @param timeout: timeout in seconds (defaults to the client timeout)
+        @return a dict (SPARQL JSON results format)
+        @raise SparqlError (with status None if the endpoint cannot be reached in time)
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self.slots:
+            with self.stats_lock:
+                self.nqueries += 1
+            conn,response = self.send_request(query_string,timeout,'application/sparql-results+json')
+            try:
+                data = response.read()
+            except (OSError,http.client.HTTPException) as e:
+                conn.close()
+                raise SparqlError.network_error(e,timeout)
+            self.finish_response(conn,response)
+        SparqlClient.check_status(response,data)
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise SparqlError(response.status,'unreadable result %s'%(data[:200],))
+
+    def send_request(self,query_string,timeout,accept):
+        """
+        Sends a query on a pooled connection, once more on a new connection if the pooled one
+        was closed by the server meanwhile.
+        @param query_string: a SPARQL query
+        @param timeout: timeout in seconds
+        @param accept: the requested results format (a MIME type)
+        @return a couple (connection,response) whose body is still to be read
+        @raise SparqlError (with status None) if the endpoint cannot be reached in time
+        """
+        body    = urllib.parse.urlencode({'query':query_string}).encode('utf-8')
+        headers = {'Content-Type':'application/x-www-form-urlencoded',
+                   'Accept':accept,
+                   'User-Agent':SparqlClient.USER_AGENT}
+        for attempt in range(2):
+            conn = self.get_connection()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                conn.request('POST',self.path,body,headers)
+                return conn,conn.getresponse()
+            except (http.client.RemoteDisconnected,http.client.CannotSendRequest,ConnectionResetError,BrokenPipeError) as e:
+                conn.close()
+                if attempt == 0:
+                    continue
+                raise SparqlError(None,'connection lost: %s'%(e,))
+            except (OSError,http.client.HTTPException) as e:
+                conn.close()
+                raise SparqlError.network_error(e,timeout)
+
+    def finish_response(self,conn,response):
+        """
+        Puts back the connection of a response read completely in the pool
+        """
+        if response.will_close:
+            conn.close()
+        else:
+            self.release_connection(conn)
+
+    @staticmethod
+    def check_status(response,data):
+        """
+        @param data: the body of the response
+        @raise SparqlError if the response has an error status
+        """
+        if response.status != 200:
+            retry_after = response.getheader('Retry-After')
+            retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+            raise SparqlError(response.status,data[:200].decode('utf-8','replace'),retry_after)
+
+    async def query_async(self,query_string,timeout=None):
+        """
+        Coroutine version of query: the query is sent by a worker thread of the client,
+        at most max_concurrency queries are sent at the same time, the others wait for a slot.
+        The cache and the queries in flight are looked up by the coroutine: a query answered by another
+        flight waits for it without taking a worker thread.
+        @param query_string: a SPARQL query
+        @param timeout: timeout in seconds (defaults to the client timeout)
+        @return a dict (SPARQL JSON results format)
+        """
+        result,flight,leader = self.lookup(query_string)
+        if result is not None:
+            return result
+        if not leader:
+            return await asyncio.wrap_future(flight)
+        return await asyncio.get_running_loop().run_in_executor(self.executor,self.lead,query_string,flight,timeout)
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+"""
+Orders the elements of the graph patterns generated by the wikidata model by estimated selectivity.
+
+The estimates come from the statistics of the knowledge base:
+   property statistics    for each property, its number of claims, distinct subjects and distinct objects
+                          (a TSV file: Pxx count subjects objects, computed from a local TripleStore)
+   entity PageRank        the file written by songnan/calculate_pr.py (calculate_pagerank): Qxx score
+Without statistics, the planner still puts the constants (BINDs) first and prefers the triples
+connected to the variables already bound.
+"""
+import re
+
+
+class QueryPlanner(object):
+    """
+    Greedy planner: picks the element with the lowest estimated number of solutions
+    given the variables bound by the elements already placed, until all are placed.
+    The elements it cannot read (UNION blocks...) keep their relative order after the others.
+    """
+    BIND_PATTERN   = re.compile(r'^\s*BIND\((\S+) AS (\?\w+)\)\s*$')
+    TRIPLE_PATTERN = re.compile(r'^\s*(\S+) (\S+) (\S+) \.\s*$')
+    DEFAULT_STATS  = (1000000,100000,100000) #(claims,subjects,objects) of a property without statistics
+    MIN_FACTOR     = 0.01                     #entity factor of an entity absent from the PageRank table
+
+    def __init__(self,property_stats=None,pageranks=None):
+        """
+        @param property_stats: a dict property ID (Pxx) -> (claims,subjects,objects) or None
+        @param pageranks: a dict entity ID (Qxx) -> PageRank score or None
+        """
+        self.property_stats = property_stats
+        self.pageranks      = pageranks
+        self.mean_rank      = sum(pageranks.values())/len(pageranks) if pageranks else None
+
+    def __str__(self):
+        return 'QueryPlanner: %d property stats, %d pageranks'%(len(self.property_stats or ()),len(self.pageranks or ()))
+
+    def has_statistics(self):
+        """
+        @return true if the estimates depend on the IDs of the entities and properties
+        """
+        return self.property_stats is not None or self.pageranks is not None
+
+    @staticmethod
+    def parse_element(pattern):
+        """
+        @param pattern: an element of a group pattern (a string)
+        @return ('bind',term,var), ('triple',s,p,o) or ('other',vars) where vars are the variables occurring in the pattern
+        """
+        match = QueryPlanner.BIND_PATTERN.match(pattern)
+        if match:
+            return ('bind',match.group(1),match.group(2))
+        match = QueryPlanner.TRIPLE_PATTERN.match(pattern)
+        if match:
+            return ('triple',match.group(1),match.group(2),match.group(3))
+        return ('other',set(re.findall(r'\?\w+',pattern)))
+
+    def get_property_stats(self,prop):
+        """
+        @param prop: a property (wdt:Pxx) or a variable
+        @return (claims,subjects,objects) for this property, DEFAULT_STATS if it has no statistics
+        (the statistics may come from a partial store while the queries are sent to the endpoint)
+        """
+        if self.property_stats is None or prop.startswith('?') or '$' in prop: #template parameters have no statistics
+            return QueryPlanner.DEFAULT_STATS
+        return self.property_stats.get(prop.split(':')[-1],QueryPlanner.DEFAULT_STATS)
+
+    def entity_factor(self,term):
+        """
+        Scales the number of claims of an entity w.r.t. the average entity (PageRank correlates with the degree)
+        @param term: a constant (wd:Qxx)
+        @return a positive float
+        """
+        if self.pageranks is None or '$' in term:
+            return 1.0
+        return max(QueryPlanner.MIN_FACTOR,self.pageranks.get(term.split(':')[-1],0.0)/self.mean_rank)
+
+    def cost(self,element,bound):
+        """
+        Estimates the number of solutions of an element given the variables bound
+        @param element: a parsed element (@see parse_element)
+        @param bound: a dict var -> constant the var is bound to (or None)
+        @return a float
+        """
+        if element[0] == 'bind':
+            return 0.0
+        if element[0] == 'other':
+            return float('inf')
+        _,subj,prop,obj = element
+        claims,subjects,objects = self.get_property_stats(prop)
+        known = [ ]
+        for term in (subj,obj):
+            if not term.startswith('?'):
+                known.append(term)
+            elif term in bound:
+                known.append(bound[term])
+            else:
+                known.append(False)
+        if known[0] is not False and known[1] is not False:
+            return min(1.0,claims)
+        if known[0] is not False:
+            return claims/max(subjects,1) * (self.entity_factor(known[0]) if known[0] else 1.0)
+        if known[1] is not False:
+            return claims/max(objects,1) * (self.entity_factor(known[1]) if known[1] else 1.0)
+        return float(claims)
+
+    def order(self,patterns):
+        """
+        @param patterns: the elements of a group pattern (strings) in derivation order
+        @return the same elements, in evaluation order
+        """
+        return [patterns[idx] for idx in self.plan(patterns)]
+
+    def plan(self,patterns):
+        """
+        @param patterns: the elements of a group pattern (strings) in derivation order
+        @return the indexes of the elements, in evaluation order (a tuple)
+        """
+        if len(patterns) < 2:
+            return tuple(range(len(patterns)))
+        remaining = [(idx,QueryPlanner.parse_element(pattern)) for idx,pattern in enumerate(patterns)]
+        bound,plan = { },[ ]
+        while remaining:
+            best = min(remaining,key=lambda item:(self.cost(item[1],bound),item[0]))
+            remaining.remove(best)
+            plan.append(best[0])
+            element = best[1]
+            if element[0] == 'bind':
+                bound[element[2]] = element[1]
+            elif element[0] == 'triple':
+                for term in (element[1],element[3]):
+                    if term.startswith('?'):
+                        bound.setdefault(term,None)
+            else:
+                for var in element[1]:
+                    bound.setdefault(var,None)
+        return tuple(plan)
+
+    @staticmethod
+    def stats_from_store(store):
+        """
+        Computes the property statistics of a local triple store
+        @param store: a TripleStore
+        @return a dict property ID -> (claims,subjects,objects)
+        """
+        props,objs,subjs = store.index['pos']
+        stats,lo,N = { },0,len(props)
+        while lo < N:
+            prop,hi = props[lo],lo
+            nobjects,last = 0,None
+            while hi < N and props[hi] == prop:
+                if objs[hi] != last:
+                    nobjects,last = nobjects+1,objs[hi]
+                hi += 1
+            stats[store.name(prop)] = (hi-lo,len(set(subjs[lo:hi])),nobjects)
+            lo = hi
+        return stats
+
+    @staticmethod
+    def save_property_stats(stats,filename):
+        ostream = open(filename,'w')
+        for prop,(claims,subjects,objects) in sorted(stats.items()):
+            print(prop,claims,subjects,objects,sep='\t',file=ostream)
+        ostream.close()
+
+    @staticmethod
+    def load_property_stats(filename):
+        """
+        @param filename: a file written by save_property_stats
+        @return a dict property ID -> (claims,subjects,objects)
+        """
+        stats = { }
+        istream = open(filename)
+        for line in istream:
+            prop,claims,subjects,objects = line.split()
+            stats[prop] = (int(claims),int(subjects),int(objects))
+        istream.close()
+        return stats
+
+    @staticmethod
+    def load_pageranks(filename):
+        """
+        @param filename: a PageRank file (one 'Qxx score' line per entity)
+        @return a dict entity ID -> PageRank score
+        """
+        pageranks = { }
+        istream = open(filename)
+        for line in istream:
+            fields = line.split()
+            if len(fields) == 2:
+                pageranks[fields[0]] = float(fields[1])
+        istream.close()
+        return pageranks
+
+    @staticmethod
+    def from_files(stats_filename=None,pagerank_filename=None):
+        """
+        @return a planner using the statistics stored in these files (None for the missing ones)
+        """
+        stats     = QueryPlanner.load_property_stats(stats_filename) if stats_filename else None
+        pageranks = QueryPlanner.load_pageranks(pagerank_filename) if pagerank_filename else None
+        return QueryPlanner(stats,pageranks)
+
+
+if __name__ == '__main__':
+    import sys
+    from triple_store import TripleStore
+
+    if len(sys.argv) != 3:
+        print('usage: python sparql_planner.py INDEX_DIR STATS_FILE')
+        sys.exit(1)
+    store = TripleStore(sys.argv[1])
+    QueryPlanner.save_property_stats(QueryPlanner.stats_from_store(store),sys.argv[2])
+    store.close()
@@ -0,0 +1,67 @@
+"""
+Fixtures shared by the tests: stand-in endpoints, local triple stores and the wikidata query config.
+"""
+import pytest
+
+from wikidata_model import WikidataQuery
+from triple_store import TripleStore
+from semparser import make_logical_parser
+from tests.sparql_server import LocalSparqlServer
+
+
+@pytest.fixture
+def make_server():
+    """
+    @return a function (answer_function,delay=0.0) -> a running LocalSparqlServer, stopped after the test
+    """
+    servers = [ ]
+    def make(answer_function,delay=0.0):
+        server = LocalSparqlServer(answer_function,delay=delay)
+        servers.append(server)
+        return server
+    yield make
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def wikidata_config():
+    """
+    Restores the config of WikidataQuery after the test (the tests point it to stand-in endpoints)
+    """
+    names = ['ENDPOINT','CACHE_SIZE','CACHE_TTLS','PLANNER','BATCH_SIZE','RETRIES','CLIENT']
+    saved = dict([(name,getattr(WikidataQuery,name)) for name in names])
+    WikidataQuery.CLIENT = None
+    yield WikidataQuery
+    if WikidataQuery.CLIENT is not None:
+        WikidataQuery.CLIENT.close()
+    for name,value in saved.items():
+        setattr(WikidataQuery,name,value)
+
+
+#mountains (P31 Q8502) with their elevation (P2044) and country (P17)
+TRIPLES = [('Q1','P31','Q8502'),('Q2','P31','Q8502'),('Q3','P31','Q8502'),('Q4','P31','Q5'),\
+           ('Q1','P2044','8848'),('Q2','P2044','4808.7'),('Q3','P2044','8611'),('Q4','P2044','9999'),\
+           ('Q2','P17','Q142'),('Q3','P17','Q142'),('Q1','P17','Q837')]
+
+@pytest.fixture
+def store(tmp_path):
+    store = TripleStore.build(TRIPLES,str(tmp_path))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def endpoint(store,make_server,wikidata_config):
+    """
+    A stand-in endpoint answering from the local store, used by WikidataQuery (without cache)
+    """
+    server = make_server(store.query)
+    wikidata_config.ENDPOINT   = server.endpoint
+    wikidata_config.CACHE_SIZE = 0
+    return server
+
+
+@pytest.fixture
+def logical_parser():
+    return make_logical_parser()
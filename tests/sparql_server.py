@@ -0,0 +1,118 @@
+"""
+Stand-in SPARQL endpoint for the tests and the benchmarks of the query layer.
+"""
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+from sparql_client import SparqlError
+
+
+class LocalSparqlServer(object):
+    """
+    A stand-in SPARQL endpoint running in a background thread on localhost.
+    The answers are computed by a python function of the query string, this is meant for
+    testing and benchmarking the query layer without a network.
+    """
+    def __init__(self,answer_function,delay=0.0,port=0):
+        """
+        @param answer_function: a function query_string -> dict (a SPARQL JSON result),
+        raising a SparqlError makes the server answer with its status
+        @param delay: time (in seconds) spent on each query by the server
+        @param port: the port to listen on (0 picks a free port)
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' #keep-alive
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (ConnectionResetError,BrokenPipeError): #the client closed the connection (stopped reading)
+                    pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length',0))
+                query_string = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))['query'][0]
+                self.send_answer(query_string)
+
+            def do_GET(self):
+                query_string = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)['query'][0]
+                self.send_answer(query_string)
+
+            def send_answer(self,query_string):
+                with server.lock:
+                    server.queries.append(query_string)
+                if server.delay:
+                    threading.Event().wait(server.delay)
+                ctype = 'application/sparql-results+json'
+                try:
+                    result = server.answer_function(query_string)
+                    if 'text/tab-separated-values' in self.headers.get('Accept','') and 'results' in result:
+                        status,ctype,data = 200,'text/tab-separated-values',LocalSparqlServer.to_tsv(result).encode('utf-8')
+                    else:
+                        status,data = 200,json.dumps(result).encode('utf-8')
+                except SparqlError as e: #the answer function decides of the error status
+                    status,data = e.status,str(e).encode('utf-8')
+                except Exception as e:
+                    status,data = 400,str(e).encode('utf-8')
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type',ctype)
+                    self.send_header('Content-Length',str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError,ConnectionResetError): #the client gave up (timeout)
+                    self.close_connection = True
+
+            def log_message(self,format,*args):
+                pass
+
+        self.answer_function = answer_function
+        self.delay   = delay
+        self.queries = []   #queries received so far
+        self.lock    = threading.Lock()
+        self.httpd   = ThreadingHTTPServer(('127.0.0.1',port),Handler)
+        self.httpd.daemon_threads = True
+        self.endpoint = 'http://127.0.0.1:%d/sparql'%(self.httpd.server_address[1],)
+        self.thread  = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """
+        Stops the server
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def to_tsv(result):
+        """
+        @param result: a dict (SPARQL JSON results format) with bindings
+        @return the result in the TSV results format
+        """
+        def term(binding):
+            value = binding['value']
+            if binding['type'] == 'uri':
+                return '<%s>'%(value,)
+            value = '"%s"'%(value.replace('\\','\\\\').replace('"','\\"').replace('\t','\\t').replace('\n','\\n').replace('\r','\\r'),)
+            if 'xml:lang' in binding:
+                return '%s@%s'%(value,binding['xml:lang'])
+            if 'datatype' in binding:
+                return '%s^^<%s>'%(value,binding['datatype'])
+            return value
+        variables = result['head'].get('vars',[])
+        lines = ['\t'.join(['?'+var for var in variables])]
+        for row in result['results']['bindings']:
+            lines.append('\t'.join([term(row[var]) if var in row else '' for var in variables]))
+        return '\n'.join(lines)+'\n'
+
+    @staticmethod
+    def ask_answer(value=True):
+        """
+        @return an answer function answering every query with the boolean value
+        """
+        return lambda query_string: {'head':{},'boolean':value}
@@ -0,0 +1,28 @@
+"""
+Lambda terms of parametrized size shared by the tests and the benchmarks.
+"""
+from functional_core import *
+
+
+def make_conjunction(parser,N,normal_form=True):
+    """
+    Builds the closed formula (exists (x:e) (and (wd:Q1 x) (and (wd:Q2 x) ... (wd:QN x))))
+    either in normal form (3N nodes) or as the application tree output by the parser (7N nodes)
+    @return a lambda term
+    """
+    names = parser.naming_context
+
+    def atom(idx):
+        pred = names['wd:Q%d'%(idx,)]
+        var  = LambdaVariable('x',ttype=(TypeSystem.DB_ENTITY,),db_index=1)
+        if not normal_form:
+            return LambdaApplication(pred,var)
+        return pred.set_args([var])
+
+    body = atom(N)
+    for idx in range(N-1,0,-1):
+        if normal_form:
+            body = names['and'].copy().set_args([atom(idx),body])
+        else:
+            body = LambdaApplication(LambdaApplication(names['and'].copy(),atom(idx)),body)
+    return ExistentialQuantifier('x',(TypeSystem.DB_ENTITY,),body)
@@ -0,0 +1,62 @@
+"""
+Tests of the parse cache of the lambda parser and of the batch evaluator.
+"""
+import io
+import json
+import pickle
+
+import pytest
+
+from functional_core import *
+from lambda_parser import FuncParser,BatchEvaluator,SnapshotError,load_defines,load_naming_context
+
+
+def test_db_identifiers_are_copies():
+    names  = NamingContext.make_std_builtins_context()
+    parser = FuncParser(names)
+    names['wd:Q1'] = parser.parse_code('(lambda (x:e) (x x))')
+    term = parser.parse_code('wd:Q1')
+    assert term is not names['wd:Q1'] and equal_terms(term,names['wd:Q1'])
+    assert parser.parse_code(' wd:Q1 ') is not term
+
+
+def test_cached_terms_are_copies(logical_parser):
+    term = logical_parser.parse_code('(lambda (P:e=>t) (@exists (x:e) (P x)))')
+    assert logical_parser.parse_code('(lambda (P:e=>t) (@exists (x:e) (P x)))') is not term
+    pred = logical_parser.parse_code('wd:Q5')
+    pred.set_args([LambdaVariable('x',ttype=(TypeSystem.DB_ENTITY,),db_index=1)])
+    assert logical_parser.parse_code('wd:Q5').nargs == 1
+
+
+def test_syntax_errors_are_not_cached(logical_parser):
+    logical_parser.report_errors = False
+    errors = logical_parser.syntax_errors
+    assert logical_parser.parse_code('((wd:Q5 x))) (wd:Q6 x)') is not None #a partial term after error recovery
+    assert logical_parser.syntax_errors == errors+1
+    assert not any(code == '((wd:Q5 x))) (wd:Q6 x)' for code,version in logical_parser.parse_cache)
+
+
+def test_batch_evaluator_keeps_the_input_order():
+    evaluator = BatchEvaluator(workers=2)
+    ostream   = io.StringIO()
+    lines     = ['(define F (lambda (x:e) x))','(F 1','# comment','(lambda (x:e) x)']
+    assert evaluator.run(io.StringIO('\n'.join(lines)),ostream) == (3,1)
+    records = [json.loads(line) for line in ostream.getvalue().splitlines()]
+    assert [record['line'] for record in records] == [1,2,4]
+    assert records[0]['define'] == 'F' and 'error' in records[1] and 'value' in records[2]
+
+
+def test_snapshots_reload_the_defines(tmp_path):
+    source,snapshot = tmp_path/'defines.txt',tmp_path/'defines.pkl'
+    source.write_text('(define F (lambda (x:e) x))\n# comment\n(define G (lambda (P:e=>t) (lambda (x:e) (P x))))\n')
+    defines = load_defines(str(source),FuncParser(NamingContext.make_std_builtins_context()),progress=None,snapshot=str(snapshot))
+    names   = load_naming_context(str(snapshot),source=str(source))
+    assert sorted(defines) == ['F','G']
+    assert all(equal_terms(names[name],term) for name,term in defines.items())
+
+    source.write_text('(define F (lambda (x:e) (x x)))\n')
+    with pytest.raises(SnapshotError):
+        load_naming_context(str(snapshot),source=str(source))
+    snapshot.write_bytes(pickle.dumps(names)) #a snapshot without header
+    with pytest.raises(SnapshotError):
+        load_naming_context(str(snapshot))
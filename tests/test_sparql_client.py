@@ -0,0 +1,242 @@
+"""
+Tests of the SPARQL client: connection pool, single flight, retries, circuit breaker, cache and streaming.
+"""
+import time
+import asyncio
+import threading
+
+import pytest
+
+from sparql_client import SparqlClient,SparqlError,CircuitOpenError,CircuitBreaker,QueryCache,TTLCache,normalize_query,parse_tsv_value
+from tests.sparql_server import LocalSparqlServer
+
+
+def select_result(values):
+    return {'head':{'vars':['x']},'results':{'bindings':[{'x':{'type':'uri','value':'http://www.wikidata.org/entity/'+value}} for value in values]}}
+
+
+def flaky(failures,status=503):
+    """
+    @return an answer function failing with status the first failures times, then answering true
+    """
+    calls = [0]
+    def answer(query_string):
+        calls[0] += 1
+        if calls[0] <= failures:
+            raise SparqlError(status,'failure %d'%(calls[0],))
+        return {'head':{},'boolean':True}
+    return answer
+
+
+def test_normalize_query_keeps_literals():
+    assert normalize_query(' ASK  {\n ?x  ?p "a  b" }\n') == 'ASK { ?x ?p "a  b" }'
+
+
+def test_connections_are_kept_alive(make_server):
+    server = make_server(LocalSparqlServer.ask_answer(True))
+    client = SparqlClient(server.endpoint)
+    for idx in range(5):
+        assert client.query('ASK { ?x ?p %d }'%(idx,))['boolean'] is True
+    assert client.nqueries == 5
+    assert client.nconnections == 1
+
+
+def test_identical_queries_share_one_request(make_server):
+    server  = make_server(LocalSparqlServer.ask_answer(True),delay=0.2)
+    client  = SparqlClient(server.endpoint)
+    results = [ ]
+    threads = [threading.Thread(target=lambda: results.append(client.query('ASK { ?x ?p ?y }'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 4 and all(result['boolean'] for result in results)
+    assert len(server.queries) == 1
+    assert client.nshared == 3
+
+
+def test_transient_failures_are_retried(make_server):
+    server = make_server(flaky(2))
+    client = SparqlClient(server.endpoint,retries=2,backoff=0.01)
+    assert client.query('ASK { ?x ?p ?y }')['boolean'] is True
+    assert len(server.queries) == 3
+    assert client.nretries == 2 and client.nfailures == 0
+
+
+def test_rejected_queries_are_not_retried(make_server):
+    server = make_server(flaky(10,status=400))
+    client = SparqlClient(server.endpoint,retries=2,backoff=0.01)
+    with pytest.raises(SparqlError) as error:
+        client.query('ASK { ?x ?p ?y }')
+    assert error.value.status == 400 and not error.value.is_transient()
+    assert len(server.queries) == 1
+
+
+def test_circuit_breaker_opens(make_server):
+    server = make_server(flaky(10))
+    client = SparqlClient(server.endpoint,retries=0,failure_threshold=2,reset_timeout=60.0)
+    for idx in range(2):
+        with pytest.raises(SparqlError):
+            client.query('ASK { ?x ?p %d }'%(idx,))
+    with pytest.raises(CircuitOpenError):
+        client.query('ASK { ?x ?p 2 }')
+    assert len(server.queries) == 2
+
+
+def test_ttl_cache_expires_and_evicts():
+    cache = TTLCache(2,0.05)
+    cache.put('a',1); cache.put('b',2); cache.put('c',3)
+    assert cache.get('a') is None and cache.get('c') == 3
+    time.sleep(0.06)
+    assert cache.get('c') is None
+
+
+def test_query_cache_stores_outcomes_by_kind():
+    cache = QueryCache(10)
+    assert QueryCache.is_empty({'head':{},'boolean':False})
+    assert QueryCache.is_empty({'head':{'vars':['count']},'results':{'bindings':[{'count':{'type':'literal','value':'0'}}]}})
+    cache.add_result('q1',select_result(['Q1']))
+    cache.add_result('q2',select_result([]))
+    cache.add_error('q3',SparqlError(503,'overloaded'))
+    cache.add_error('q4',CircuitOpenError('open'))
+    assert len(cache.positive) == 1 and len(cache.negative) == 1 and len(cache.errors) == 1
+    assert cache.get('q1') == select_result(['Q1'])
+    with pytest.raises(SparqlError):
+        cache.get('q3')
+    assert cache.get('q4') is None
+
+
+def test_cached_outcomes_are_not_sent_again(make_server):
+    server = make_server(lambda query_string: select_result([] if 'empty' in query_string else ['Q1']))
+    client = SparqlClient(server.endpoint,cache=QueryCache(10))
+    for _ in range(3):
+        client.query('SELECT ?x WHERE { ?x ?p ?y }')
+        client.query('SELECT ?x WHERE { ?x ?p "empty" }')
+    assert len(server.queries) == 2
+    assert client.cache.hits['positive'] == 2 and client.cache.hits['negative'] == 2
+
+
+def test_failures_are_cached_with_the_error_ttl(make_server):
+    server = make_server(flaky(1))
+    client = SparqlClient(server.endpoint,retries=0,cache=QueryCache(10,error_ttl=0.05))
+    for _ in range(2):
+        with pytest.raises(SparqlError):
+            client.query('ASK { ?x ?p ?y }')
+    assert len(server.queries) == 1
+    time.sleep(0.06)
+    assert client.query('ASK { ?x ?p ?y }')['boolean'] is True
+
+
+def test_parse_tsv_value():
+    assert parse_tsv_value('<http://www.wikidata.org/entity/Q42>') == 'http://www.wikidata.org/entity/Q42'
+    assert parse_tsv_value('"a\\tb"@fr') == 'a\tb'
+    assert parse_tsv_value('"12"^^<http://www.w3.org/2001/XMLSchema#integer>') == '12'
+
+
+def test_stream_reads_tsv_solutions(make_server):
+    result = select_result(['Q%d'%(idx,) for idx in range(100)])
+    result['head']['vars'].append('label')
+    result['results']['bindings'][0]['label'] = {'type':'literal','value':'tab\there','xml:lang':'fr'}
+    server = make_server(lambda query_string: result)
+    client = SparqlClient(server.endpoint)
+    rows   = list(client.stream('SELECT ?x ?label WHERE { ?x ?p ?label }'))
+    assert len(rows) == 100
+    assert rows[0] == {'x':'http://www.wikidata.org/entity/Q0','label':'tab\there'}
+    assert rows[1] == {'x':'http://www.wikidata.org/entity/Q1'}
+
+
+def test_stream_stopped_early(make_server):
+    server = make_server(lambda query_string: select_result(['Q%d'%(idx,) for idx in range(20000)]))
+    client = SparqlClient(server.endpoint,max_concurrency=1)
+    stream = client.stream('SELECT ?x WHERE { ?x ?p ?y }')
+    assert next(stream) == {'x':'http://www.wikidata.org/entity/Q0'}
+    #the slot is not held while the consumer reads
+    assert client.slots.acquire(timeout=1.0)
+    client.slots.release()
+    stream.close()
+
+
+def test_stream_retries_without_holding_a_slot(make_server,monkeypatch):
+    failures = [1]
+    def answer(query_string):
+        if failures[0]:
+            failures[0] -= 1
+            raise SparqlError(503,'overloaded')
+        return select_result(['Q1'])
+    server = make_server(answer)
+    client = SparqlClient(server.endpoint,max_concurrency=1)
+    free   = [ ]
+    def sleep(delay):
+        free.append(client.slots.acquire(blocking=False))
+        if free[-1]:
+            client.slots.release()
+    monkeypatch.setattr(time,'sleep',sleep)
+    assert list(client.stream('SELECT ?x WHERE { ?x ?p ?y }')) == [{'x':'http://www.wikidata.org/entity/Q1'}]
+    assert free == [True]
+
+
+def test_closed_streams_reuse_their_connection(make_server):
+    server = make_server(lambda query_string: select_result(['Q%d'%(idx,) for idx in range(2000)]))
+    client = SparqlClient(server.endpoint)
+    for idx in range(20):
+        stream = client.stream('SELECT ?x WHERE { ?x ?p ?y } #%d'%(idx,))
+        assert next(stream) == {'x':'http://www.wikidata.org/entity/Q0'}
+        stream.close()
+    assert client.nconnections == 1
+    #a body longer than DRAIN_SIZE is not drained
+    client.DRAIN_SIZE = 1000
+    stream = client.stream('SELECT ?x WHERE { ?x ?p ?y }')
+    next(stream)
+    stream.close()
+    assert client.idle.empty()
+
+
+def test_stream_reads_cached_results(make_server):
+    server = make_server(lambda query_string: select_result(['Q1','Q2']))
+    client = SparqlClient(server.endpoint,cache=QueryCache(10))
+    client.query('SELECT ?x WHERE { ?x ?p ?y }')
+    assert [row['x'] for row in client.stream('SELECT ?x WHERE { ?x ?p ?y }')] == ['http://www.wikidata.org/entity/Q1','http://www.wikidata.org/entity/Q2']
+    assert len(server.queries) == 1
+
+
+def test_stale_trial_lets_another_trial_through():
+    breaker = CircuitBreaker(failure_threshold=1,reset_timeout=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.before_query() #the trial, never resolved
+    with pytest.raises(CircuitOpenError):
+        breaker.before_query()
+    time.sleep(0.06)
+    breaker.before_query()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_trial_raising_another_error_does_not_block_the_breaker(make_server):
+    server = make_server(flaky(1))
+    client = SparqlClient(server.endpoint,retries=0,failure_threshold=1,reset_timeout=0.05)
+    with pytest.raises(SparqlError):
+        client.query('ASK { ?x ?p ?y }')
+    time.sleep(0.06)
+    def unreadable(query_string,timeout):
+        raise ValueError('unreadable answer')
+    with pytest.raises(ValueError):
+        client.send_with_retries('ASK { ?x ?p ?y }',send=unreadable)
+    assert client.query('ASK { ?x ?p ?z }')['boolean'] is True
+    assert client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_async_followers_do_not_take_worker_threads(make_server):
+    server = make_server(LocalSparqlServer.ask_answer(True))
+    client = SparqlClient(server.endpoint,max_concurrency=1)
+    result,flight,leader = client.lookup('ASK { ?x ?p ?y }') #led elsewhere, e.g. by a batch
+    assert leader
+    async def scenario():
+        followers = [asyncio.ensure_future(client.query_async('ASK { ?x ?p ?y }')) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        other = await asyncio.wait_for(client.query_async('ASK { ?x ?p ?z }'),2.0) #the only worker is free
+        client.complete('ASK { ?x ?p ?y }',flight,{'head':{},'boolean':False})
+        return other,await asyncio.gather(*followers)
+    other,followers = asyncio.run(scenario())
+    assert other['boolean'] is True
+    assert [result['boolean'] for result in followers] == [False]*3
+    assert client.nshared == 3 and len(server.queries) == 1
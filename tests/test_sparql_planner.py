@@ -0,0 +1,41 @@
+"""
+Tests of the evaluation order chosen by the query planner.
+"""
+from sparql_planner import QueryPlanner
+
+
+def test_binds_come_first():
+    patterns = ['?x0 wdt:P31 ?x1 .','BIND(wd:Q5 AS ?x1)']
+    assert QueryPlanner().plan(patterns) == (1,0)
+    assert QueryPlanner().order(patterns) == ['BIND(wd:Q5 AS ?x1)','?x0 wdt:P31 ?x1 .']
+
+
+def test_connected_triples_are_preferred():
+    patterns = ['BIND(wd:Q5 AS ?x1)','?x2 wdt:P17 ?x3 .','?x0 wdt:P31 ?x1 .','?x0 wdt:P19 ?x2 .']
+    assert QueryPlanner().plan(patterns) == (0,2,3,1)
+
+
+def test_unreadable_elements_come_last():
+    patterns = ['{ ?x0 wdt:P31 ?x1 } UNION { ?x0 wdt:P279 ?x1 }','?x0 wdt:P17 ?x2 .','BIND(wd:Q142 AS ?x2)']
+    assert QueryPlanner().plan(patterns) == (2,1,0)
+
+
+def test_property_statistics_drive_the_order():
+    planner  = QueryPlanner({'P31':(1000000,900000,1000),'P17':(100,100,10)})
+    assert planner.has_statistics() and not QueryPlanner().has_statistics()
+    patterns = ['?x0 wdt:P31 ?x1 .','?x0 wdt:P17 ?x2 .']
+    assert planner.plan(patterns) == (1,0)
+    assert QueryPlanner().plan(patterns) == (0,1) #same estimates: derivation order
+
+
+def test_pageranks_drive_the_order():
+    planner  = QueryPlanner(pageranks={'Q5':100.0,'Q8502':0.01,'Q1':1.0})
+    patterns = ['BIND(wd:Q5 AS ?x1)','BIND(wd:Q8502 AS ?x2)','?x0 wdt:P31 ?x1 .','?x0 wdt:P31 ?x2 .']
+    assert planner.plan(patterns) == (0,1,3,2) #the rare class first
+
+
+def test_properties_without_statistics_are_not_free():
+    planner  = QueryPlanner({'P31':(1000000,900000,1000)})
+    patterns = ['BIND(wd:Q5 AS ?x1)','?a wdt:P999 ?b .','?x0 wdt:P31 ?x1 .']
+    assert planner.cost(QueryPlanner.parse_element(patterns[1]),{ }) == QueryPlanner.DEFAULT_STATS[0]
+    assert planner.plan(patterns) == (0,2,1)
@@ -0,0 +1,59 @@
+"""
+Tests of the superlative combinators: typing, compilation to ORDER BY ... LIMIT 1 subqueries and answers.
+"""
+import pytest
+
+from functional_core import TypeSystem,SuperlativeCombinator,CompilationError
+from wikidata_model import WikiSuperlative,WikidataQuery
+from triple_store import TripleStoreModelInterface
+from semparser import make_logical_parser
+
+
+MOUNTAIN = '(lambda (y:e) (exists (z:e) (and (wdt:P31 y z) (wd:Q8502 z))))'
+IN_FRANCE = '(lambda (y:e) (exists (c:e) (and (wdt:P17 y c) (wd:Q142 c))))'
+
+
+def test_superlative_is_abstract():
+    with pytest.raises(TypeError):
+        SuperlativeCombinator()
+    assert not WikiSuperlative().is_evaluable()
+
+
+def test_ranked_values_are_numbers_or_dates(logical_parser):
+    typecheck = lambda code: TypeSystem.typecheck(logical_parser.parse_code(code))
+    assert typecheck('(argmax %s wdt:P2044)'%(MOUNTAIN,)) == (TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN)
+    assert typecheck('(latest %s wdt:P571)'%(MOUNTAIN,)) == (TypeSystem.DB_ENTITY,TypeSystem.BOOLEAN)
+    assert typecheck('(argmax %s wdt:P17)'%(MOUNTAIN,)) == TypeSystem.FAILURE  #entity valued property
+    assert typecheck('(argmax %s wdt:P571)'%(MOUNTAIN,)) == TypeSystem.FAILURE #dates are ranked by latest/earliest
+
+
+def test_order_by_limit_subquery(logical_parser):
+    term  = logical_parser.parse_code('(@exists (x:e) (argmax %s wdt:P2044 x))'%(MOUNTAIN,)).value()
+    query = term.sparql_query('SELECT')
+    assert '{ SELECT ?x0 WHERE { BIND(wd:Q8502 AS ?x1) ?x0 wdt:P31 ?x1 . ?x0 wdt:P2044 ?x2 . } ORDER BY DESC(?x2) LIMIT 1 }' in query
+    assert query.count('SELECT') == 2 and 'SELECT DISTINCT ?x0 WHERE' in query
+    term  = logical_parser.parse_code('(@exists (x:e) (and (argmin %s wdt:P2044 x) (%s x)))'%(MOUNTAIN,IN_FRANCE)).value()
+    query = term.sparql_query('SELECT')
+    assert 'ORDER BY ASC(?x2) LIMIT 1 }' in query
+    assert query.index('wdt:P17') < query.index('{ SELECT') #the conjunct is outside of the subquery
+
+
+def test_unbound_candidates_raise(logical_parser):
+    term = logical_parser.parse_code('(@exists (x:e) (argmax %s wdt:P2044 y))'%(MOUNTAIN,)).value()
+    with pytest.raises(CompilationError):
+        term.sparql_query('SELECT')
+
+
+@pytest.mark.parametrize('code,answer',[('(@exists (x:e) (argmax %s wdt:P2044 x))'%(MOUNTAIN,),['Q1']),
+                                        ('(@exists (x:e) (argmin %s wdt:P2044 x))'%(MOUNTAIN,),['Q2']),
+                                        ('(@exists (x:e) (and (argmax %s wdt:P2044 x) (%s x)))'%(MOUNTAIN,IN_FRANCE),[]),
+                                        ('(@exists (x:e) (argmax (lambda (y:e) (and (%s y) (%s y))) wdt:P2044 x))'%(MOUNTAIN,IN_FRANCE),['Q3'])])
+def test_local_store_answers(store,code,answer):
+    term = make_logical_parser(TripleStoreModelInterface(store)).parse_code(code).value()
+    assert [value for assignment in term.ret_value('SELECT',debug=False) for var,value in assignment] == answer
+
+
+def test_endpoint_answers(endpoint,logical_parser):
+    term = logical_parser.parse_code('(@exists (x:e) (argmax %s wdt:P2044 x))'%(MOUNTAIN,)).value()
+    assert term.ret_value('SELECT',debug=False) == [[('x0','Q1')]]
+    assert 'ORDER BY DESC(?x2) LIMIT 1' in endpoint.queries[0]
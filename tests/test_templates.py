@@ -0,0 +1,61 @@
+"""
+Tests of the query templates: an instance of a template is the query generated from the logical form of its derivation.
+"""
+import pytest
+
+from wikidata_model import WikidataQuery
+from sparql_planner import QueryPlanner
+from semparser import CCGParser
+from lexerpytrie_quan import Token
+
+
+SHAPES = {'WHQ P Q':['S','S','S','>[JOIN]','>'],
+          'WHQ P P Q':['S','S','S','S','>[JOIN]','>[JOIN]','>'],
+          'WHQ P Q AND P Q':['S','S','S','>[JOIN]','D','S','S','>[JOIN]','C[AND]','>']}
+
+
+def make_derivation(ccg,parser,shape,ids):
+    """
+    @param shape: a key of SHAPES
+    @param ids: the wikidata IDs of the P and Q macros of the shape, in order
+    @return a couple (derivation,toklist)
+    """
+    actions = dict([(action.stack_label,action) for action in ccg.actions_list])
+    ids     = iter(ids)
+    toklist = [ ]
+    for macro in shape.split():
+        if macro == 'WHQ':
+            toklist.append(Token('qui','NOTAG','WHQ',parser.parse_code('(lambda (P:e=>t) (@exists(x:e) (P x)))')))
+        elif macro == 'AND':
+            toklist.append(Token('et','NOTAG','AND',None))
+        else:
+            ident = next(ids)
+            toklist.append(Token(ident,'NOTAG',ident,parser.parse_code(('wd:' if macro == 'Q' else 'wdt:')+ident)))
+    return [(None,actions[label]) for label in SHAPES[shape]]+[(None,None)],toklist
+
+
+ASSIGNMENTS = {'WHQ P Q':[['P31','Q5'],['P17','Q142'],['P106','Q82955']],
+               'WHQ P P Q':[['P17','P31','Q5'],['P31','P17','Q142'],['P19','P131','Q90']],
+               'WHQ P Q AND P Q':[['P31','Q5','P17','Q142'],['P106','Q82955','P27','Q30'],['P31','Q8502','P17','Q142']]}
+
+
+@pytest.mark.parametrize('shape',sorted(SHAPES))
+def test_instances_match_the_generated_queries(logical_parser,wikidata_config,shape):
+    ccg = CCGParser(None)
+    for ids in ASSIGNMENTS[shape]:
+        derivation,toklist = make_derivation(ccg,logical_parser,shape,ids)
+        query_string,template = ccg.make_query_string(derivation,toklist)
+        assert query_string == ccg.make_query_term(derivation,toklist).sparql_query('SELECT')
+        assert all(ident in query_string for ident in ids)
+    assert len(ccg.templates) == 1 #one template for all the assignments
+
+
+def test_instances_are_planned_with_their_ids(logical_parser,wikidata_config):
+    #P31 is common and P17 rare in the statistics, so the evaluation order depends on the IDs
+    wikidata_config.PLANNER = QueryPlanner({'P31':(1000000,900000,1000),'P17':(100,100,10),'P19':(5000,5000,500)})
+    ccg = CCGParser(None)
+    for ids in [['P31','P17','Q142'],['P17','P31','Q142'],['P19','P31','Q5']]:
+        derivation,toklist = make_derivation(ccg,logical_parser,'WHQ P P Q',ids)
+        query_string,template = ccg.make_query_string(derivation,toklist)
+        assert query_string == ccg.make_query_term(derivation,toklist).sparql_query('SELECT')
+    assert len(ccg.templates) == 1 and len(template.plans) > 1 #several evaluation orders for the same template
@@ -0,0 +1,65 @@
+"""
+Tests of the cached information of the lambda terms built or modified in place.
+"""
+from functional_core import *
+from tests.terms import make_conjunction
+
+
+def test_conjunctions_are_closed(logical_parser):
+    term = make_conjunction(logical_parser,50)
+    assert check_cached_info(term)
+    assert is_closed_term(term)
+    assert not is_closed_term(term.body) #x is free below its quantifier
+    term = make_conjunction(logical_parser,50,normal_form=False)
+    assert check_cached_info(term)
+    assert not is_closed_term(term) #the predicates are still lambda terms
+    assert is_closed_term(term.value())
+
+
+def test_set_args_refreshes(logical_parser):
+    pred = logical_parser.parse_code('wd:Q42')
+    assert pred.has_lambda and pred.nargs == 1
+    pred.set_args([LambdaVariable('x',ttype=(TypeSystem.DB_ENTITY,),db_index=1)])
+    assert check_cached_info(pred)
+    assert not pred.has_lambda and pred.max_free_index == 1
+    stale = logical_parser.parse_code('wd:Q42')
+    stale.args_values[0] = LambdaVariable('x',ttype=(TypeSystem.DB_ENTITY,),db_index=1)
+    stale.nargs = 0
+    assert not check_cached_info(stale)
+
+
+def test_normalized_terms_are_up_to_date(logical_parser):
+    term = logical_parser.parse_code('((lambda (P:e=>t Q:e=>t) (@exists (x:e) (and (P x) (Q x)))) wd:Q5 (lambda (y:e) (exists (z:e) (wdt:P31 y z))))')
+    assert check_cached_info(term.value())
+
+
+def test_macro_type_cache_per_dictionary(logical_parser):
+    cache = MacroTypeCache(max_size=2)
+    pred,entity = logical_parser.parse_code('wd:Q5'),logical_parser.parse_code('(lambda (P:e=>t) (@exists (x:e) (P x)))')
+    assert cache.typecheck('M',pred) == TypeSystem.typecheck(pred)
+    assert cache.typecheck('M',entity) == TypeSystem.typecheck(entity) #the macro is rebound in the dictionary
+    assert MacroTypeCache().typecheck('M',pred) == TypeSystem.typecheck(pred) #another dictionary
+    cache.typecheck('A',pred)
+    cache.typecheck('B',pred)
+    assert list(cache.types) == ['A','B']
+
+
+def test_macro_type_cache_per_naming_context(logical_parser):
+    names = logical_parser.naming_context
+    cache = MacroTypeCache(names)
+    cache.typecheck('M',logical_parser.parse_code('wd:Q5'))
+    assert cache.typecheck('M',logical_parser.parse_code('wd:Q5')) == TypeSystem.typecheck(logical_parser.parse_code('wd:Q5'))
+    logical_parser.parse_code('(define M wdt:P31)')
+    term = logical_parser.parse_code('M')
+    assert cache.typecheck('M',term) == TypeSystem.typecheck(term)
+
+
+def test_substitution_in_partially_applied_constants(logical_parser):
+    term = logical_parser.parse_code('((lambda (y:num) (lambda (v:num) (+ y))) 4)').value()
+    assert term.body.nargs == 1 and term.body.args_values[0].ret_value() == 4
+    #the argument 5 fills the inner partial application (+ 4), not the outer function
+    term  = logical_parser.parse_code('(((lambda (y:num) (* (+ y) 2)) 4) 5)').value()
+    inner = term.args_values[0]
+    assert term.nargs == 0 and inner.nargs == 0
+    assert [arg.ret_value() for arg in inner.args_values] == [4,5]
+    assert evaluate_to_string(term) == evaluate_to_string(evaluate_term(logical_parser.parse_code('(((lambda (y:num) (* (+ y) 2)) 4) 5)')))
@@ -0,0 +1,156 @@
+"""
+Tests of the queries of the wikidata model against a local store behind a stand-in endpoint:
+ASK checks with VALUES, batched SELECT queries and the answers of CCG derivations.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from sparql_client import SparqlError
+from wikidata_model import WikidataQuery
+from semparser import CCGParser
+from lexerpytrie_quan import Token
+
+
+MOUNTAINS = 'BIND(wd:Q8502 AS ?x1) ?x0 wdt:P31 ?x1 .'
+
+
+def test_local_store_select(store):
+    result = store.query(WikidataQuery.wrap_query(MOUNTAINS,['?x0'],'SELECT'))
+    assert sorted(row['x0']['value'].split('/')[-1] for row in result['results']['bindings']) == ['Q1','Q2','Q3']
+
+
+def test_check_query_joins_the_values(store):
+    ask = lambda refs: store.query(WikidataQuery.make_check_query('?x0',refs,MOUNTAINS))['boolean']
+    assert ask(['wd:Q4','wd:Q2'])
+    assert not ask(['wd:Q4','wd:Q42'])
+
+
+def test_batch_query_results_are_split_by_query(store):
+    subqueries = [(MOUNTAINS,['?x0']),('BIND(wd:Q142 AS ?x1) ?x0 wdt:P17 ?x1 .',['?x0']),('BIND(wd:Q5 AS ?x1) ?x0 wdt:P17 ?x1 .',['?x0'])]
+    answers    = WikidataQuery.read_batch_results(store.query(WikidataQuery.make_batch_query(subqueries)),len(subqueries))
+    assert [sorted(value for assignment in answer for var,value in assignment) for answer in answers] == [['Q1','Q2','Q3'],['Q2','Q3'],[]]
+
+
+def test_send_batch_one_request(endpoint):
+    subqueries = [(MOUNTAINS,['?x0']),('BIND(wd:Q142 AS ?x1) ?x0 wdt:P17 ?x1 .',['?x0'])]
+    answers    = asyncio.run(WikidataQuery.send_batch_async(subqueries))
+    assert [sorted(value for assignment in answer for var,value in assignment) for answer in answers] == [['Q1','Q2','Q3'],['Q2','Q3']]
+    assert len(endpoint.queries) == 1
+
+
+def test_rejected_batch_is_sent_query_by_query(endpoint):
+    subqueries = [(MOUNTAINS,['?x0']),('?x0 wdt:P31 None .',['?x0'])]
+    answers    = asyncio.run(WikidataQuery.send_batch_async(subqueries))
+    assert sorted(value for assignment in answers[0] for var,value in assignment) == ['Q1','Q2','Q3']
+    assert answers[1] == [] #rejected query: no solution
+    assert len(endpoint.queries) == 3
+
+
+def test_failed_batch_reports_the_error_for_each_query(make_server,wikidata_config):
+    def overloaded(query_string):
+        raise SparqlError(503,'overloaded')
+    wikidata_config.ENDPOINT   = make_server(overloaded).endpoint
+    wikidata_config.CACHE_SIZE = 0
+    wikidata_config.RETRIES    = 0
+    answers = asyncio.run(WikidataQuery.send_batch_async([(MOUNTAINS,['?x0']),(MOUNTAINS,['?x1'])]))
+    assert all(isinstance(answer,SparqlError) and answer.is_transient() for answer in answers)
+
+
+COUNTRY = 'BIND(wd:Q142 AS ?x1) ?x0 wdt:P17 ?x1 .'
+
+
+def test_shared_client_is_created_once(make_server,wikidata_config):
+    from tests.sparql_server import LocalSparqlServer
+    wikidata_config.ENDPOINT = make_server(LocalSparqlServer.ask_answer(True)).endpoint
+    barrier = threading.Barrier(8)
+    clients = [ ]
+    def get_client():
+        barrier.wait()
+        clients.append(WikidataQuery.client())
+    threads = [threading.Thread(target=get_client) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(clients) == 8 and all(client is clients[0] for client in clients)
+    wikidata_config.ENDPOINT = make_server(LocalSparqlServer.ask_answer(True)).endpoint
+    assert WikidataQuery.client() is not clients[0]
+    with pytest.raises(RuntimeError): #the replaced client is closed
+        clients[0].executor.submit(len,'')
+
+
+def test_batch_reads_and_fills_the_cache(endpoint):
+    WikidataQuery.CACHE_SIZE = 100
+    assert sorted(value for assignment in WikidataQuery.run_query(MOUNTAINS,['?x0'],'SELECT') for var,value in assignment) == ['Q1','Q2','Q3']
+    answers = asyncio.run(WikidataQuery.send_batch_async([(MOUNTAINS,['?x0']),(COUNTRY,['?x0']),(COUNTRY.replace('Q142','Q837'),['?x0'])]))
+    assert [sorted(value for assignment in answer for var,value in assignment) for answer in answers] == [['Q1','Q2','Q3'],['Q2','Q3'],['Q1']]
+    assert len(endpoint.queries) == 2 and endpoint.queries[-1].count('?__qid') == 2 #the cached query is not in the batch
+    assert sorted(value for assignment in WikidataQuery.run_query(COUNTRY,['?x0'],'SELECT') for var,value in assignment) == ['Q2','Q3']
+    assert len(endpoint.queries) == 2 #answered by the results of the batch
+
+
+def test_batch_shares_the_queries_in_flight(endpoint):
+    client = WikidataQuery.client()
+    query  = WikidataQuery.wrap_query(COUNTRY,['?x0'],'SELECT')
+    result,flight,leader = client.lookup(query) #sent by someone else meanwhile
+    assert leader
+    answer = {'head':{'vars':['x0']},'results':{'bindings':[{'x0':{'type':'uri','value':'http://www.wikidata.org/entity/Q42'}}]}}
+    threading.Timer(0.1,client.complete,(query,flight,answer)).start()
+    answers = asyncio.run(WikidataQuery.send_batch_async([(MOUNTAINS,['?x0']),(COUNTRY,['?x0'])]))
+    assert answers[1] == [[('x0','Q42')]]
+    assert len(endpoint.queries) == 1 and '?__qid' not in endpoint.queries[0] #a single query left to send
+    assert client.nshared == 1
+
+
+@pytest.fixture
+def derivations(logical_parser):
+    """
+    @return a CCGParser, the tokens of 'qui P31 Q8502' and two derivations:
+    one whose logical form is a query and one whose logical form is not
+    """
+    ccg     = CCGParser(None)
+    actions = dict([(action.stack_label,action) for action in ccg.actions_list])
+    toklist = [Token('qui','NOTAG','WHQ',logical_parser.parse_code('(lambda (P:e=>t) (@exists(x:e) (P x)))')),\
+               Token('P31','NOTAG','P31',logical_parser.parse_code('wdt:P31')),\
+               Token('Q8502','NOTAG','Q8502',logical_parser.parse_code('wd:Q8502'))]
+    query   = [(None,actions[label]) for label in ['S','S','S','>[JOIN]','>']]+[(None,None)]
+    other   = [(None,actions[label]) for label in ['D','S','D']]+[(None,None)]
+    return ccg,toklist,query,other
+
+
+@pytest.mark.parametrize('batch_size',[1,4])
+def test_derivation_answers(endpoint,derivations,batch_size):
+    ccg,toklist,query,other = derivations
+    WikidataQuery.BATCH_SIZE = batch_size
+    answers = ccg.make_queries_concurrently([query,other,query],toklist)
+    assert sorted(answers[0]) == ['Q1','Q2','Q3'] and answers[1] == [] and answers[2] == answers[0]
+    assert ccg.query_counts == (2,1)
+    assert ccg.make_query(other,toklist) == []
+
+
+@pytest.mark.parametrize('mode',['select','stream','ask'])
+def test_check_modes_agree(endpoint,derivations,mode):
+    ccg,toklist,query,other = derivations
+    ccg.check_mode = mode
+    assert ccg.check_derivations([(query,('t',)),(other,('t',))],toklist,set(['Q3']),True) == [True,False]
+    assert ccg.check_derivations([(query,('t',))],toklist,set(['Q4']),True) == [False]
+    if mode == 'ask':
+        assert all(query_string.startswith('PREFIX') and 'ASK' in query_string and 'VALUES ?x0' in query_string for query_string in endpoint.queries)
+
+
+def test_batch_evaluator_writes_json_lines(endpoint,capsys):
+    import io,sys,json
+    from lambda_parser import BatchEvaluator
+    from wikidata_model import WikidataModelInterface,NamingContextWikidata
+    mountain  = '(exists (y:e) (and (wdt:P31 x y) (wd:Q8502 y)))'
+    lines     = ['(exists (x:e) %s)'%(mountain,),'(assignation (@exists (x:e) %s))'%(mountain,),\
+                 '(count (@exists (x:e) %s))'%(mountain,),'(exists (x:e) (and %s (exists (z:e) (and (wdt:P17 x z) (wd:Q5 z)))))'%(mountain,)]
+    evaluator = BatchEvaluator(WikidataModelInterface(),NamingContextWikidata.make_wikidata_builtins_context(),workers=2)
+    evaluator.run(io.StringIO('\n'.join(lines)),sys.stdout)
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()] #nothing but JSON on stdout
+    assert [record['line'] for record in records] == [1,2,3,4]
+    assert records[0]['value'] is True and records[3]['value'] is False
+    assert sorted(records[1]['value']) == ['Q1','Q2','Q3']
+    assert records[2]['value'] == 3
@@ -0,0 +1,495 @@
+#!/usr/bin/python
+
+"""
+Local triple store answering the queries generated by the wikidata model without a remote endpoint.
+
+The store is built from the graph files extracted by songnan/calculate_pr.py (extract_entities):
+each line holds tab separated python lists [subject,property,object(,qualifier,value)] and the
+(subject,property,object) triples are the wdt: claims.
+
+On disk, an index is a directory with:
+   terms.txt                   one wikidata ID per line, the line number is the integer code of the ID
+   spo.bin, pos.bin, osp.bin   the triples sorted in each order, as three columns of native uint32
+
+The .bin files are memory mapped when the store is opened.
+"""
+import os
+import re
+import ast
+import mmap
+import array
+import bisect
+
+from functional_core import *
+from wikidata_model import *
+from sparql_client import SparqlError
+
+
+class TripleStore(object):
+    """
+    Integer encoded triples with SPO, POS and OSP indexes.
+    Evaluates the SPARQL subset generated by the wikidata model (@see query):
+    basic graph patterns, BIND of constants, UNION and SELECT subqueries, in ASK, SELECT DISTINCT
+    and COUNT queries with an optional final VALUES clause on one variable and ORDER BY one variable.
+    Numeric terms (e.g. '8848') are number literals: they are ordered by value.
+    """
+    ORDERS   = ['spo','pos','osp']
+    #triple field (0=subject,1=property,2=object) stored in each column of an index
+    FIELDS   = {'spo':(0,1,2),'pos':(1,2,0),'osp':(2,0,1)}
+    ENTITY_URI = 'http://www.wikidata.org/entity/'
+    NUMBER     = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)$')
+
+    def __init__(self,dirname):
+        """
+        Opens an index built by TripleStore.build
+        @param dirname: the index directory
+        """
+        self.dirname = dirname
+        istream = open(os.path.join(dirname,'terms.txt'))
+        self.terms = [line.rstrip('\n') for line in istream]
+        istream.close()
+        self.codes = dict([(term,code) for code,term in enumerate(self.terms)])
+        self.files,self.maps,self.index = [],[],{}
+        for order in TripleStore.ORDERS:
+            stream = open(os.path.join(dirname,order+'.bin'),'rb')
+            self.files.append(stream)
+            size = os.fstat(stream.fileno()).st_size
+            if size == 0:
+                self.index[order] = ([],[],[])
+                continue
+            mapping = mmap.mmap(stream.fileno(),0,access=mmap.ACCESS_READ)
+            self.maps.append(mapping)
+            cells = memoryview(mapping).cast('I')
+            N = len(cells) // 3
+            self.index[order] = (cells[:N],cells[N:2*N],cells[2*N:])
+        self.ntriples = len(self.index['spo'][0])
+
+    def __str__(self):
+        return 'TripleStore(%s): %d triples, %d terms'%(self.dirname,self.ntriples,len(self.terms))
+
+    def close(self):
+        """
+        Releases the memory maps
+        """
+        self.index = {}
+        for mapping in self.maps:
+            mapping.close()
+        for stream in self.files:
+            stream.close()
+        self.maps,self.files = [],[]
+
+    @staticmethod
+    def read_graph_file(filename):
+        """
+        Iterates over the (subject,property,object) claims of a graph file
+        @param filename: a graph file written by extract_entities
+        @return a generator of triples of wikidata IDs
+        """
+        istream = open(filename)
+        for line in istream:
+            for field in line.rstrip('\n').split('\t'):
+                if not field:
+                    continue
+                claim = ast.literal_eval(field)
+                if len(claim) in (3,5): #[s,p,o] or [s,p,o,qualifier,value] ([s,p,qualifier,value] are not direct claims)
+                    yield claim[0],claim[1],claim[2]
+        istream.close()
+
+    @staticmethod
+    def build(triples,dirname):
+        """
+        Builds an index on disk
+        @param triples: an iterable of (subject,property,object) wikidata IDs (e.g. 'Q42','P31','Q5')
+        @param dirname: the index directory (created if needed)
+        @return the opened TripleStore
+        """
+        os.makedirs(dirname,exist_ok=True)
+        codes,encoded = {},set()
+        for triple in triples:
+            encoded.add(tuple(codes.setdefault(term,len(codes)) for term in triple))
+
+        ostream = open(os.path.join(dirname,'terms.txt'),'w')
+        for term in codes:
+            ostream.write(term+'\n')
+        ostream.close()
+
+        for order in TripleStore.ORDERS:
+            f0,f1,f2 = TripleStore.FIELDS[order]
+            rows  = sorted([(triple[f0],triple[f1],triple[f2]) for triple in encoded])
+            ostream = open(os.path.join(dirname,order+'.bin'),'wb')
+            for col in range(3):
+                array.array('I',[row[col] for row in rows]).tofile(ostream)
+            ostream.close()
+        return TripleStore(dirname)
+
+    def match(self,subj=None,prop=None,obj=None):
+        """
+        Iterates over the triples matching a pattern
+        @param subj,prop,obj: integer codes or None for the unknown positions
+        @return a generator of (subject,property,object) integer codes
+        """
+        if subj is not None:
+            order,keys = 'spo',(subj,prop) if prop is not None else (subj,)
+        elif prop is not None:
+            order,keys = 'pos',(prop,obj) if obj is not None else (prop,)
+        elif obj is not None:
+            order,keys = 'osp',(obj,)
+        else:
+            order,keys = 'spo',()
+        columns = self.index[order]
+        lo,hi   = 0,len(columns[0])
+        for col,key in enumerate(keys):
+            lo,hi = bisect.bisect_left(columns[col],key,lo,hi),bisect.bisect_right(columns[col],key,lo,hi)
+        f0,f1,f2 = TripleStore.FIELDS[order]
+        A,B,C    = columns
+        for idx in range(lo,hi):
+            triple = [0,0,0]
+            triple[f0],triple[f1],triple[f2] = A[idx],B[idx],C[idx]
+            if (subj is None or triple[0] == subj) and (prop is None or triple[1] == prop) and (obj is None or triple[2] == obj):
+                yield tuple(triple)
+
+    def query(self,query_string):
+        """
+        Evaluates a query generated by the wikidata model
+        @param query_string: a SPARQL query (ASK, SELECT DISTINCT or COUNT @see WikidataQuery.wrap_query)
+        @return a dict (SPARQL JSON results format), as returned by the endpoint
+        """
+        form,answer_vars,pattern,order,limit,values = SparqlFragmentParser(query_string).parse_query()
+        solutions = self.eval_group(pattern,[{}])
+        if values is not None: #joins the solutions with the VALUES
+            var,terms = values
+            codes     = set(self.code(term) for term in terms)
+            solutions = [solution for solution in solutions if solution.get(var) in codes]
+        if form == 'ASK':
+            return {'head':{},'boolean':len(solutions) > 0}
+        if form == 'COUNT':
+            count = len(solutions) if answer_vars == ['*'] else sum(1 for solution in solutions if all(var in solution for var in answer_vars))
+            return {'head':{'vars':['count']},'results':{'bindings':[{'count':{'type':'literal','value':str(count)}}]}}
+        rows     = TripleStore.project(self.sort(solutions,order),answer_vars,limit)
+        bindings = [dict([(var[1:],self.binding(code)) for var,code in row]) for row in rows]
+        return {'head':{'vars':[var[1:] for var in answer_vars]},'results':{'bindings':bindings}}
+
+    @staticmethod
+    def project(solutions,answer_vars,limit=None):
+        """
+        @param solutions: a list of dicts var -> code
+        @param answer_vars: the projected variables (['*'] for all of them)
+        @param limit: max number of rows (None for no limit)
+        @return the list of the distinct rows, tuples of (var,code) couples for the bound variables
+        """
+        rows = [ ]
+        seen = set()
+        for solution in solutions:
+            names = sorted(solution) if answer_vars == ['*'] else [var for var in answer_vars if var in solution]
+            row   = tuple((var,solution[var]) for var in names)
+            if row not in seen:
+                seen.add(row)
+                rows.append(row)
+                if len(rows) == limit:
+                    break
+        return rows
+
+    def binding(self,code):
+        """
+        @return the JSON result binding of a code: an entity or a number
+        """
+        name = self.name(code)
+        if TripleStore.NUMBER.match(name):
+            datatype = 'integer' if name.lstrip('+-').isdigit() else 'decimal'
+            return {'type':'literal','datatype':'http://www.w3.org/2001/XMLSchema#'+datatype,'value':name}
+        return {'type':'uri','value':TripleStore.ENTITY_URI+name}
+
+    def sort(self,solutions,order):
+        """
+        Sorts the solutions of a query (ORDER BY): the numbers by value first, then the other terms by name, then the unbound
+        @param solutions: a list of dicts var -> code
+        @param order: None or a couple (var,descending)
+        @return the sorted list of solutions
+        """
+        if order is None:
+            return solutions
+        var,descending = order
+        numbers,terms,unbound = [ ],[ ],[ ]
+        for solution in solutions:
+            if var not in solution:
+                unbound.append(solution)
+                continue
+            name = self.name(solution[var])
+            if TripleStore.NUMBER.match(name):
+                numbers.append((float(name),solution))
+            else:
+                terms.append((name,solution))
+        numbers.sort(key=lambda item:item[0],reverse=descending)
+        terms.sort(key=lambda item:item[0],reverse=descending)
+        return [solution for _,solution in numbers]+[solution for _,solution in terms]+unbound
+
+    def code(self,term):
+        """
+        @param term: a prefixed name (wd:Qxx or wdt:Pxx)
+        @return the integer code of the term or its wikidata ID (a string) if it does not occur in the store
+        """
+        name = term.split(':',1)[-1]
+        return self.codes.get(name,name)
+
+    def name(self,code):
+        """
+        @param code: a code returned by the code method
+        @return the wikidata ID of the code
+        """
+        return code if type(code) == str else self.terms[code]
+
+    def eval_group(self,pattern,solutions):
+        """
+        Evaluates a group pattern for each of the solutions given.
+        The BINDs are evaluated first, then the triples (the most bound first), the UNIONs are evaluated
+        as soon as no triple has a bound subject or object.
+        @param pattern: a list of elements ('bind',term,var), ('triple',s,p,o), ('union',[group,...])
+        @param solutions: a list of dicts var -> code
+        @return the list of the extended solutions
+        """
+        binds   = [elt for elt in pattern if elt[0] == 'bind']
+        triples = [elt for elt in pattern if elt[0] == 'triple']
+        unions  = [elt for elt in pattern if elt[0] in ('union','subquery')]
+        for _,term,var in binds:
+            code = self.code(term)
+            solutions = [ dict(solution,**{var:code}) if var not in solution else solution for solution in solutions if solution.get(var,code) == code ]
+        bound = set(solutions[0]) if solutions else set()
+        known = lambda elt: sum(1 for term in elt[1:] if not term.startswith('?') or term in bound)
+        while (triples or unions) and solutions:
+            triple = max(triples,key=known) if triples else None
+            if triple is None or (unions and known(triple) < 2): #no triple with a bound subject or object: UNIONs first
+                solutions = self.eval_nested(unions.pop(0),solutions)
+                bound.update(solutions[0] if solutions else ())
+                continue
+            triples.remove(triple)
+            solutions = self.join_triple(triple[1:],solutions)
+            bound.update(term for term in triple[1:] if term.startswith('?'))
+        return solutions
+
+    def eval_nested(self,element,solutions):
+        """
+        Evaluates a UNION or a subquery for each of the solutions given
+        @param element: ('union',[group,...]) or ('subquery',answer_vars,pattern,order,limit)
+        @param solutions: a list of dicts var -> code
+        @return the list of the extended solutions
+        """
+        if element[0] == 'union':
+            return [extended for group in element[1] for extended in self.eval_group(group,solutions)]
+        _,answer_vars,pattern,order,limit = element #the subquery is evaluated first, then joined
+        rows = TripleStore.project(self.sort(self.eval_group(pattern,[{}]),order),answer_vars,limit)
+        return [dict(solution,**dict(row)) for solution in solutions for row in rows if all(solution.get(var,code) == code for var,code in row)]
+
+    def join_triple(self,triple,solutions):
+        """
+        Extends each solution with the matches of a triple pattern
+        @param triple: a triple of terms (variables '?x' or prefixed names)
+        @param solutions: a list of dicts var -> code
+        @return the list of the extended solutions
+        """
+        result = [ ]
+        for solution in solutions:
+            keys = [solution.get(term) if term.startswith('?') else self.code(term) for term in triple]
+            if any(type(key) == str for key in keys): #a term absent from the store has no match
+                continue
+            for match in self.match(*keys):
+                extended = solution
+                for term,key,value in zip(triple,keys,match):
+                    if key is None:
+                        if term in extended and extended[term] != value: #same variable twice in the triple
+                            break
+                        if extended is solution:
+                            extended = dict(solution)
+                        extended[term] = value
+                else:
+                    result.append(extended)
+        return result
+
+
+class SparqlFragmentParser(object):
+    """
+    Parses the SPARQL subset generated by the wikidata model (@see WikidataQuery.wrap_query and make_batch_query).
+    A group pattern is parsed as a list of elements ('bind',term,var), ('triple',s,p,o), ('union',[group,...])
+    or ('subquery',answer_vars,pattern,order,limit) for a group made of a SELECT subquery.
+    SERVICE clauses (labels) are ignored.
+    """
+    TOKENS = re.compile(r'\s*(\?\w+|<[^>]*>|[A-Za-z_][\w-]*:[\w-]*|"[^"]*"(?:@\w+)?|\d+|[A-Za-z_]\w*|[{}().*])')
+
+    def __init__(self,query_string):
+        self.tokens = [ ]
+        pos = 0
+        query_string = query_string.rstrip()
+        while pos < len(query_string):
+            match = SparqlFragmentParser.TOKENS.match(query_string,pos)
+            if match is None:
+                raise SparqlError(400,'unsupported query near %s'%(query_string[pos:pos+20],))
+            self.tokens.append(match.group(1))
+            pos = match.end()
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self,expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token.upper() != expected):
+            raise SparqlError(400,'unsupported query: expected %s, got %s'%(expected,token))
+        self.pos += 1
+        return token
+
+    def parse_query(self):
+        """
+        @return a tuple (form,answer_vars,pattern,order,limit,values) where form is ASK, SELECT or COUNT,
+        order is None or the couple (var,descending) of an ORDER BY clause
+        and values is None or the couple (var,terms) of a final VALUES clause
+        """
+        while self.peek() and self.peek().upper() == 'PREFIX':
+            self.next(); self.next(); self.next()
+        form,answer_vars,order,limit = self.next().upper(),['*'],None,None
+        if form == 'SELECT':
+            if self.peek().upper() == 'DISTINCT':
+                self.next()
+            if self.peek() == '(': # (COUNT (vars) AS ?count)
+                form = 'COUNT'
+                self.next('('); self.next('COUNT'); self.next('(')
+                answer_vars = self.parse_vars(')')
+                self.next(')'); self.next('AS'); self.next(); self.next(')')
+            else:
+                answer_vars = self.parse_vars('WHERE','{')
+            if self.peek().upper() == 'WHERE':
+                self.next()
+        elif form != 'ASK':
+            raise SparqlError(400,'unsupported query form %s'%(form,))
+        pattern = self.parse_group()
+        values  = None
+        if self.peek() and self.peek().upper() == 'VALUES':
+            self.next()
+            var = self.next()
+            self.next('{')
+            values = (var,self.parse_vars('}'))
+            self.next('}')
+        if self.peek() and self.peek().upper() == 'ORDER':
+            self.next(); self.next('BY')
+            if self.peek().startswith('?'):
+                order = (self.next(),False)
+            else:
+                direction = self.next().upper()
+                if direction not in ('ASC','DESC'):
+                    raise SparqlError(400,'unsupported order %s'%(direction,))
+                self.next('('); order = (self.next(),direction == 'DESC'); self.next(')')
+        if self.peek() and self.peek().upper() == 'LIMIT':
+            self.next()
+            limit = int(self.next())
+        return form,answer_vars,pattern,order,limit,values
+
+    def parse_vars(self,*stops):
+        answer_vars = [ ]
+        while self.peek().upper() not in stops:
+            answer_vars.append(self.next())
+        return answer_vars
+
+    def parse_group(self):
+        self.next('{')
+        if self.peek() and self.peek().upper() == 'SELECT': #subquery
+            form,answer_vars,pattern,order,limit,values = self.parse_query()
+            if form != 'SELECT' or values is not None:
+                raise SparqlError(400,'unsupported subquery')
+            self.next('}')
+            return [('subquery',answer_vars,pattern,order,limit)]
+        pattern = [ ]
+        while self.peek() != '}':
+            token = self.peek()
+            if token == '{':
+                groups = [self.parse_group()]
+                while self.peek() and self.peek().upper() == 'UNION':
+                    self.next()
+                    groups.append(self.parse_group())
+                pattern.append(('union',groups))
+            elif token.upper() == 'BIND':
+                self.next(); self.next('(')
+                term = self.next(); self.next('AS'); var = self.next()
+                self.next(')')
+                pattern.append(('bind',term,var))
+            elif token.upper() == 'SERVICE':
+                self.next(); self.next()
+                self.skip_group()
+            elif token == '.':
+                self.next()
+            else:
+                subj,prop,obj = self.next(),self.next(),self.next()
+                if any(term[0] in '"(' or term.upper() == 'NONE' for term in (subj,prop,obj)):
+                    raise SparqlError(400,'unsupported triple %s %s %s'%(subj,prop,obj))
+                pattern.append(('triple',subj,prop,obj))
+        self.next('}')
+        return pattern
+
+    def skip_group(self):
+        self.next('{')
+        depth = 1
+        while depth:
+            token = self.next()
+            depth += 1 if token == '{' else -1 if token == '}' else 0
+
+
+class TripleStoreModelInterface(WikidataModelInterface):
+    """
+    Wikidata model whose queries are answered by a local TripleStore instead of the endpoint
+    """
+    def __init__(self,store):
+        """
+        @param store: a TripleStore
+        """
+        self.store = store
+
+    def make_quantifier(self,boundvarname,boundvartype,body,**kwargs):
+        return LocalExistentialQuantifier(boundvarname,boundvartype,body,answer_marked=kwargs.get('answer_marked',False),store=self.store)
+
+
+class LocalExistentialQuantifier(WikiExistentialQuantifier):
+    """
+    Existential quantifier evaluated against a local TripleStore
+    """
+    __slots__ = ['store']
+
+    def __init__(self,boundvar_name,boundvar_type,body,answer_marked=False,store=None):
+        super().__init__(boundvar_name,boundvar_type,body,answer_marked=answer_marked)
+        self.store = store
+
+    def send_query(self,query_string,qtype='ASK'):
+        """
+        Evaluates a complete query on the local store.
+        As with the endpoint, unsupported SELECT queries have no solution.
+        """
+        if qtype != 'SELECT':
+            return WikidataQuery.read_results(self.store.query(query_string),qtype)
+        try:
+            return WikidataQuery.read_results(self.store.query(query_string),qtype)
+        except SparqlError as e:
+            return [ ]
+
+    async def send_query_async(self,query_string,qtype='ASK'):
+        return self.send_query(query_string,qtype)
+
+    def stream_query(self,query_string):
+        yield from self.send_query(query_string,'SELECT')
+
+    async def send_batch_async(self,subqueries):
+        """
+        Evaluates SELECT queries merged in one (@see WikidataQuery.make_batch_query),
+        one by one if the batch is not supported.
+        """
+        try:
+            return WikidataQuery.read_batch_results(self.store.query(WikidataQuery.make_batch_query(subqueries)),len(subqueries))
+        except SparqlError:
+            return [self.send_query(WikidataQuery.wrap_query(generated_query,answer_vars,'SELECT'),'SELECT') for generated_query,answer_vars in subqueries]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    if len(sys.argv) < 3:
+        print('usage: python triple_store.py INDEX_DIR GRAPH_FILE ...')
+        sys.exit(1)
+    start = time.perf_counter()
+    store = TripleStore.build((triple for filename in sys.argv[2:] for triple in TripleStore.read_graph_file(filename)),sys.argv[1])
+    print('%s built in %.1fs'%(store,time.perf_counter()-start))
@@ -4,9 +4,12 @@
 Module for interpreting first order predicates 
 """
 import re
+import asyncio
+import threading
 from functional_core import *
 from lambda_parser import *
-from SPARQLWrapper import SPARQLWrapper, JSON
+from sparql_client import SparqlClient,SparqlError,QueryCache,normalize_query
+from sparql_planner import QueryPlanner
 
 class WikidataModelInterface(ModelInterface):
     """
@@ -37,6 +40,8 @@ class WikidataModelInterface(ModelInterface):
         return WikidataPredicate(predname,nargs)
 
     
+CLIENT_LOCK = threading.Lock() #guards the creation of the shared client (@see WikidataQuery.client)
+
 class WikidataQuery:
     """
     That's a namespace for storing wikidata config params
@@ -45,6 +50,38 @@ class WikidataQuery:
     PROPERTY_PREFIX = "PREFIX wd:  <http://www.wikidata.org/entity/>"
     ENDPOINT = 'https://query.wikidata.org/sparql'
     MAX_QUERY_RESULTS = 1000
+    MAX_CONNECTIONS   = 8      #idle connections kept alive
+    MAX_CONCURRENCY   = 8      #queries in flight
+    TIMEOUTS   = {'ASK':5.0,'COUNT':10.0,'SELECT':3.0} #deadline (in seconds) of the first attempt of a query, per query type
+    RETRIES    = 2             #retries after transient failures (@see SparqlClient)
+    RATE_LIMIT = None          #max queries per second (None for no limit)
+    CACHE_SIZE = 100000        #max number of cached outcomes of each kind (0 disables the cache)
+    CACHE_TTLS = {'positive':86400.0,'negative':3600.0,'error':300.0} #times to live in seconds (@see QueryCache)
+    PLANNER    = QueryPlanner() #orders the graph patterns (None keeps the derivation order @see QueryPlanner.from_files)
+    BATCH_SIZE = 1             #max number of SELECT queries merged in one request (@see make_batch_query), 1 sends them one by one
+    CLIENT = None
+
+    @staticmethod
+    def client():
+        """
+        @return the SparqlClient shared by the queries (created on first use with the config params above)
+        The client is created once whatever the number of threads asking for it, and when ENDPOINT
+        changes, the client of the previous endpoint is closed and replaced.
+        """
+        client = WikidataQuery.CLIENT
+        if client is not None and client.endpoint == WikidataQuery.ENDPOINT:
+            return client
+        with CLIENT_LOCK:
+            client = WikidataQuery.CLIENT
+            if client is None or client.endpoint != WikidataQuery.ENDPOINT:
+                if client is not None:
+                    client.close()
+                ttls   = WikidataQuery.CACHE_TTLS
+                cache  = QueryCache(WikidataQuery.CACHE_SIZE,ttls['positive'],ttls['negative'],ttls['error']) if WikidataQuery.CACHE_SIZE > 0 else None
+                client = SparqlClient(WikidataQuery.ENDPOINT,max_connections=WikidataQuery.MAX_CONNECTIONS,max_concurrency=WikidataQuery.MAX_CONCURRENCY,\
+                                      retries=WikidataQuery.RETRIES,rate=WikidataQuery.RATE_LIMIT,burst=WikidataQuery.MAX_CONCURRENCY,cache=cache)
+                WikidataQuery.CLIENT = client
+        return client
 
     @staticmethod
     def make_select_query(query_vars,generated_query):
@@ -102,65 +139,392 @@ class WikidataQuery:
         """%(WikidataQuery.ENTITY_PREFIX,WikidataQuery.PROPERTY_PREFIX,generated_query)
 
     @staticmethod
-    def run_query(query_string,answer_vars=None,qtype='ASK',debug=False,timeout=3):
+    def make_check_query(answer_var,values,generated_query):
         """
-        Connect to the server and run the query.
-        @param answer_vars: vars for which we are interested in getting the binding.
+        Wraps the generated code in an ASK clause checking whether one of the values is an answer
+        (the values are joined with the solutions in a final VALUES clause, after the BINDs of the pattern)
+        @param answer_var: the variable we seek the assignation for
+        @param values: a list of prefixed names (e.g. wd:Q42)
+        @param generated_query: the query code generated
+        @return a valid SPARQL query as a string
+        """
+        return """
+        %s
+        %s
+        ASK {
+            %s
+        } VALUES %s { %s }
+        """%(WikidataQuery.ENTITY_PREFIX,WikidataQuery.PROPERTY_PREFIX,generated_query,answer_var,' '.join(values))
+
+    @staticmethod
+    def make_batch_query(subqueries):
+        """
+        Merges SELECT queries in one: each query is a subquery (with its DISTINCT and LIMIT) in a UNION branch
+        binding ?__qid to the index of the query, so that the solutions can be sorted out by query (@see read_batch_results)
+        @param subqueries: a list of couples (generated_query,answer_vars)
+        @return a valid SPARQL query as a string, whitespace normalized
+        """
+        branches = ['{ { SELECT DISTINCT %s WHERE { %s } LIMIT %d } BIND(%d AS ?__qid) }'%(' '.join(answer_vars) if answer_vars else '*',generated_query,WikidataQuery.MAX_QUERY_RESULTS,idx)\
+                        for idx,(generated_query,answer_vars) in enumerate(subqueries)]
+        return normalize_query("""
+        %s
+        %s
+        SELECT * WHERE {
+            %s
+        }
+        """%(WikidataQuery.ENTITY_PREFIX,WikidataQuery.PROPERTY_PREFIX,' UNION '.join(branches)))
+
+    @staticmethod
+    def read_batch_results(results,nqueries):
+        """
+        Extracts the answers of each query from the JSON results of a batch query.
+        @param results: a dict (SPARQL JSON results format)
+        @param nqueries: the number of queries in the batch
+        @return a list with the assignments of each query (@see read_results)
+        """
+        answers = [[ ] for _ in range(nqueries)]
+        for binding in results['results']['bindings']:
+            idx = int(binding['__qid']['value'].split('/')[-1])
+            answers[idx].append([ (varname,binding[varname]['value'].split('/')[-1]) for varname in binding.keys() if varname != '__qid' ])
+        return answers
+
+    @staticmethod
+    def split_batch_results(results,subqueries):
+        """
+        Splits the JSON results of a batch query into the JSON results of its queries
+        @param results: a dict (SPARQL JSON results format)
+        @param subqueries: the list of couples (generated_query,answer_vars) of the batch
+        @return a list of dicts (SPARQL JSON results format), one per query
+        """
+        split = [{'head':{'vars':[var.lstrip('?') for var in answer_vars or [ ] if var != '*']},'results':{'bindings':[ ]}} for generated_query,answer_vars in subqueries]
+        for binding in results['results']['bindings']:
+            binding = dict(binding)
+            idx = int(binding.pop('__qid')['value'].split('/')[-1])
+            split[idx]['results']['bindings'].append(binding)
+        return split
+
+    @staticmethod
+    async def send_batch_async(subqueries,timeout=None):
+        """
+        Sends SELECT queries merged in one request (@see make_batch_query).
+        Each query is first looked up in the cache and among the queries in flight (@see SparqlClient.lookup):
+        only the other ones are merged, their results are cached and passed to the same queries asked meanwhile.
+        When the endpoint rejects the batch (one of the queries is incoherent), the queries are sent one by one.
+        @param subqueries: a list of couples (generated_query,answer_vars)
+        @param timeout: deadline of the first attempt (defaults to TIMEOUTS['SELECT'] per query)
+        @return a list with, for each query, its list of assignments or the SparqlError raised by the request
+        """
+        client  = WikidataQuery.client()
+        loop    = asyncio.get_running_loop()
+        queries = [WikidataQuery.wrap_query(generated_query,answer_vars,'SELECT') for generated_query,answer_vars in subqueries]
+        results = [None] * len(queries)
+        flights = { } #index of a query led by this batch -> its Future
+        waiting = { } #index of a query in flight elsewhere -> its Future
+        for idx,query in enumerate(queries):
+            try:
+                result,flight,leader = client.lookup(query)
+            except SparqlError as e:
+                result = e
+            if result is not None:
+                results[idx] = result
+            elif leader:
+                flights[idx] = flight
+            else:
+                waiting[idx] = flight
+        sent = list(flights)
+        if len(sent) > 1:
+            batch_timeout = WikidataQuery.TIMEOUTS.get('SELECT') * len(sent) if timeout is None else timeout
+            batch = [subqueries[idx] for idx in sent]
+            try:
+                batch_results = await loop.run_in_executor(client.executor,client.send_with_retries,WikidataQuery.make_batch_query(batch),batch_timeout)
+                for idx,result in zip(sent,WikidataQuery.split_batch_results(batch_results,batch)):
+                    client.complete(queries[idx],flights[idx],result)
+                    results[idx] = result
+                sent = [ ]
+            except SparqlError as e:
+                if e.is_transient(): #the failure of the batch is not cached for its queries
+                    for idx in sent:
+                        client.complete(queries[idx],flights[idx],error=e,cache=False)
+                        results[idx] = e
+                    sent = [ ]
+            except BaseException as e: #cancelled: the queries waiting for the batch get the error
+                for idx in sent:
+                    client.complete(queries[idx],flights[idx],error=e,cache=False)
+                raise
+        select_timeout = WikidataQuery.TIMEOUTS.get('SELECT')
+        tasks   = [loop.run_in_executor(client.executor,client.lead,queries[idx],flights[idx],select_timeout) for idx in sent]
+        tasks  += [asyncio.wrap_future(flight) for flight in waiting.values()]
+        for idx,result in zip(sent+list(waiting),await asyncio.gather(*tasks,return_exceptions=True)):
+            results[idx] = result
+        answers = [ ]
+        for result in results:
+            if isinstance(result,SparqlError) and not result.is_transient(): #rejected (incoherent) query: no solution
+                answers.append([ ])
+            elif isinstance(result,BaseException):
+                answers.append(result)
+            else:
+                answers.append(WikidataQuery.read_results(result,'SELECT'))
+        return answers
+
+    @staticmethod
+    def wrap_query(query_string,answer_vars=None,qtype='ASK'):
+        """
+        Wraps the generated code in a query of the requested type.
         @param query_string : the inner SPARQL code.
-        @param qtype: the query type: either ASK or SELECT
-        @return a boolean if qtype == ASK , a list of assigned entities otherwise.
+        @param answer_vars: vars for which we are interested in getting the binding.
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        @return a valid SPARQL query as a string, whitespace normalized (@see normalize_query)
         """
-        #SELECT QUERY
         if qtype == 'ASK':
-            query_string = WikidataQuery.make_ask_query(query_string)
-            if debug:
-                print('sparql query:',query_string)
-            sparql = SPARQLWrapper(WikidataQuery.ENDPOINT)
-            sparql.setQuery(query_string)
-            sparql.setReturnFormat(JSON)
-            results = sparql.query().convert()
-            return results['boolean'] 
+            return normalize_query(WikidataQuery.make_ask_query(query_string))
+        if not answer_vars:  #recovery for queries without identified focus
+            answer_vars = ['*']
+        if qtype == 'COUNT':
+            return normalize_query(WikidataQuery.make_count_query(answer_vars,query_string))
+        return normalize_query(WikidataQuery.make_select_query(answer_vars,query_string))
+
+    @staticmethod
+    def read_results(results,qtype='ASK'):
+        """
+        Extracts the answer from the JSON results of a query.
+        @param results: a dict (SPARQL JSON results format)
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        @return a boolean if qtype == ASK, a count if qtype == COUNT, a list of assignments otherwise
+        """
+        if qtype == 'ASK':
+            return results['boolean']
         elif qtype == 'COUNT':
-            if not answer_vars:  #recovery for queries without identified focus
-                answer_vars = ['*']
-            query_string = WikidataQuery.make_count_query(answer_vars,query_string)
-            if debug:
-                print('sparql query:',query_string)
-            sparql = SPARQLWrapper(WikidataQuery.ENDPOINT)
-            sparql.setQuery(query_string)
-            sparql.setReturnFormat(JSON)
-            results = sparql.query().convert()
             return results['results']['bindings'][0]['count']['value']
-        elif qtype == 'SELECT':
-            if not answer_vars:  #recovery for queries without identified focus
-                answer_vars = ['*']
-            query_string = WikidataQuery.make_select_query(answer_vars,query_string)
-            if debug:
-                print('sparql query:',query_string)
-
-            solutions = [ ]
-            try:
-                sparql = SPARQLWrapper(WikidataQuery.ENDPOINT)
-                sparql.setQuery(query_string)
-                sparql.setReturnFormat(JSON)
-                sparql.setTimeout(timeout)
-                results = sparql.query().convert()
-                #extract tuples 
-                for binding in results['results']['bindings']:
-                    solutions.append( [ (varname,binding[varname]['value'].split('/')[-1]) for varname in binding.keys() ])
-            except Exception as e:
-                #print('Incoherent query issued')
-                pass
-            return solutions
+        #extract tuples
+        return [ [ (varname,binding[varname]['value'].split('/')[-1]) for varname in binding.keys() ] for binding in results['results']['bindings'] ]
+
+    @staticmethod
+    def run_query(query_string,answer_vars=None,qtype='ASK',debug=False,timeout=None):
+        """
+        Connect to the server and run the query.
+        @param answer_vars: vars for which we are interested in getting the binding.
+        @param query_string : the inner SPARQL code.
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        @return a boolean if qtype == ASK , a list of assigned entities otherwise.
+        """
+        if qtype not in ('ASK','COUNT','SELECT'):
+            return None
+        query_string = WikidataQuery.wrap_query(query_string,answer_vars,qtype)
+        if debug:
+            print('sparql query:',query_string)
+        return WikidataQuery.send_query(query_string,qtype,timeout)
+
+    @staticmethod
+    async def run_query_async(query_string,answer_vars=None,qtype='ASK',debug=False,timeout=None):
+        """
+        Coroutine version of run_query: the query is sent by a worker thread of the client
+        and other coroutines run meanwhile (@see SparqlClient.query_async).
+        """
+        if qtype not in ('ASK','COUNT','SELECT'):
+            return None
+        query_string = WikidataQuery.wrap_query(query_string,answer_vars,qtype)
+        if debug:
+            print('sparql query:',query_string)
+        return await WikidataQuery.send_query_async(query_string,qtype,timeout)
+
+    @staticmethod
+    def join_patterns(patterns):
+        """
+        Joins the elements of a group pattern in the order chosen by the planner
+        @param patterns: a list of strings, the elements in derivation order
+        @return a string
+        """
+        if WikidataQuery.PLANNER is not None:
+            patterns = WikidataQuery.PLANNER.order(patterns)
+        return '\n'.join(patterns)
+
+    @staticmethod
+    def stream_query(query_string,timeout=None):
+        """
+        Sends a complete SELECT query and yields its assignments as they are read (@see SparqlClient.stream).
+        As with send_query, a query rejected by the endpoint has no solution.
+        A consumer stopping early closes the generator, which closes the stream of the client.
+        @param query_string : a SPARQL query
+        @param timeout: deadline of the first attempt (defaults to TIMEOUTS['SELECT'])
+        @return a generator of assignments, in the format of read_results
+        @raise SparqlError if the endpoint fails (unreachable, overloaded, timeout)
+        """
+        timeout = WikidataQuery.TIMEOUTS.get('SELECT') if timeout is None else timeout
+        stream  = WikidataQuery.client().stream(query_string,timeout=timeout)
+        try:
+            for binding in stream:
+                yield [ (varname,value.split('/')[-1]) for varname,value in binding.items() ]
+        except SparqlError as e:
+            if e.is_transient():
+                raise
+        finally:
+            stream.close()
+
+    @staticmethod
+    def send_query(query_string,qtype='ASK',timeout=None):
+        """
+        Sends a complete query (@see wrap_query) and reads its results.
+        A SELECT query rejected by the endpoint (an incoherent query) has no solution.
+        @param query_string : a SPARQL query
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        @param timeout: deadline of the first attempt (defaults to TIMEOUTS[qtype])
+        @return a boolean if qtype == ASK , a list of assigned entities otherwise.
+        @raise SparqlError if the endpoint fails (unreachable, overloaded, timeout), whatever the query type
+        """
+        timeout = WikidataQuery.TIMEOUTS.get(qtype) if timeout is None else timeout
+        try:
+            return WikidataQuery.read_results(WikidataQuery.client().query(query_string,timeout=timeout),qtype)
+        except SparqlError as e:
+            if qtype != 'SELECT' or e.is_transient():
+                raise
+            return [ ]
+
+    @staticmethod
+    async def send_query_async(query_string,qtype='ASK',timeout=None):
+        """
+        Coroutine version of send_query
+        """
+        timeout = WikidataQuery.TIMEOUTS.get(qtype) if timeout is None else timeout
+        try:
+            return WikidataQuery.read_results(await WikidataQuery.client().query_async(query_string,timeout=timeout),qtype)
+        except SparqlError as e:
+            if qtype != 'SELECT' or e.is_transient():
+                raise
+            return [ ]
+
+class SparqlTemplate:
+    """
+    A query generated once for a logical form whose database IDs are parameters (wd:Q$0, wdt:P$1 ...):
+    the queries of the logical forms with the same structure are obtained by substituting the actual IDs,
+    without building nor normalizing their lambda terms.
+    The elements of the group pattern are ordered for each instance, the planner estimates depending on
+    the IDs (@see WikidataQuery.PLANNER): the template keeps one query per evaluation order.
+    The groups nested in an element (UNION branches, subqueries) are ordered once, with the parameters.
+    """
+    PARAM_PATTERN  = re.compile(r'(?:wd:Q|wdt:P)\$([0-9]+)')
+    ENTITY_PATTERN = re.compile(r'Q[0-9]+$')
+    MAX_PLANS      = 32 #max number of evaluation orders kept by a template
+
+    def __init__(self,query_term,qtype='SELECT'):
+        """
+        @param query_term: a normalized query term built from parameters (@see parameter)
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        """
+        self.query_term   = query_term
+        self.qtype        = qtype
+        self.elements,self.answer_vars = query_term.sparql_elements()
+        self.plans        = { } #evaluation order -> (pattern,query_string) with parameters
+        order = WikidataQuery.PLANNER.plan(self.elements) if WikidataQuery.PLANNER is not None else tuple(range(len(self.elements)))
+        self.pattern,self.query_string = self.make_plan(order)
+
+    def __str__(self):
+        return self.query_string
+
+    @staticmethod
+    def substitute(text,ids):
+        """
+        @param text: a query or a pattern with parameters
+        @param ids: the IDs substituted to the parameters (e.g. ['wd:Q42','wdt:P31'])
+        @return the text of the instance
+        """
+        return SparqlTemplate.PARAM_PATTERN.sub(lambda match: ids[int(match.group(1))],text)
+
+    def make_plan(self,order):
+        """
+        @param order: the indexes of the elements of the group pattern, in evaluation order
+        @return a couple (pattern,query_string) with parameters
+        """
+        plan = self.plans.get(order)
+        if plan is None:
+            pattern = '\n'.join([self.elements[idx] for idx in order])
+            plan    = (pattern,WikidataQuery.wrap_query(pattern,self.answer_vars,self.qtype))
+            if len(self.plans) < SparqlTemplate.MAX_PLANS:
+                self.plans[order] = plan
+        return plan
+
+    def plan(self,ids):
+        """
+        Orders the elements of the group pattern of an instance.
+        Without statistics, the order does not depend on the IDs: it is the one of the template.
+        @param ids: the IDs substituted to the parameters
+        @return a couple (pattern,query_string) with parameters (@see make_plan)
+        """
+        if WikidataQuery.PLANNER is None or not WikidataQuery.PLANNER.has_statistics() or len(self.elements) < 2:
+            return self.pattern,self.query_string
+        return self.make_plan(WikidataQuery.PLANNER.plan([SparqlTemplate.substitute(elt,ids) for elt in self.elements]))
+
+    @staticmethod
+    def parameter(idx,arity):
+        """
+        @param idx: the index of the parameter in the template
+        @param arity: 1 for an entity, 2 for a property
+        @return a WikidataPredicate standing for the idx-th ID of a template
+        """
+        return WikidataPredicate(('wd:Q$%d' if arity == 1 else 'wdt:P$%d')%(idx,),arity)
+
+    def instantiate(self,ids):
+        """
+        @param ids: the IDs substituted to the parameters (e.g. ['wd:Q42','wdt:P31'])
+        @return the query, as generated by the query term with these IDs
+        """
+        pattern,query_string = self.plan(ids)
+        return SparqlTemplate.substitute(query_string,ids)
+
+    def check_query(self,ids,refset):
+        """
+        Generates the ASK query telling whether one of the reference answers is an answer of an instance
+        (@see WikidataQuery.make_check_query)
+        @param ids: the IDs substituted to the parameters
+        @param refset: the reference answers (wikidata IDs)
+        @return the ASK query or None if it cannot be checked that way (several answer variables,
+        references other than entities)
+        """
+        if len(self.answer_vars) != 1 or not all(SparqlTemplate.ENTITY_PATTERN.match(ref) for ref in refset):
+            return None
+        pattern,_    = self.plan(ids)
+        query_string = WikidataQuery.make_check_query(self.answer_vars[0],['wd:'+ref for ref in sorted(refset)],pattern)
+        return SparqlTemplate.substitute(normalize_query(query_string),ids)
+
+    def send_query(self,query_string,qtype=None):
+        """
+        Sends an instance of the template (@see WikiExistentialQuantifier.send_query)
+        @param qtype: the query type (defaults to the one of the template)
+        """
+        return self.query_term.send_query(query_string,self.qtype if qtype is None else qtype)
+
+    async def send_query_async(self,query_string,qtype=None):
+        return await self.query_term.send_query_async(query_string,self.qtype if qtype is None else qtype)
+
+    def stream_query(self,query_string):
+        """
+        Streams the assignments of an instance of a SELECT template (@see WikiExistentialQuantifier.stream_query)
+        """
+        return self.query_term.stream_query(query_string)
+
+    def instance_pattern(self,ids):
+        """
+        @param ids: the IDs substituted to the parameters
+        @return the couple (pattern,answer_vars) of an instance (@see WikidataQuery.make_batch_query)
+        """
+        pattern,_ = self.plan(ids)
+        return SparqlTemplate.substitute(pattern,ids),self.answer_vars
+
+    async def send_batch_async(self,subqueries):
+        """
+        Sends SELECT queries merged in one request (@see WikiExistentialQuantifier.send_batch_async)
+        """
+        return await self.query_term.send_batch_async(subqueries)
+
 
 class SparqlNameGenerator:
     """
     That's a name generator for generating sparql queries code and helper class for managing variable bindings.
+    Variables are numbered in the order they are created while generating a query (?x0, ?x1 ...),
+    the copies of a generator share its counter: the same logical form always yields the same query.
     """
-    UNIQUE_IDX = -1
-    
     def __init__(self):
         self.bound_names = {}
+        self.counter     = [0] #next variable index, shared with the copies
 
     def __str__(self):
         return '\n'.join(['%s => %s'%(vname,depth) for vname,depth in self.bound_names.items()])
@@ -168,21 +532,22 @@ class SparqlNameGenerator:
     def copy(self):
         cpy = SparqlNameGenerator()
         cpy.bound_names =  dict([(key,depth) for key,depth in self.bound_names.items()])
+        cpy.counter     = self.counter
         return cpy
 
-    @staticmethod
-    def get_unique_varname():
+    def get_unique_varname(self):
         """
-        @return a unique name for a new sparql variable
+        @return a name for a new sparql variable, unique within the query
         """
-        SparqlNameGenerator.UNIQUE_IDX += 1
-        return '?x%d'%(SparqlNameGenerator.UNIQUE_IDX,)
+        idx = self.counter[0]
+        self.counter[0] += 1
+        return '?x%d'%(idx,)
 
     def add_new_varname(self):
         """
         Create a new variable name with depth = 0
         """
-        newvarname = SparqlNameGenerator.get_unique_varname()
+        newvarname = self.get_unique_varname()
         self.bound_names[newvarname] = 0 
         return newvarname
     
@@ -202,12 +567,36 @@ class SparqlNameGenerator:
         
 class NamingContextWikidata(NamingContext):
     """
-    Interpreter name bindings management
+    Interpreter name bindings management.
+    The properties whose values are numbers or dates (@see VALUE_TYPES) are typed e=>num=>t or e=>date=>t,
+    the other ones e=>e=>t.
     """
+    #a few quantity and time properties, add the other ones with set_value_type
+    VALUE_TYPES = {'wdt:P1082':TypeSystem.NUMERIC, #population
+                   'wdt:P2044':TypeSystem.NUMERIC, #elevation above sea level
+                   'wdt:P2043':TypeSystem.NUMERIC, #length
+                   'wdt:P2046':TypeSystem.NUMERIC, #area
+                   'wdt:P2048':TypeSystem.NUMERIC, #height
+                   'wdt:P2067':TypeSystem.NUMERIC, #mass
+                   'wdt:P569':TypeSystem.DATE,     #date of birth
+                   'wdt:P570':TypeSystem.DATE,     #date of death
+                   'wdt:P571':TypeSystem.DATE,     #inception
+                   'wdt:P577':TypeSystem.DATE}     #publication date
+
     def __init__(self,debug=False):
 
         super().__init__(debug)
         self.predicates_pattern = re.compile('(wdt:P|wd:Q)[0-9]+')
+        self.value_types = dict(NamingContextWikidata.VALUE_TYPES)
+
+    def set_value_type(self,prop,value_type):
+        """
+        Sets the type of the values of a property
+        @param prop: a property (wdt:Pxx)
+        @param value_type: num, date or e (an entity)
+        """
+        self.value_types[prop] = value_type
+        self.version += 1
         
     def get_names(self):
         """
@@ -225,7 +614,7 @@ class NamingContextWikidata(NamingContext):
 
         if self.predicates_pattern.match(key):
             A = 1 if key.startswith('wd:Q') else 2
-            return WikidataPredicate(key,arity=A)
+            return WikidataPredicate(key,arity=A,value_type=self.value_types.get(key,TypeSystem.DB_ENTITY))
 
         return super().__getitem__(key)
     
@@ -242,7 +631,9 @@ class NamingContextWikidata(NamingContext):
         """
         context = NamingContextWikidata(debug)
         builtins = [ExtAddition(),ExtSubstraction(),ExtMultiplication(),ExtDivision(),WikiAnd(),WikiOr(),WikiNot(),\
-                    ExtEqual(),ExtNotEqual(),ExtLess(),ExtLessEq(),ExtGreater(),ExtGreaterEq(),Assignation(),Count()]
+                    ExtEqual(),ExtNotEqual(),ExtLess(),ExtLessEq(),ExtGreater(),ExtGreaterEq(),Assignation(),Count(),\
+                    WikiSuperlative('argmax',True),WikiSuperlative('argmin',False),\
+                    WikiSuperlative('latest',True,TypeSystem.DATE),WikiSuperlative('earliest',False,TypeSystem.DATE)]
         for f in builtins:
             context[f.fun_name] = f
         return context
@@ -254,12 +645,17 @@ class NamingContextWikidata(NamingContext):
 
 class WikidataPredicate(ConstantFunction):
 
-    def __init__(self,pred_name,arity):
+    __slots__ = ['arity']
+
+    def __init__(self,pred_name,arity,value_type=TypeSystem.DB_ENTITY):
         """
         @param name:the name of the predicate
         @param arity: the number or arguments of the predicate
+        @param value_type: the type of the second argument of a property (an entity, a number or a date)
         """
         pred_argtypes = tuple([TypeSystem.DB_ENTITY] * arity)
+        if arity == 2:
+            pred_argtypes = (TypeSystem.DB_ENTITY,value_type)
         super().__init__(name=pred_name,argtypes=pred_argtypes,ret_type=TypeSystem.BOOLEAN)
         assert(arity <= 2 and arity >= 0)
         self.arity = arity
@@ -305,6 +701,8 @@ class WikiAnd(ConstantFunction):
     """
     Implements logical and
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="and",argtypes=(TypeSystem.BOOLEAN,TypeSystem.BOOLEAN),ret_type=TypeSystem.BOOLEAN)
 
@@ -312,6 +710,10 @@ class WikiAnd(ConstantFunction):
         res = self.args_values[0].ret_value() and self.args_values[1].ret_value()
         return res
 
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) and rhs(env)
+
     def sparql_value(self,answer_vars,var_bindings):
         """
         This generates a SPARQL query for the AND
@@ -319,13 +721,27 @@ class WikiAnd(ConstantFunction):
         @param var_bindings: a dict sparql_varname: depth
         @return: a string part of the query
         """
-        return '\n'.join([self.args_values[0].sparql_value(answer_vars,var_bindings.copy()),self.args_values[1].sparql_value(answer_vars,var_bindings.copy())])
+        return WikidataQuery.join_patterns(self.sparql_patterns(answer_vars,var_bindings))
+
+    def sparql_patterns(self,answer_vars,var_bindings):
+        """
+        @return the elements of the group pattern of the conjunction (a list of strings), in derivation order
+        """
+        patterns = [ ]
+        for arg in self.args_values:
+            if hasattr(arg,'sparql_patterns'):
+                patterns.extend(arg.sparql_patterns(answer_vars,var_bindings.copy()))
+            else:
+                patterns.append(arg.sparql_value(answer_vars,var_bindings.copy()))
+        return patterns
 
     
 class WikiOr(ConstantFunction):
     """
     Implements logical OR
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="or",argtypes=(TypeSystem.BOOLEAN,TypeSystem.BOOLEAN),ret_type=TypeSystem.BOOLEAN)
 
@@ -333,6 +749,10 @@ class WikiOr(ConstantFunction):
     def ret_value(self):
         res = self.args_values[0].ret_value() or self.args_values[1].ret_value()
         return res
+
+    def compile_closure(self,arg_closures):
+        lhs,rhs = arg_closures
+        return lambda env: lhs(env) or rhs(env)
     
     def sparql_value(self,answer_vars,var_bindings):
         """
@@ -352,12 +772,18 @@ class WikiNot(ConstantFunction):
     """
     Implements logical not
     """
+    __slots__ = ()
+
     def __init__(self):
         super().__init__(name="not",argtypes=(TypeSystem.BOOLEAN,),ret_type=TypeSystem.BOOLEAN)
 
     def ret_value(self):
         return not self.args_values[0].ret_value()
 
+    def compile_closure(self,arg_closures):
+        arg, = arg_closures
+        return lambda env: not arg(env)
+
     def sparql_value(self,answer_vars,var_bindings):
         """
         This generates a SPARQL query for the predicate
@@ -367,8 +793,52 @@ class WikiNot(ConstantFunction):
         """
         return 'NEGATION GENERATOR NOT IMPLEMENTED !'
 
+class WikiSuperlative(SuperlativeCombinator):
+    """
+    Implements the superlatives (argmax, argmin, latest, earliest): the candidates are ranked by the endpoint
+    """
+    __slots__ = ()
+
+    def sparql_value(self,answer_vars,var_bindings):
+        """
+        This generates a SPARQL subquery for the superlative: the candidates x such that (Q x) and (P x v)
+        are sorted on v and only the first one is kept, e.g. for the highest mountain:
+           { SELECT ?x0 WHERE { ?x0 wdt:P31 wd:Q8502 . ?x0 wdt:P2044 ?x1 . } ORDER BY DESC(?x1) LIMIT 1 }
+        Only one of the ex aequo candidates is kept.
+        @param answer_vars : variables whose bindings are answers to the question 
+        @param var_bindings: a dict sparql_varname: depth
+        @return: a string part of the query
+        @raise CompilationError if the candidate variable x is not bound by an enclosing quantifier
+        """
+        xarg,xvar = self.args_values[2],None
+        if isinstance(xarg,LambdaVariable):
+            for sparql_varname,depth in var_bindings.items():
+                if xarg.is_bound(xarg.varname,depth):
+                    xvar = sparql_varname
+        if xvar is None:
+            raise CompilationError(self,'the candidates of %s are not bound by a quantifier'%(self.fun_name,))
+        patterns = [ ]
+        #the variables of the subquery are not answers: only x is projected
+        restriction = self.restriction()
+        if hasattr(restriction,'sparql_patterns'):
+            patterns.extend(restriction.sparql_patterns([],var_bindings.copy()))
+        else:
+            patterns.append(restriction.sparql_value([],var_bindings.copy()))
+        quantity_bindings = var_bindings.copy()
+        vname = quantity_bindings.add_new_varname()
+        quantity_bindings.deepen_indexes()
+        quantity = self.quantity()
+        if hasattr(quantity,'sparql_patterns'):
+            patterns.extend(quantity.sparql_patterns([],quantity_bindings))
+        else:
+            patterns.append(quantity.sparql_value([],quantity_bindings))
+        return '{ SELECT %s WHERE { %s } ORDER BY %s(%s) LIMIT 1 }'%(xvar,WikidataQuery.join_patterns(patterns),'DESC' if self.descending else 'ASC',vname)
+
+
 class WikiExistentialQuantifier(ExistentialQuantifier):
 
+    __slots__ = ['answer_marked']
+
     def __init__(self,boundvar_name,boundvar_type,body,answer_marked=False):
         """
         That creates an Existential quantifier term (exists (boundvar_name:boundvar_type) (func_body) )
@@ -383,15 +853,7 @@ class WikiExistentialQuantifier(ExistentialQuantifier):
         self.answer_marked = answer_marked
     
         
-    def copy(self,db_update=0,depth=0):
-        """
-        Performs a deep copy of the term and returns it
-        @param db_update: a number with which to update db_indexes
-        @return a WikiExistentialQuantifier instance
-        """
-        return WikiExistentialQuantifier(self.boundvar_name,self.boundvar_type,self.body.copy(db_update,depth+1),self.answer_marked)
-        
-    def ret_value(self,ret_type='ASK',debug=True):
+    def ret_value(self,ret_type='ASK',debug=False):
         """
         This evaluates the whole subformula behind this node against the database
         and returns a boolean (true or false) if there exists an assignment of the variables satisfied by the model.
@@ -400,10 +862,77 @@ class WikiExistentialQuantifier(ExistentialQuantifier):
         In this case, this prints an error message and returns False.
         @return a boolean
         """
+        query_string = self.sparql_query(ret_type)
+        if debug:
+            print('sparql query:',query_string)
+        return self.send_query(query_string,ret_type)
+
+    def sparql_query(self,ret_type='ASK'):
+        """
+        Generates the complete (canonical) query evaluated by ret_value
+        @return a SPARQL query as a string
+        """
+        sparql_query,answer_vars = self.sparql_pattern()
+        return WikidataQuery.wrap_query(sparql_query,answer_vars,ret_type)
+
+    def sparql_pattern(self):
+        """
+        Generates the group pattern of the query
+        @return a couple (pattern,answer_vars): the pattern (a string) and the list of the answer variables
+        """
+        elements,answer_vars = self.sparql_elements()
+        return WikidataQuery.join_patterns(elements),answer_vars
+
+    def sparql_elements(self):
+        """
+        Generates the elements of the group pattern of the query, in derivation order
+        @return a couple (elements,answer_vars): a list of strings and the list of the answer variables
+        """
         sparql_names = SparqlNameGenerator()
         answer_vars  = [] 
-        sparql_query = self.sparql_value(answer_vars,sparql_names)
-        return WikidataQuery.run_query(sparql_query,answer_vars=answer_vars,qtype=ret_type,debug=debug)
+        elements     = self.sparql_patterns(answer_vars,sparql_names)
+        return elements,answer_vars
+
+    async def ret_value_async(self,ret_type='ASK',debug=False):
+        """
+        Coroutine version of ret_value: the query is generated right away
+        and the coroutine waits for the database answer.
+        """
+        query_string = self.sparql_query(ret_type)
+        if debug:
+            print('sparql query:',query_string)
+        return await self.send_query_async(query_string,ret_type)
+
+    def send_query(self,query_string,qtype='ASK'):
+        """
+        Sends a complete query to the database this quantifier is evaluated against (the wikidata endpoint)
+        Subclasses evaluating queries elsewhere overload this method and send_query_async.
+        @param query_string: a SPARQL query (@see sparql_query)
+        @param qtype: the query type: either ASK, COUNT or SELECT
+        @return a boolean if qtype == ASK , a list of assigned entities otherwise.
+        """
+        return WikidataQuery.send_query(query_string,qtype)
+
+    async def send_query_async(self,query_string,qtype='ASK'):
+        """
+        Coroutine version of send_query
+        """
+        return await WikidataQuery.send_query_async(query_string,qtype)
+
+    def stream_query(self,query_string):
+        """
+        Sends a complete SELECT query and yields its assignments as they arrive (@see WikidataQuery.stream_query)
+        @return an iterable of assignments
+        """
+        return WikidataQuery.stream_query(query_string)
+
+    async def send_batch_async(self,subqueries):
+        """
+        Sends SELECT queries merged in one request (@see WikidataQuery.send_batch_async)
+        @param subqueries: a list of couples (generated_query,answer_vars)
+        @return a list with, for each query, its list of assignments or a SparqlError
+        """
+        return await WikidataQuery.send_batch_async(subqueries)
 
     def sparql_value(self,answer_vars=None,var_bindings=None):
         """        
@@ -412,19 +941,29 @@ class WikiExistentialQuantifier(ExistentialQuantifier):
         @param var_bindings: a SparqlNameGenerator object
         @return: a string being (part of) the query
         """        
+        return WikidataQuery.join_patterns(self.sparql_patterns(answer_vars,var_bindings))
+
+    def sparql_patterns(self,answer_vars,var_bindings):
+        """
+        @return the elements of the group pattern of the body (a list of strings), in derivation order
+        """
         vname = var_bindings.add_new_varname()
         var_bindings.deepen_indexes()
 
         if self.answer_marked:
             answer_vars.append(vname)
-                    
-        return self.body.sparql_value(answer_vars,var_bindings)
+
+        if hasattr(self.body,'sparql_patterns'):
+            return self.body.sparql_patterns(answer_vars,var_bindings)
+        return [self.body.sparql_value(answer_vars,var_bindings)]
 
 
 class Assignation(ConstantFunction): 
     """
     Gets assignations from a logical formula
     """
+    __slots__ = ()
+
     def __init__(self):
         #ret type will become a list type in the future
         super().__init__(name="assignation",argtypes=(TypeSystem.BOOLEAN,),ret_type=TypeSystem.DB_ENTITY)
@@ -436,18 +975,8 @@ class Assignation(ConstantFunction):
             return result
         return []
     
-    def __str__(self):
-        if isinstance(self.args_values[0],WikiExistentialQuantifier):
-            return str(self.ret_value())
-        else:
-            def pprint_arg(term):
-                if isinstance(term,ConstantFunction) and term.is_constant():
-                    return str(term.ret_value())
-                elif isinstance(term,LambdaVariable):
-                    return str(term)
-                else:
-                    return str(term)
-            return '%s(%s)'%(self.fun_name,','.join([pprint_arg(val) for val in self.args_values]))
+    def is_evaluable(self):
+        return isinstance(self.args_values[0],WikiExistentialQuantifier)
 
         
 class Count(ConstantFunction):
@@ -455,6 +984,8 @@ class Count(ConstantFunction):
     This counts the number of results in a query,
     that is the number of distinct assignments that make the query true
     """
+    __slots__ = ()
+
     def __init__(self):
         #ret type will become a list type in the future
         super().__init__(name="count",argtypes=(TypeSystem.BOOLEAN,),ret_type=TypeSystem.NUMERIC)
@@ -465,29 +996,15 @@ class Count(ConstantFunction):
             return result
         return []    
 
-    def __str__(self):
-        if isinstance(self.args_values[0],WikiExistentialQuantifier):
-            return str(self.ret_value())
-        else:
-            def pprint_arg(term):
-                if isinstance(term,ConstantFunction) and term.is_constant():
-                    return str(term.ret_value())
-                elif isinstance(term,LambdaVariable):
-                    return str(term)
-                else:
-                    return str(term)
-            return '%s(%s)'%(self.fun_name,','.join([pprint_arg(val) for val in self.args_values]))
+    def is_evaluable(self):
+        return isinstance(self.args_values[0],WikiExistentialQuantifier)
     
 if __name__ == '__main__':
     import sys
     
     wikidata_model = WikidataModelInterface()
-    wikidata_names = NamingContextWikidata.make_wikidata_builtins_context(debug=True)
-    if len(sys.argv) > 1 :
-         source_defines(sys.argv[1],wikidata_names,wikidata_model)
-
-    shell = InteractiveShell(model_interface =  wikidata_model, naming_context = wikidata_names)
-    shell.cmdloop()
+    wikidata_names = NamingContextWikidata.make_wikidata_builtins_context()
+    batch_main(wikidata_model,wikidata_names,description='Evaluates lambda terms against wikidata')
 
 
 